@@ -1,17 +1,31 @@
 # LangGraph Implementation for Patient Chatbot
 # Uses LangGraph StateGraph for state management with nodes and edges
 import os
+import asyncio
+import contextlib
+import functools
+import inspect
+import threading
+import time
 from typing import TypedDict, Annotated, Literal
 from dotenv import load_dotenv
-from langgraph.graph import StateGraph, END
-
-# Try the newer Client API import, fallback to standard import
-try:
-    from google import genai
-    USE_NEW_CLIENT = True
-except ImportError:
-    import google.generativeai as genai
-    USE_NEW_CLIENT = False
+from model_resolver import ModelResolver
+from model_health import ModelPool
+from session_store import create_session_store
+from session_turns import SessionTurnQueue
+from scenarios import create_scenario_registry
+from opening_pool import CANONICAL_GREETING, OpeningPool, is_generic_greeting
+from conversation_context import create_context_window, estimate_tokens, new_context
+from intent_router import Intent, route_message
+from treatment_classifier import classify_treatment_response, get_classifier
+import transcript
+from prompt_cache import PromptPrefixCache
+from response_cache import ResponseCache, cache_key
+from rate_limiter import PRIORITY_ACTIVE, PRIORITY_BACKGROUND, PRIORITY_NEW, AdaptiveRateLimiter, RateLimitExceeded
+from metrics import (
+    FAILED_REPLIES, GENERATE_SECONDS, LLM_CALL_SECONDS, NODE_SECONDS, PROMPT_SECONDS, RATE_LIMITED,
+    RETRIES, SDK_CALL_SECONDS, STATE_TRANSITIONS, TOKENS, TREATMENT_RESPONSES, span,
+)
 
 load_dotenv()
 
@@ -23,61 +37,157 @@ GEMINI_API_KEY = (
     os.environ.get("gemini_api_key")
 )
 if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable must be set")
+    print("[WARNING] GEMINI_API_KEY is not set; generation will fail until it is")
 
 # Set the API key in environment if not already set
-if not os.environ.get("GEMINI_API_KEY"):
+if GEMINI_API_KEY and not os.environ.get("GEMINI_API_KEY"):
     os.environ["GEMINI_API_KEY"] = GEMINI_API_KEY
 
-# Initialize the client based on available API
-if USE_NEW_CLIENT:
-    try:
-        client = genai.Client()
-        print("[INFO] Using newer Google Generative AI Client API")
-    except Exception as e:
-        print(f"[WARNING] New Client API failed: {e}, falling back to standard API")
-        USE_NEW_CLIENT = False
-        genai.configure(api_key=GEMINI_API_KEY)
-        client = None
-else:
-    genai.configure(api_key=GEMINI_API_KEY)
-    client = None
-    print("[INFO] Using standard Google Generative AI API")
-
-# Find an available model (prioritize free-tier models)
+# The Gemini SDK takes most of a second to import, so it is loaded and the
+# client built on first use (or by start_model_warmup), not at import time.
+# That keeps cold starts and /api/health, /api/session cheap.
+genai = None
+client = None
+USE_NEW_CLIENT = False
+_GENAI_READY = False
+_GENAI_LOCK = threading.Lock()
+
+def _init_genai_client():
+    """Import the Gemini SDK and build the client; runs once"""
+    global genai, client, USE_NEW_CLIENT, _GENAI_READY
+    with _GENAI_LOCK:
+        if _GENAI_READY:
+            return
+        if not GEMINI_API_KEY:
+            raise ValueError("GEMINI_API_KEY environment variable must be set")
+        # Try the newer Client API import, fallback to standard import
+        try:
+            from google import genai as sdk
+            use_new_client = True
+        except ImportError:
+            import google.generativeai as sdk
+            use_new_client = False
+
+        if use_new_client:
+            try:
+                new_client = sdk.Client()
+                # Keep a client installed by a test harness while we were importing
+                client = client or new_client
+                print("[INFO] Using newer Google Generative AI Client API")
+            except Exception as e:
+                print(f"[WARNING] New Client API failed: {e}, falling back to standard API")
+                use_new_client = False
+                import google.generativeai as sdk
+                sdk.configure(api_key=GEMINI_API_KEY)
+        else:
+            sdk.configure(api_key=GEMINI_API_KEY)
+            print("[INFO] Using standard Google Generative AI API")
+        genai, USE_NEW_CLIENT = sdk, use_new_client
+        _GENAI_READY = True
+
+def _genai_client():
+    """The new-API client, or None when the legacy SDK is in use"""
+    if client is None and not _GENAI_READY:
+        _init_genai_client()
+    return client if USE_NEW_CLIENT else None
+
+# Candidate models, prioritizing free-tier models
+MODEL_CANDIDATES = [
+    'gemini-1.5-flash',  # Free tier compatible
+    'gemini-1.0-pro',    # Free tier compatible
+    'gemini-pro',        # Free tier compatible
+    'gemini-2.5-flash',  # May not be on free tier
+    'gemini-1.5-pro',    # May not be on free tier
+]
+
+def _probe_model(model_name: str):
+    """Send a tiny request to check that model_name is usable; raises if not"""
+    gemini = _genai_client()
+    if gemini is not None:
+        gemini.models.generate_content(model=model_name, contents="test")
+    else:
+        genai.GenerativeModel(model_name).generate_content("test")
+
+# Model discovery runs in the background (see start_model_warmup) and is
+# cached on disk for all workers; the request path never probes.
+MODEL_RESOLVER = ModelResolver(
+    probe=_probe_model,
+    candidates=MODEL_CANDIDATES,
+    fallback=os.environ.get("GEMINI_MODEL", "gemini-2.5-flash"),
+    cache_path=os.environ.get("MODEL_CACHE_PATH"),
+    ttl=float(os.environ.get("MODEL_CACHE_TTL", 6 * 3600)),
+    revalidate_interval=float(os.environ.get("MODEL_REVALIDATE_INTERVAL", 1800)),
+)
+
+# Static prompt prefixes are registered as Gemini cached contents
+PREFIX_CACHE = PromptPrefixCache(
+    ttl_seconds=float(os.environ.get("PROMPT_CACHE_TTL", 3600)),
+    enabled=os.environ.get("PROMPT_CACHE_ENABLED", "true").lower() != "false",
+    # Gemini's minimum for an explicit cache (model dependent); smaller prefixes are never sent to caches.create
+    min_tokens=int(os.environ.get("PROMPT_CACHE_MIN_TOKENS", 1024)),
+)
+
+def get_prompt_cache_stats() -> dict:
+    """Per-node prompt/cached token counts and cached-token hit ratio"""
+    return PREFIX_CACHE.stats()
+
+# Every Gemini call waits its turn here; limits adapt to 429 responses
+RATE_LIMITER = AdaptiveRateLimiter(
+    rpm=float(os.environ.get("GEMINI_RPM", 60)),
+    tpm=float(os.environ.get("GEMINI_TPM", 1_000_000)),
+    max_wait=float(os.environ.get("RATE_LIMIT_MAX_WAIT", 30)),
+    max_wait_new=float(os.environ.get("RATE_LIMIT_MAX_WAIT_NEW", 10)),
+    max_queue=int(os.environ.get("RATE_LIMIT_MAX_QUEUE", 500)),
+    redis_url=os.environ.get("RATE_LIMIT_REDIS_URL"),
+)
+
+def get_rate_limiter_stats() -> dict:
+    """Learned limits, queue depth and shed/429 counters"""
+    return RATE_LIMITER.stats()
+
+# Per-model circuit breakers; calls go to the first healthy model in
+# fallback order and are optionally hedged to the next one after its p95
+MODEL_POOL = ModelPool(
+    MODEL_CANDIDATES,
+    error_threshold=float(os.environ.get("MODEL_BREAKER_ERROR_RATE", 0.5)),
+    cooldown=float(os.environ.get("MODEL_BREAKER_COOLDOWN", 30)),
+)
+HEDGING_ENABLED = os.environ.get("HEDGING_ENABLED", "false").lower() == "true"
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", 1.0))
+_HEDGE_TASKS = set()
+
+def get_model_health_stats() -> dict:
+    """Circuit breaker state, error rate and p95 per model, and hedge counts"""
+    return dict(MODEL_POOL.stats(), hedging=HEDGING_ENABLED)
+
 def get_available_model():
     """Try different model names, prioritizing free-tier compatible models"""
-    model_names = [
-        'gemini-1.5-flash',  # Free tier compatible
-        'gemini-1.0-pro',    # Free tier compatible
-        'gemini-pro',        # Free tier compatible
-        'gemini-2.5-flash',  # May not be on free tier
-        'gemini-1.5-pro',    # May not be on free tier
-    ]
-    
-    for model_name in model_names:
-        try:
-            if USE_NEW_CLIENT and client:
-                test_response = client.models.generate_content(
-                    model=model_name,
-                    contents="test"
-                )
-            else:
-                model = genai.GenerativeModel(model_name)
-                test_response = model.generate_content("test")
-            print(f"[INFO] Using model: {model_name}")
-            return model_name
-        except Exception as e:
-            error_msg = str(e)
-            if "404" not in error_msg and "not found" not in error_msg.lower() and "429" not in error_msg:
-                print(f"[INFO] Using model: {model_name} (test had minor issue, but will try)")
-                return model_name
-            print(f"[ERROR] Model {model_name} not available: {error_msg[:50]}")
-            continue
-    
-    raise ValueError("No available Gemini models found. Check API key and quota.")
+    return MODEL_RESOLVER.refresh(max_age=0)
 
-MODEL_NAME = None  # lazy-load later
+def start_model_warmup():
+    """
+    Resolve the model in a background thread and keep re-validating it.
+    Another thread loads the SDK and compiles the graph, so the first turn
+    doesn't pay for them.
+    """
+    MODEL_RESOLVER.warm_up()
+    if os.environ.get("WARM_UP_ENABLED", "true").lower() != "false":
+        threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+def _warm_up():
+    started = time.perf_counter()
+    try:
+        _genai_client()
+        get_patient_graph()
+        get_classifier()
+    except Exception as e:
+        print(f"[WARNING] Warm-up failed, loading on first use instead: {e}")
+        return
+    # Opening replies for the scenario new sessions get by default
+    scenario = SCENARIOS.get(SCENARIOS.default)
+    if scenario is not None:
+        _prefetch_opening(scenario.new_profile())
+    print(f"[INFO] Warm-up finished in {time.perf_counter() - started:.2f}s")
 
 
 # ============================================================================
@@ -95,27 +205,85 @@ class PatientState(TypedDict):
     treatment_detected: bool
     treatment_accepted: bool
     patient_profile: dict
+    conversation_context: dict  # rolling summary + render cache, see conversation_context.py
+    intent: Intent  # routing decision for user_message, made once per turn (intent_router.py)
+
+# ============================================================================
+# Instrumentation
+# ============================================================================
+
+_NO_SPAN = contextlib.nullcontext()
+
+def _timed_node(histogram, node: str, traced: bool = False):
+    """
+    Observe a node step's duration under `node` (sync or async, taking the
+    state first). With `traced`, also open a span carrying the session_id.
+    """
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            async def wrapper(state, *args, **kwargs):
+                context = span(f"node.{node}", session_id=state.get("session_id")) if traced else _NO_SPAN
+                with context, histogram.time(node=node):
+                    return await fn(state, *args, **kwargs)
+        else:
+            def wrapper(state, *args, **kwargs):
+                context = span(f"node.{node}", session_id=state.get("session_id")) if traced else _NO_SPAN
+                with context, histogram.time(node=node):
+                    return fn(state, *args, **kwargs)
+        return functools.wraps(fn)(wrapper)
+    return decorate
+
+def _timed_generation(histogram, span_name: str):
+    """
+    Observe a generation call's duration under its `node` argument. Works
+    for plain and async functions and for (async) streaming generators,
+    which are timed until the stream ends. Streams get no span, since a
+    span cannot stay current across yields.
+    """
+    def node_of(args, kwargs):
+        return kwargs.get("node", args[2] if len(args) > 2 else None) or "unknown"
+
+    def decorate(fn):
+        if inspect.isasyncgenfunction(fn):
+            async def wrapper(*args, **kwargs):
+                with histogram.time(node=node_of(args, kwargs)):
+                    async for item in fn(*args, **kwargs):
+                        yield item
+        elif inspect.isgeneratorfunction(fn):
+            def wrapper(*args, **kwargs):
+                with histogram.time(node=node_of(args, kwargs)):
+                    yield from fn(*args, **kwargs)
+        elif inspect.iscoroutinefunction(fn):
+            async def wrapper(*args, **kwargs):
+                node = node_of(args, kwargs)
+                with span(span_name, node=node), histogram.time(node=node):
+                    return await fn(*args, **kwargs)
+        else:
+            def wrapper(*args, **kwargs):
+                node = node_of(args, kwargs)
+                with span(span_name, node=node), histogram.time(node=node):
+                    return fn(*args, **kwargs)
+        return functools.wraps(fn)(wrapper)
+    return decorate
 
 # ============================================================================
 # LangGraph Node Functions
 # ============================================================================
 
-def initial_greeting_node(state: PatientState) -> PatientState:
-    """Node 1: Initial greeting with mild symptoms"""
+def _instruction(state: PatientState, node: str, level: int) -> str:
+    """The session scenario's pre-rendered instruction for a node (see scenarios.py)"""
     profile = state["patient_profile"]
-    
-    prompt = f"""You are a simulated patient. Your patient profile:
-- Name: {profile["patient_name"]}
-- Age: {profile["age"]}
-- MedicalHistory: {profile["med_history"]}
-
-You are starting a conversation with a doctor. Introduce yourself briefly and mention only MILD symptoms. Keep it short and natural.
+    return SCENARIOS.for_profile(profile).instruction(node, level, profile)
 
-Doctor: {state["user_message"]}
-Patient:"""
-    
-    response = generate_response(prompt)
+@_timed_node(PROMPT_SECONDS, "initial_greeting")
+def _initial_greeting_prompt(state: PatientState) -> tuple[str, str]:
+    instruction = _instruction(state, "initial_greeting", 0)
     
+    prompt = f"""Doctor: {state["user_message"]}
+Patient:"""
+    return instruction, prompt
+
+def _initial_greeting_result(state: PatientState, response: str) -> PatientState:
     return {
         "patient_response": response,
         "current_state": "questioning",
@@ -126,34 +294,33 @@ Patient:"""
         ]
     }
 
-def questioning_node(state: PatientState) -> PatientState:
-    """Node 2: Answer doctor's questions"""
-    profile = state["patient_profile"]
-    history = format_history(state["conversation_history"])
-    
-    prompt = f"""You are a simulated patient. Your patient profile:
-- Name: {profile["patient_name"]}
-- Age: {profile["age"]}
-- MedicalHistory: {profile["med_history"]}
-
-You are answering the doctor's questions. Be concise and factual. If asked about symptoms, reveal a bit more detail than before, but still keep it moderate.
+@_timed_node(NODE_SECONDS, "initial_greeting", traced=True)
+def initial_greeting_node(state: PatientState) -> PatientState:
+    """Node 1: Initial greeting with mild symptoms"""
+    instruction, prompt = _initial_greeting_prompt(state)
+    response = generate_response(prompt, instruction, node="initial_greeting")
+    return _initial_greeting_result(state, response)
 
-Conversation history:
+@_timed_node(PROMPT_SECONDS, "questioning")
+def _questioning_prompt(state: PatientState) -> tuple[str, str]:
+    history = format_history(state["conversation_history"], state.get("conversation_context"))
+    instruction = _instruction(state, "questioning", state["symptom_level"])
+    
+    prompt = f"""Conversation history:
 {history}
 
 Doctor: {state["user_message"]}
 Patient:"""
-    
-    response = generate_response(prompt)
-    
+    return instruction, prompt
+
+def _questioning_result(state: PatientState, response: str) -> PatientState:
     # Check if treatment is mentioned
-    treatment_keywords = ["prescribe", "medication", "treatment", "take", "medicine", "drug"]
-    treatment_detected = any(keyword in state["user_message"].lower() for keyword in treatment_keywords)
+    treatment_detected = state["intent"].treatment
     
     # Determine next state
     if treatment_detected:
         next_state = "treatment"
-    elif state["symptom_level"] < 2 and any(word in state["user_message"].lower() for word in ["more", "detail", "tell me", "describe"]):
+    elif state["symptom_level"] < 2 and state["intent"].detail:
         next_state = "progressive"
     else:
         next_state = "questioning"
@@ -168,34 +335,31 @@ Patient:"""
         ]
     }
 
-def progressive_revelation_node(state: PatientState) -> PatientState:
-    """Node 3: Progressive symptom revelation"""
-    profile = state["patient_profile"]
-    history = format_history(state["conversation_history"])
-    symptom_level = min(state["symptom_level"] + 1, 2)  # Increment but cap at 2
+@_timed_node(NODE_SECONDS, "questioning", traced=True)
+def questioning_node(state: PatientState) -> PatientState:
+    """Node 2: Answer doctor's questions"""
+    instruction, prompt = _questioning_prompt(state)
+    response = generate_response(prompt, instruction, node="questioning")
+    return _questioning_result(state, response)
+
+@_timed_node(PROMPT_SECONDS, "progressive_revelation")
+def _progressive_revelation_prompt(state: PatientState) -> tuple[str, str]:
+    history = format_history(state["conversation_history"], state.get("conversation_context"))
+    # reveals the next symptom level; the result moves the session to it
+    instruction = _instruction(state, "progressive_revelation", state["symptom_level"] + 1)
     
-    prompt = f"""You are a simulated patient. Your patient profile:
-- Name: {profile["patient_name"]}
-- Age: {profile["age"]}
-- MedicalHistory: {profile["med_history"]}
-
-The doctor is asking for more details. Reveal MORE detailed symptoms now. Be more specific about:
-- When symptoms started
-- Severity and frequency
-- Any triggers or patterns
-- Impact on daily life
-
-Conversation history:
+    prompt = f"""Conversation history:
 {history}
 
 Doctor: {state["user_message"]}
 Patient:"""
-    
-    response = generate_response(prompt)
+    return instruction, prompt
+
+def _progressive_revelation_result(state: PatientState, response: str) -> PatientState:
+    symptom_level = min(state["symptom_level"] + 1, 2)  # Increment but cap at 2
     
     # Check for treatment
-    treatment_keywords = ["prescribe", "medication", "treatment", "take", "medicine", "drug"]
-    treatment_detected = any(keyword in state["user_message"].lower() for keyword in treatment_keywords)
+    treatment_detected = state["intent"].treatment
     
     next_state = "treatment" if treatment_detected else "questioning"
     
@@ -210,31 +374,30 @@ Patient:"""
         ]
     }
 
-def treatment_node(state: PatientState) -> PatientState:
-    """Node 4: Treatment detection and acceptance"""
-    profile = state["patient_profile"]
-    history = format_history(state["conversation_history"])
-    
-    prompt = f"""You are a simulated patient. Your patient profile:
-- Name: {profile["patient_name"]}
-- Age: {profile["age"]}
-- MedicalHistory: {profile["med_history"]}
-
-The doctor has prescribed a treatment. Evaluate if it's reasonable for your condition:
-- If reasonable: Accept it clearly by saying "I accept the treatment: [treatment name]"
-- If unclear: Ask clarifying questions
-- If unreasonable: Politely express concern
+@_timed_node(NODE_SECONDS, "progressive_revelation", traced=True)
+def progressive_revelation_node(state: PatientState) -> PatientState:
+    """Node 3: Progressive symptom revelation"""
+    instruction, prompt = _progressive_revelation_prompt(state)
+    response = generate_response(prompt, instruction, node="progressive_revelation")
+    return _progressive_revelation_result(state, response)
 
-Conversation history:
+@_timed_node(PROMPT_SECONDS, "treatment")
+def _treatment_prompt(state: PatientState) -> tuple[str, str]:
+    history = format_history(state["conversation_history"], state.get("conversation_context"))
+    instruction = _instruction(state, "treatment", state["symptom_level"])
+    
+    prompt = f"""Conversation history:
 {history}
 
 Doctor: {state["user_message"]}
 Patient:"""
-    
-    response = generate_response(prompt)
-    
-    # Check if patient accepted
-    treatment_accepted = "accept" in response.lower() and "treatment" in response.lower()
+    return instruction, prompt
+
+def _treatment_result(state: PatientState, response: str) -> PatientState:
+    # Grade the reply locally (accept / concern / clarification)
+    graded = classify_treatment_response(response)
+    TREATMENT_RESPONSES.inc(label=graded.label, source=graded.source)
+    treatment_accepted = graded.accepted
     
     return {
         "patient_response": response,
@@ -247,130 +410,711 @@ Patient:"""
         ]
     }
 
+@_timed_node(NODE_SECONDS, "treatment", traced=True)
+def treatment_node(state: PatientState) -> PatientState:
+    """Node 4: Treatment detection and acceptance"""
+    instruction, prompt = _treatment_prompt(state)
+    response = generate_response(prompt, instruction, node="treatment")
+    return _treatment_result(state, response)
+
+# Each node is split into a prompt builder and a result builder so the
+# blocking and streaming paths share the same prompts and state transitions.
+# Prompt builders return (instruction, prompt): the instruction is the
+# static persona/node prefix that Gemini can cache, the prompt is the
+# per-turn suffix.
+NODE_STEPS = {
+    "initial_greeting": (_initial_greeting_prompt, _initial_greeting_result),
+    "questioning": (_questioning_prompt, _questioning_result),
+    "progressive_revelation": (_progressive_revelation_prompt, _progressive_revelation_result),
+    "treatment": (_treatment_prompt, _treatment_result),
+}
+
+# asyncio variants of the nodes, used by the ASGI request path
+@_timed_node(NODE_SECONDS, "initial_greeting", traced=True)
+async def ainitial_greeting_node(state: PatientState) -> PatientState:
+    instruction, prompt = _initial_greeting_prompt(state)
+    response = await generate_response_async(prompt, instruction, node="initial_greeting")
+    return _initial_greeting_result(state, response)
+
+@_timed_node(NODE_SECONDS, "questioning", traced=True)
+async def aquestioning_node(state: PatientState) -> PatientState:
+    instruction, prompt = _questioning_prompt(state)
+    response = await generate_response_async(prompt, instruction, node="questioning")
+    return _questioning_result(state, response)
+
+@_timed_node(NODE_SECONDS, "progressive_revelation", traced=True)
+async def aprogressive_revelation_node(state: PatientState) -> PatientState:
+    instruction, prompt = _progressive_revelation_prompt(state)
+    response = await generate_response_async(prompt, instruction, node="progressive_revelation")
+    return _progressive_revelation_result(state, response)
+
+@_timed_node(NODE_SECONDS, "treatment", traced=True)
+async def atreatment_node(state: PatientState) -> PatientState:
+    instruction, prompt = _treatment_prompt(state)
+    response = await generate_response_async(prompt, instruction, node="treatment")
+    return _treatment_result(state, response)
+
 # ============================================================================
 # Helper Functions
 # ============================================================================
 
-def _call_gemini_llm_raw(prompt: str) -> str:
+def _is_rate_limit_error(error_msg: str) -> bool:
+    return "429" in error_msg or "RESOURCE_EXHAUSTED" in error_msg or "quota" in error_msg.lower()
+
+# Nodes whose calls are speculative background work, not a live turn
+SPECULATIVE_NODES = frozenset({"opening_pool"})
+
+def _call_priority(node: str | None) -> int:
+    """Conversations in progress are served before new sessions, and both before pre-generation"""
+    if node in SPECULATIVE_NODES:
+        return PRIORITY_BACKGROUND
+    return PRIORITY_NEW if node == "initial_greeting" else PRIORITY_ACTIVE
+
+def _sdk_config(gemini, model_name: str, system_instruction: str | None) -> dict | None:
+    """Config carrying the static prompt prefix (explicitly cached when possible)"""
+    if not system_instruction:
+        return None
+    return PREFIX_CACHE.config_for(gemini, model_name, system_instruction)
+
+def _record_usage(node: str | None, usage_metadata):
+    """Feed a response's token counts to the prefix cache stats and metrics"""
+    PREFIX_CACHE.record_usage(node, usage_metadata)
+    if usage_metadata is not None:
+        node = node or "unknown"
+        TOKENS.inc(getattr(usage_metadata, "prompt_token_count", None) or 0, node=node, kind="prompt")
+        TOKENS.inc(getattr(usage_metadata, "candidates_token_count", None) or 0, node=node, kind="completion")
+
+def _record_success(model_name: str, node: str | None, started: float, usage_metadata):
+    latency = time.perf_counter() - started
+    MODEL_POOL.breaker(model_name).record_success(latency)
+    SDK_CALL_SECONDS.observe(latency, model=model_name, outcome="ok")
+    _record_usage(node, usage_metadata)
+    RATE_LIMITER.on_success()
+
+def _record_failure(model_name: str, started: float, error: Exception, node: str | None = None):
+    breaker = MODEL_POOL.breaker(model_name)
+    if node in SPECULATIVE_NODES and not _is_rate_limit_error(str(error)):
+        # Pre-generation failures are counted apart so they never open a circuit on live traffic
+        breaker.record_neutral()
+        MODEL_POOL.record_speculative_failure()
+        outcome = "speculative_error"
+    elif _is_rate_limit_error(str(error)):
+        # Quota exhaustion says nothing about the model's health
+        RATE_LIMITER.on_rate_limited()
+        RATE_LIMITED.inc(model=model_name)
+        breaker.record_neutral()
+        outcome = "rate_limited"
+    else:
+        breaker.record_failure()
+        outcome = "error"
+    SDK_CALL_SECONDS.observe(time.perf_counter() - started, model=model_name, outcome=outcome)
+
+def _call_model(model_name: str, prompt: str, system_instruction: str | None = None, node: str | None = None,
+                timeout: float | None = None) -> str:
     """
-    Low-level call that actually invokes the Gemini SDK (new or legacy),
-    returning a plain string. This isolates the direct SDK usage so a
-    LangChain wrapper can call it safely.
+    One SDK call (new or legacy) to model_name, feeding its circuit breaker.
+    With timeout (seconds) the SDK gives up after that long, raising
+    TimeoutError; that says nothing about the model's health.
     """
-    global MODEL_NAME
-    # Choose model lazily if not chosen yet
-    if MODEL_NAME is None:
-        try:
-            MODEL_NAME = get_available_model()
-        except Exception as e:
-            print(f"[WARNING] Model discovery failed in raw call: {e}. Using fallback.")
-            MODEL_NAME = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
-
-    # Actual SDK call (same logic you already have)
+    gemini = _genai_client()
+    started = time.perf_counter()
     try:
-        if USE_NEW_CLIENT and client:
-            response = client.models.generate_content(model=MODEL_NAME, contents=prompt)
+        if gemini is not None:
+            config = _sdk_config(gemini, model_name, system_instruction)
+            if timeout is not None:
+                config = dict(config or {}, http_options={"timeout": int(timeout * 1000)})
+            response = gemini.models.generate_content(model=model_name, contents=prompt, config=config)
             # New client responses have `.text` or `.content`
-            return getattr(response, "text", getattr(response, "content", str(response)))
+            text = getattr(response, "text", getattr(response, "content", str(response)))
         else:
             # legacy API usage
             if genai is None:
                 raise RuntimeError("No genai SDK available.")
-            model = genai.GenerativeModel(MODEL_NAME)
-            response = model.generate_content(prompt)
-            return getattr(response, "text", str(response))
+            model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+            if timeout is not None:
+                response = model.generate_content(prompt, request_options={"timeout": timeout})
+            else:
+                response = model.generate_content(prompt)
+            text = getattr(response, "text", str(response))
     except Exception as e:
-        # Let caller handle fallback / retries — return error string
-        err = f"(Gemini call failed: {str(e)[:200]})"
-        print("Error in _call_gemini_llm_raw:", err)
+        if timeout is not None and time.perf_counter() - started >= timeout:
+            MODEL_POOL.breaker(model_name).record_neutral()
+            SDK_CALL_SECONDS.observe(time.perf_counter() - started, model=model_name, outcome="abandoned")
+            raise TimeoutError(f"{model_name} gave no answer within {timeout:.1f}s") from e
+        _record_failure(model_name, started, e, node)
         raise
+    _record_success(model_name, node, started, getattr(response, "usage_metadata", None))
+    return text
 
-def generate_response(prompt: str) -> str:
+async def _acall_model(model_name: str, prompt: str, system_instruction: str | None = None, node: str | None = None) -> str:
+    """asyncio counterpart of _call_model"""
+    gemini = _genai_client()
+    started = time.perf_counter()
+    try:
+        if gemini is not None:
+            config = await PREFIX_CACHE.aconfig_for(gemini, model_name, system_instruction) if system_instruction else None
+            response = await gemini.aio.models.generate_content(model=model_name, contents=prompt, config=config)
+            text = getattr(response, "text", getattr(response, "content", str(response)))
+        else:
+            if genai is None:
+                raise RuntimeError("No genai SDK available.")
+            model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+            response = await model.generate_content_async(prompt)
+            text = getattr(response, "text", str(response))
+    except asyncio.CancelledError:
+        MODEL_POOL.breaker(model_name).record_neutral()
+        raise
+    except Exception as e:
+        _record_failure(model_name, started, e, node)
+        raise
+    _record_success(model_name, node, started, getattr(response, "usage_metadata", None))
+    return text
+
+def _hedge_delay(model_name: str) -> float | None:
+    """How long to wait for model_name before hedging (None: don't hedge)"""
+    if not HEDGING_ENABLED:
+        return None
+    p95 = MODEL_POOL.breaker(model_name).p95()
+    return None if p95 is None else max(p95, HEDGE_MIN_DELAY)
+
+def _claim_backup(backups: list, tokens: int) -> str | None:
+    """Next healthy model for a hedge, if the rate limiter has capacity to spare"""
+    for model_name in backups:
+        breaker = MODEL_POOL.breaker(model_name)
+        if breaker.allow():
+            # A hedge never queues: it only helps if it can start right away
+            if RATE_LIMITER.try_acquire(tokens):
+                return model_name
+            breaker.record_neutral()
+            MODEL_POOL.record_hedge_skipped()
+            return None
+    return None
+
+def _call_hedged(model_name: str, backups: list, prompt: str, system_instruction: str | None,
+                 node: str | None, tokens: int) -> str:
     """
-    Main generation entrypoint used by nodes.
-    Tries using a LangChain PromptTemplate + LLMChain (if langchain available),
-    otherwise falls back to direct Gemini calls with retry logic.
+    Call model_name on the caller's thread. A blocking SDK call can't be
+    raced, so when a hedge applies the call gets an SDK timeout at the
+    model's p95 latency: past that it is abandoned and the next healthy
+    model answers instead, also on the caller's thread. The asyncio path
+    keeps both calls running and returns whichever answers first.
     """
-    import time, traceback
+    delay = _hedge_delay(model_name) if backups else None
+    if delay is None or not any(MODEL_POOL.breaker(backup).is_available() for backup in backups):
+        return _call_model(model_name, prompt, system_instruction, node)
+    try:
+        return _call_model(model_name, prompt, system_instruction, node, timeout=delay)
+    except TimeoutError:
+        pass
 
-    # Ensure Gemini client/module is initialized (lazy)
+    # Its circuit may have opened meanwhile: then ask the primary again, without a deadline
+    backup_model = next((backup for backup in backups if MODEL_POOL.breaker(backup).allow()), model_name)
+    print(f"[INFO] {model_name} slower than its p95 ({delay:.1f}s), abandoned for {backup_model}")
+    # Replaces the abandoned call, so it queues like any other call of a conversation in progress
+    RATE_LIMITER.acquire(tokens, PRIORITY_ACTIVE)
     try:
-        _init_genai_client()
+        result = _call_model(backup_model, prompt, system_instruction, node)
     except Exception:
-        traceback.print_exc()
+        MODEL_POOL.record_hedge(won=False)
+        raise
+    MODEL_POOL.record_hedge(won=True)
+    return result
 
-    # If LangChain is installed, try to use a small PromptTemplate + LLMChain.
-    # We create a tiny adapter LLM that delegates to our _call_gemini_llm_raw.
-    try:
-        from langchain.prompts import PromptTemplate
-        from langchain.chains import LLMChain
-        from langchain.llms.base import LLM
+def _detach(task: asyncio.Task):
+    """Let a hedge loser finish in the background without warnings"""
+    _HEDGE_TASKS.add(task)
+    task.add_done_callback(lambda t: (_HEDGE_TASKS.discard(t), t.cancelled() or t.exception()))
+
+async def _acall_hedged(model_name: str, backups: list, prompt: str, system_instruction: str | None,
+                        node: str | None, tokens: int) -> str:
+    """asyncio counterpart of _call_hedged"""
+    delay = _hedge_delay(model_name) if backups else None
+    if delay is None:
+        return await _acall_model(model_name, prompt, system_instruction, node)
 
-        class _GeminiAdapterLLM(LLM):
-            """Tiny LangChain LLM adapter that calls our Gemini raw function."""
-            def _call(self, prompt_text: str, stop: list | None = None) -> str:
-                # Delegate to the real Gemini call; re-raise so the chain will handle errors.
-                return _call_gemini_llm_raw(prompt_text)
+    primary = asyncio.ensure_future(_acall_model(model_name, prompt, system_instruction, node))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    backup_model = None if done else _claim_backup(backups, tokens)
+    if backup_model is None:
+        return await primary
 
-            def _identifying_params(self):
-                return {"name": "gemini-adapter"}
+    print(f"[INFO] {model_name} slower than its p95 ({delay:.1f}s), hedging with {backup_model}")
+    backup = asyncio.ensure_future(_acall_model(backup_model, prompt, system_instruction, node))
+    pending = {primary, backup}
+    while True:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        winner = next((task for task in done if task.exception() is None), None)
+        if winner is not None:
+            for task in pending:
+                _detach(task)
+            MODEL_POOL.record_hedge(won=winner is backup)
+            return winner.result()
+        if not pending:
+            MODEL_POOL.record_hedge(won=False)
+            return primary.result()
 
-            @property
-            def _llm_type(self):
-                return "gemini-adapter"
+def _dispatch_models() -> list:
+    """Healthy models in fallback order, starting with the resolved one"""
+    models = MODEL_POOL.healthy_models(MODEL_RESOLVER.current())
+    if not models:
+        raise RuntimeError("No healthy Gemini model available (all circuit breakers are open)")
+    return models
+
+@_timed_generation(LLM_CALL_SECONDS, "llm_call")
+def _call_gemini_llm_raw(prompt: str, system_instruction: str | None = None, node: str | None = None) -> str:
+    """
+    Low-level call that actually invokes the Gemini SDK (new or legacy),
+    returning a plain string. This isolates the direct SDK usage so a
+    LangChain wrapper can call it safely. `system_instruction` is the
+    stable per-profile/node prefix; `prompt` is the per-turn suffix.
+    A model that errors is skipped in favour of the next healthy one.
+    """
+    models = _dispatch_models()
+    tokens = estimate_tokens(prompt + (system_instruction or ""))
+    RATE_LIMITER.acquire(tokens, _call_priority(node))
 
+    acquired, error = True, None
+    for index, model_name in enumerate(models):
+        if not MODEL_POOL.breaker(model_name).allow():
+            continue
+        if not acquired:
+            RATE_LIMITER.acquire(tokens, PRIORITY_ACTIVE)
+        acquired = False
         try:
-            prompt_template = PromptTemplate(input_variables=["prompt"], template="{prompt}")
-            chain = LLMChain(llm=_GeminiAdapterLLM(), prompt=prompt_template)
-            # run the chain (this will call our adapter, which calls Gemini)
-            return chain.run(prompt=prompt)
-        except Exception as chain_exc:
-            # LangChain present but something in the chain failed - fall back
-            print("[WARNING] LangChain chain.run failed, falling back to raw calls:", str(chain_exc)[:200])
+            return _call_hedged(model_name, models[index + 1:], prompt, system_instruction, node, tokens)
+        except Exception as e:
+            err = f"(Gemini call failed on {model_name}: {str(e)[:200]})"
+            print("Error in _call_gemini_llm_raw:", err)
+            # Let caller handle rate-limit retries
+            if _is_rate_limit_error(str(e)):
+                raise
+            error = e
+    raise error or RuntimeError("No healthy Gemini model available (all circuit breakers are open)")
 
-    except Exception:
-        # LangChain not installed or import failed — we'll silently fall back
-        pass
+@_timed_generation(LLM_CALL_SECONDS, "llm_call")
+def _call_gemini_llm_stream(prompt: str, system_instruction: str | None = None, node: str | None = None):
+    """
+    Streaming counterpart of _call_gemini_llm_raw. Yields text chunks as
+    the model produces them. Streams are not hedged, and only fall back to
+    the next model while nothing has been yielded yet.
+    """
+    models = _dispatch_models()
+    tokens = estimate_tokens(prompt + (system_instruction or ""))
+    RATE_LIMITER.acquire(tokens, _call_priority(node))
+
+    acquired, error = True, None
+    for model_name in models:
+        breaker = MODEL_POOL.breaker(model_name)
+        if not breaker.allow():
+            continue
+        if not acquired:
+            RATE_LIMITER.acquire(tokens, PRIORITY_ACTIVE)
+        acquired = False
+        gemini = _genai_client()
+        started = time.perf_counter()
+        yielded = False
+        try:
+            if gemini is not None:
+                stream = gemini.models.generate_content_stream(
+                    model=model_name, contents=prompt, config=_sdk_config(gemini, model_name, system_instruction)
+                )
+            else:
+                if genai is None:
+                    raise RuntimeError("No genai SDK available.")
+                model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+                stream = model.generate_content(prompt, stream=True)
+
+            usage = None
+            for chunk in stream:
+                # Token counts arrive with the final chunk
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                text = getattr(chunk, "text", None)
+                if text:
+                    yielded = True
+                    yield text
+        except GeneratorExit:
+            # Client went away mid-stream
+            breaker.record_neutral()
+            raise
+        except Exception as e:
+            _record_failure(model_name, started, e, node)
+            if yielded or _is_rate_limit_error(str(e)):
+                raise
+            print(f"[WARNING] Stream from {model_name} failed, trying next model: {str(e)[:200]}")
+            error = e
+            continue
+        _record_success(model_name, node, started, usage)
+        return
+    raise error or RuntimeError("No healthy Gemini model available (all circuit breakers are open)")
+
+@_timed_generation(LLM_CALL_SECONDS, "llm_call")
+async def _call_gemini_llm_raw_async(prompt: str, system_instruction: str | None = None, node: str | None = None) -> str:
+    """
+    asyncio counterpart of _call_gemini_llm_raw. Uses the SDK's native async
+    client so the event loop is free while Gemini is generating.
+    """
+    models = _dispatch_models()
+    tokens = estimate_tokens(prompt + (system_instruction or ""))
+    await RATE_LIMITER.aacquire(tokens, _call_priority(node))
+
+    acquired, error = True, None
+    for index, model_name in enumerate(models):
+        if not MODEL_POOL.breaker(model_name).allow():
+            continue
+        if not acquired:
+            await RATE_LIMITER.aacquire(tokens, PRIORITY_ACTIVE)
+        acquired = False
+        try:
+            return await _acall_hedged(model_name, models[index + 1:], prompt, system_instruction, node, tokens)
+        except Exception as e:
+            err = f"(Gemini call failed on {model_name}: {str(e)[:200]})"
+            print("Error in _call_gemini_llm_raw_async:", err)
+            if _is_rate_limit_error(str(e)):
+                raise
+            error = e
+    raise error or RuntimeError("No healthy Gemini model available (all circuit breakers are open)")
+
+@_timed_generation(LLM_CALL_SECONDS, "llm_call")
+async def _call_gemini_llm_stream_async(prompt: str, system_instruction: str | None = None, node: str | None = None):
+    """asyncio counterpart of _call_gemini_llm_stream"""
+    models = _dispatch_models()
+    tokens = estimate_tokens(prompt + (system_instruction or ""))
+    await RATE_LIMITER.aacquire(tokens, _call_priority(node))
+
+    acquired, error = True, None
+    for model_name in models:
+        breaker = MODEL_POOL.breaker(model_name)
+        if not breaker.allow():
+            continue
+        if not acquired:
+            await RATE_LIMITER.aacquire(tokens, PRIORITY_ACTIVE)
+        acquired = False
+        gemini = _genai_client()
+        started = time.perf_counter()
+        yielded = False
+        try:
+            if gemini is not None:
+                config = await PREFIX_CACHE.aconfig_for(gemini, model_name, system_instruction) if system_instruction else None
+                stream = await gemini.aio.models.generate_content_stream(model=model_name, contents=prompt, config=config)
+            else:
+                if genai is None:
+                    raise RuntimeError("No genai SDK available.")
+                model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+                stream = await model.generate_content_async(prompt, stream=True)
+
+            usage = None
+            async for chunk in stream:
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                text = getattr(chunk, "text", None)
+                if text:
+                    yielded = True
+                    yield text
+        except (GeneratorExit, asyncio.CancelledError):
+            breaker.record_neutral()
+            raise
+        except Exception as e:
+            _record_failure(model_name, started, e, node)
+            if yielded or _is_rate_limit_error(str(e)):
+                raise
+            print(f"[WARNING] Stream from {model_name} failed, trying next model: {str(e)[:200]}")
+            error = e
+            continue
+        _record_success(model_name, node, started, usage)
+        return
+    raise error or RuntimeError("No healthy Gemini model available (all circuit breakers are open)")
+
+# ============================================================================
+# Generation Backends
+# ============================================================================
+
+class DirectGeminiBackend:
+    """Generation backend that calls the Gemini SDK directly"""
+    name = "direct"
+
+    def generate(self, prompt: str, system_instruction: str | None = None, node: str | None = None) -> str:
+        return _call_gemini_llm_raw(prompt, system_instruction, node)
+
+    async def agenerate(self, prompt: str, system_instruction: str | None = None, node: str | None = None) -> str:
+        return await _call_gemini_llm_raw_async(prompt, system_instruction, node)
+
+def _gemini_adapter_llm():
+    """
+    Tiny LangChain LLM adapter that calls our Gemini raw function. Defined
+    on demand so LangChain is only imported with the langchain backend.
+    """
+    from langchain_core.language_models.llms import LLM
+
+    class _GeminiAdapterLLM(LLM):
+        def _call(self, prompt: str, stop: list | None = None, run_manager=None, node: str | None = None, **kwargs) -> str:
+            # Delegate to the real Gemini call; re-raise so the caller handles retries.
+            return _call_gemini_llm_raw(prompt, node=node)
+
+        async def _acall(self, prompt: str, stop: list | None = None, run_manager=None, node: str | None = None, **kwargs) -> str:
+            return await _call_gemini_llm_raw_async(prompt, node=node)
+
+        @property
+        def _identifying_params(self):
+            return {"name": "gemini-adapter"}
+
+        @property
+        def _llm_type(self):
+            return "gemini-adapter"
+
+    return _GeminiAdapterLLM()
+
+class LangChainBackend:
+    """
+    Generation backend that runs a PromptTemplate | adapter chain, built once.
+    The chain carries a single text prompt, so the static prefix is inlined
+    and does not benefit from context caching.
+    """
+    name = "langchain"
+
+    def __init__(self):
+        from langchain_core.prompts import PromptTemplate
+
+        self.template = PromptTemplate.from_template("{system_instruction}{prompt}")
+        self.llm = _gemini_adapter_llm()
+        self.chain = self.template | self.llm
+        # One chain per node with the node bound, so priority and per-node metrics apply
+        self._chains = {}
+
+    def _chain(self, node: str | None):
+        if node is None:
+            return self.chain
+        chain = self._chains.get(node)
+        if chain is None:
+            chain = self._chains[node] = self.template | self.llm.bind(node=node)
+        return chain
+
+    def _inputs(self, prompt: str, system_instruction: str | None) -> dict:
+        return {"system_instruction": f"{system_instruction}\n\n" if system_instruction else "", "prompt": prompt}
+
+    def generate(self, prompt: str, system_instruction: str | None = None, node: str | None = None) -> str:
+        return self._chain(node).invoke(self._inputs(prompt, system_instruction))
+
+    async def agenerate(self, prompt: str, system_instruction: str | None = None, node: str | None = None) -> str:
+        return await self._chain(node).ainvoke(self._inputs(prompt, system_instruction))
+
+GENERATION_BACKENDS = {
+    "direct": DirectGeminiBackend,
+    "langchain": LangChainBackend,
+}
+
+def create_generation_backend(name: str | None = None):
+    """Select the generation backend (GENERATION_BACKEND env, default: direct)"""
+    name = (name or os.environ.get("GENERATION_BACKEND", "direct")).lower()
+    if name not in GENERATION_BACKENDS:
+        print(f"[WARNING] Unknown GENERATION_BACKEND {name!r}, using direct")
+        name = "direct"
+    backend = GENERATION_BACKENDS[name]()
+    print(f"[INFO] Using {backend.name} generation backend")
+    return backend
+
+# Selected once at startup and reused for every generation
+GENERATION_BACKEND = create_generation_backend()
+
+def _create_response_cache():
+    """Opt-in reply cache for repeated prompts (RESPONSE_CACHE_ENABLED=true)"""
+    if os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() != "true":
+        return None
+    print("[INFO] Response cache enabled")
+    return ResponseCache(
+        max_entries=int(os.environ.get("RESPONSE_CACHE_SIZE", 1024)),
+        ttl=int(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+        variants=int(os.environ.get("RESPONSE_CACHE_VARIANTS", 3)),
+        redis_url=os.environ.get("RESPONSE_CACHE_REDIS_URL"),
+    )
+
+RESPONSE_CACHE = _create_response_cache()
+
+def get_response_cache_stats() -> dict:
+    """Hit rate and latency saved by the response cache"""
+    if RESPONSE_CACHE is None:
+        return {"enabled": False}
+    return dict(RESPONSE_CACHE.stats(), enabled=True)
+
+@_timed_generation(GENERATE_SECONDS, "generate_response")
+def generate_response(prompt: str, system_instruction: str | None = None, node: str | None = None) -> str:
+    """
+    Main generation entrypoint used by nodes.
+    Sends the prompt through the startup-selected GENERATION_BACKEND with
+    rate-limit retry logic. Identical prompts may be answered from
+    RESPONSE_CACHE when it is enabled.
+    """
+    key = None
+    if RESPONSE_CACHE is not None:
+        key = cache_key(MODEL_RESOLVER.current(), prompt, system_instruction)
+        cached = RESPONSE_CACHE.get(key)
+        if cached is not None:
+            return cached
 
-    # Fallback: do the original retry logic and raw SDK calls.
     max_retries = 3
-    retry_delay = 2
 
     for attempt in range(max_retries):
         try:
-            return _call_gemini_llm_raw(prompt)
+            started = time.perf_counter()
+            response = GENERATION_BACKEND.generate(prompt, system_instruction, node)
         except Exception as e:
             error_msg = str(e)
             # Basic rate-limit/backoff handling (same idea as before)
-            if ("429" in error_msg or "RESOURCE_EXHAUSTED" in error_msg or "quota" in error_msg.lower()):
+            if isinstance(e, RateLimitExceeded):
+                print(f"[WARNING] Shedding request: {error_msg}")
+                FAILED_REPLIES.inc(node=node or "unknown", reason="shed")
+                return "I'm experiencing high demand right now. Please try again shortly."
+            if _is_rate_limit_error(error_msg):
                 if attempt < max_retries - 1:
-                    wait_time = retry_delay * (2 ** attempt)
-                    print(f"[WARNING] Rate limit hit. Waiting {wait_time}s before retry {attempt+1}/{max_retries}")
-                    time.sleep(wait_time)
+                    # The shared limiter has already backed off; the retry waits in its queue
+                    print(f"[WARNING] Rate limit hit. Retry {attempt+1}/{max_retries} via the rate limiter")
+                    RETRIES.inc(node=node or "unknown")
                     continue
                 else:
+                    FAILED_REPLIES.inc(node=node or "unknown", reason="rate_limited")
                     return "I'm experiencing high demand right now. Please try again shortly."
             # Non-rate errors: log and return a friendly message
             print(f"Error generating response (final attempt): {error_msg[:200]}")
+            FAILED_REPLIES.inc(node=node or "unknown", reason="error")
             return f"I'm having trouble responding right now. (Error: {error_msg[:200]})"
+        # Outside the try: the reply stands whatever the cache does with it
+        if key is not None:
+            RESPONSE_CACHE.put(key, response, time.perf_counter() - started)
+        return response
 
     return "I'm experiencing technical difficulties. Please try again later."
 
-def format_history(history: list) -> str:
-    """Format conversation history for prompt"""
+@_timed_generation(GENERATE_SECONDS, "generate_response")
+def generate_response_stream(prompt: str, system_instruction: str | None = None, node: str | None = None):
+    """
+    Streaming generation entrypoint. Yields text chunks; rate-limit retries
+    only happen before the first chunk has been sent to the client.
+    """
+    max_retries = 3
+
+    for attempt in range(max_retries):
+        started = False
+        try:
+            for text in _call_gemini_llm_stream(prompt, system_instruction, node):
+                started = True
+                yield text
+            return
+        except Exception as e:
+            error_msg = str(e)
+            if started:
+                # Part of the reply is already on the wire; stop here
+                print(f"[WARNING] Stream interrupted: {error_msg[:200]}")
+                return
+            if isinstance(e, RateLimitExceeded):
+                print(f"[WARNING] Shedding request: {error_msg}")
+                FAILED_REPLIES.inc(node=node or "unknown", reason="shed")
+                yield "I'm experiencing high demand right now. Please try again shortly."
+                return
+            if _is_rate_limit_error(error_msg):
+                if attempt < max_retries - 1:
+                    # The shared limiter has already backed off; the retry waits in its queue
+                    print(f"[WARNING] Rate limit hit. Retry {attempt+1}/{max_retries} via the rate limiter")
+                    RETRIES.inc(node=node or "unknown")
+                    continue
+                FAILED_REPLIES.inc(node=node or "unknown", reason="rate_limited")
+                yield "I'm experiencing high demand right now. Please try again shortly."
+                return
+            print(f"Error generating streamed response: {error_msg[:200]}")
+            FAILED_REPLIES.inc(node=node or "unknown", reason="error")
+            yield f"I'm having trouble responding right now. (Error: {error_msg[:200]})"
+            return
+
+@_timed_generation(GENERATE_SECONDS, "generate_response")
+async def generate_response_async(prompt: str, system_instruction: str | None = None, node: str | None = None) -> str:
+    """
+    asyncio counterpart of generate_response. Rate-limit backoff awaits
+    instead of sleeping, so other conversations keep being served.
+    """
+    key = None
+    if RESPONSE_CACHE is not None:
+        key = cache_key(MODEL_RESOLVER.current(), prompt, system_instruction)
+        cached = await RESPONSE_CACHE.aget(key)
+        if cached is not None:
+            return cached
+
+    max_retries = 3
+
+    for attempt in range(max_retries):
+        try:
+            started = time.perf_counter()
+            response = await GENERATION_BACKEND.agenerate(prompt, system_instruction, node)
+        except Exception as e:
+            error_msg = str(e)
+            if isinstance(e, RateLimitExceeded):
+                print(f"[WARNING] Shedding request: {error_msg}")
+                FAILED_REPLIES.inc(node=node or "unknown", reason="shed")
+                return "I'm experiencing high demand right now. Please try again shortly."
+            if _is_rate_limit_error(error_msg):
+                if attempt < max_retries - 1:
+                    # The shared limiter has already backed off; the retry waits in its queue
+                    print(f"[WARNING] Rate limit hit. Retry {attempt+1}/{max_retries} via the rate limiter")
+                    RETRIES.inc(node=node or "unknown")
+                    continue
+                else:
+                    FAILED_REPLIES.inc(node=node or "unknown", reason="rate_limited")
+                    return "I'm experiencing high demand right now. Please try again shortly."
+            print(f"Error generating response (final attempt): {error_msg[:200]}")
+            FAILED_REPLIES.inc(node=node or "unknown", reason="error")
+            return f"I'm having trouble responding right now. (Error: {error_msg[:200]})"
+        # Outside the try: the reply stands whatever the cache does with it
+        if key is not None:
+            await RESPONSE_CACHE.aput(key, response, time.perf_counter() - started)
+        return response
+
+    return "I'm experiencing technical difficulties. Please try again later."
+
+@_timed_generation(GENERATE_SECONDS, "generate_response")
+async def generate_response_stream_async(prompt: str, system_instruction: str | None = None, node: str | None = None):
+    """asyncio counterpart of generate_response_stream"""
+    max_retries = 3
+
+    for attempt in range(max_retries):
+        started = False
+        try:
+            async for text in _call_gemini_llm_stream_async(prompt, system_instruction, node):
+                started = True
+                yield text
+            return
+        except Exception as e:
+            error_msg = str(e)
+            if started:
+                print(f"[WARNING] Stream interrupted: {error_msg[:200]}")
+                return
+            if isinstance(e, RateLimitExceeded):
+                print(f"[WARNING] Shedding request: {error_msg}")
+                FAILED_REPLIES.inc(node=node or "unknown", reason="shed")
+                yield "I'm experiencing high demand right now. Please try again shortly."
+                return
+            if _is_rate_limit_error(error_msg):
+                if attempt < max_retries - 1:
+                    # The shared limiter has already backed off; the retry waits in its queue
+                    print(f"[WARNING] Rate limit hit. Retry {attempt+1}/{max_retries} via the rate limiter")
+                    RETRIES.inc(node=node or "unknown")
+                    continue
+                FAILED_REPLIES.inc(node=node or "unknown", reason="rate_limited")
+                yield "I'm experiencing high demand right now. Please try again shortly."
+                return
+            print(f"Error generating streamed response: {error_msg[:200]}")
+            FAILED_REPLIES.inc(node=node or "unknown", reason="error")
+            yield f"I'm having trouble responding right now. (Error: {error_msg[:200]})"
+            return
+
+# Prompt history is kept within a token budget; older turns are folded
+# into a running summary instead of being dropped
+CONTEXT_WINDOW = create_context_window()
+
+def format_history(history: list, context: dict | None = None) -> str:
+    """
+    Format conversation history for prompt. Pass the session's
+    conversation_context to reuse its rendered lines and summary across
+    turns; without it the history is rendered from scratch.
+    """
     if not history:
         return "No previous conversation."
-    
-    formatted = []
-    for msg in history[-10:]:  # Last 10 messages
-        role = msg.get("role", "unknown")
-        content = msg.get("content", "")
-        if role == "user":
-            formatted.append(f"Doctor: {content}")
-        elif role == "patient":
-            formatted.append(f"Patient: {content}")
-    
-    return "\n".join(formatted) if formatted else "No previous conversation."
+    return CONTEXT_WINDOW.render(context if context is not None else new_context(), history)
 
 # ============================================================================
 # LangGraph State Machine Construction
@@ -378,140 +1122,395 @@ def format_history(history: list) -> str:
 
 def create_patient_graph():
     """Create and compile LangGraph state machine"""
+    # Imported here: LangGraph and LangChain are only needed once the first
+    # turn is played, not to answer /api/health or create a session
+    from langchain_core.runnables import RunnableLambda
+    from langgraph.graph import StateGraph, END
     
     # Create StateGraph
     workflow = StateGraph(PatientState)
     
-    # Add nodes
-    workflow.add_node("initial_greeting", initial_greeting_node)
-    workflow.add_node("questioning", questioning_node)
-    workflow.add_node("progressive_revelation", progressive_revelation_node)
-    workflow.add_node("treatment", treatment_node)
-    
-    # Set entry point
-    workflow.set_entry_point("initial_greeting")
-    
-    # Add conditional edges - route based on next_state from node output
-    workflow.add_conditional_edges(
-        "initial_greeting",
-        lambda state: state.get("current_state", "questioning"),
-        {
-            "questioning": "questioning",
-            "progressive": "progressive_revelation",
-            "treatment": "treatment"
-        }
-    )
-    
-    workflow.add_conditional_edges(
-        "questioning",
-        lambda state: state.get("current_state", "questioning"),
-        {
-            "questioning": "questioning",
-            "progressive": "progressive_revelation",
-            "treatment": "treatment"
-        }
-    )
+    # Add nodes - each carries its sync and asyncio implementation so the
+    # same compiled graph serves both invoke() and ainvoke()
+    workflow.add_node("initial_greeting", RunnableLambda(initial_greeting_node, afunc=ainitial_greeting_node))
+    workflow.add_node("questioning", RunnableLambda(questioning_node, afunc=aquestioning_node))
+    workflow.add_node("progressive_revelation", RunnableLambda(progressive_revelation_node, afunc=aprogressive_revelation_node))
+    workflow.add_node("treatment", RunnableLambda(treatment_node, afunc=atreatment_node))
     
-    workflow.add_conditional_edges(
-        "progressive_revelation",
-        lambda state: state.get("current_state", "questioning"),
+    # Each invocation is one conversation turn: route on the incoming
+    # message and session state, run exactly one node, then stop
+    workflow.set_conditional_entry_point(
+        _select_node,
         {
+            "initial_greeting": "initial_greeting",
             "questioning": "questioning",
-            "progressive": "progressive_revelation",
+            "progressive_revelation": "progressive_revelation",
             "treatment": "treatment"
         }
     )
     
-    # Treatment node routes back to questioning (can continue conversation after treatment)
-    workflow.add_edge("treatment", "questioning")
+    workflow.add_edge("initial_greeting", END)
+    workflow.add_edge("questioning", END)
+    workflow.add_edge("progressive_revelation", END)
+    workflow.add_edge("treatment", END)
     
     # Compile graph
     app = workflow.compile()
     return app
 
+_PATIENT_GRAPH = None
+_PATIENT_GRAPH_LOCK = threading.Lock()
+
+def get_patient_graph():
+    """Return the process-wide compiled graph, compiling it on first use"""
+    global _PATIENT_GRAPH
+    if _PATIENT_GRAPH is None:
+        with _PATIENT_GRAPH_LOCK:
+            if _PATIENT_GRAPH is None:
+                _PATIENT_GRAPH = create_patient_graph()
+    return _PATIENT_GRAPH
+
 # ============================================================================
 # Session Management with LangGraph
 # ============================================================================
 
-SESSIONS = {}  # session_id -> {"graph": graph, "profile": profile, "state": state}
+# Sessions hold only their small mutable state; the compiled graph is shared.
+# REDIS_URL selects a store shared by all workers (see session_store.py).
+SESSION_STORE = create_session_store()
 
-def get_or_create_agent_for_session(session_id: str):
-    """Create or retrieve LangGraph agent for session"""
-    if session_id not in SESSIONS:
-        # Create patient profile
-        profile = {
-            "patient_name": "Alex",
-            "age": 35,
-            "med_history": "no known chronic diseases",
-        }
-        
-        # Create LangGraph instance
-        graph = create_patient_graph()
-        
-        SESSIONS[session_id] = {
-            "graph": graph,
-            "profile": profile,
-            "conversation_history": [],
-            "current_state": "initial",
-            "symptom_level": 0,
-            "treatment_detected": False,
-            "treatment_accepted": False
-        }
-        print(f"[INFO] Created LangGraph agent for session: {session_id}")
+# Patient cases; SCENARIO_DIR adds scenarios to the built-in default (see scenarios.py)
+SCENARIOS = create_scenario_registry()
+
+def _generate_opening(instruction: str) -> str:
+    """One speculative reply to CANONICAL_GREETING; raises on failure, so errors are never pooled"""
+    return GENERATION_BACKEND.generate(f"Doctor: {CANONICAL_GREETING}\nPatient:", instruction, "opening_pool")
+
+def _create_opening_pool():
+    if os.environ.get("OPENING_POOL_ENABLED", "true").lower() == "false":
+        return None
+    return OpeningPool(
+        _generate_opening,
+        size=int(os.environ.get("OPENING_POOL_SIZE", 2)),
+        max_size=int(os.environ.get("OPENING_POOL_MAX_SIZE", 8)),
+        max_profiles=int(os.environ.get("OPENING_POOL_MAX_PROFILES", 256)),
+        workers=int(os.environ.get("OPENING_POOL_WORKERS", 2)),
+    )
+
+# Pre-generated answers to a generic first message (see opening_pool.py)
+OPENING_POOL = _create_opening_pool()
+
+def _prefetch_opening(profile: dict):
+    """Start filling the opening pool for a profile, typically when its session is created"""
+    if OPENING_POOL is not None:
+        OPENING_POOL.prefetch(SCENARIOS.for_profile(profile).instruction("initial_greeting", 0, profile))
+
+def _pooled_opening(state: PatientState) -> str | None:
+    """A pre-generated reply if this is a generic first message and one is ready"""
+    if OPENING_POOL is None or state["current_state"] != "initial" or not is_generic_greeting(state["user_message"]):
+        return None
+    return OPENING_POOL.take(_instruction(state, "initial_greeting", 0))
+
+def get_opening_pool_stats() -> dict:
+    if OPENING_POOL is None:
+        return {"enabled": False}
+    return dict(OPENING_POOL.stats(), enabled=True)
+
+def _new_session(scenario: str | None = None) -> dict:
+    # Patient profile of the chosen scenario (UnknownScenario if unknown)
+    profile = SCENARIOS.pick(scenario).new_profile()
     
-    return SESSIONS[session_id]
+    return {
+        "profile": profile,
+        "conversation_history": [],
+        "current_state": "initial",
+        "symptom_level": 0,
+        "treatment_detected": False,
+        "treatment_accepted": False,
+        "conversation_context": new_context()
+    }
 
-def handle_user_message(agent_obj: dict, session_id: str, user_message: str) -> str:
-    """Handle user message using LangGraph state machine"""
-    graph = agent_obj["graph"]
-    profile = agent_obj["profile"]
-    conversation_history = agent_obj.get("conversation_history", [])
-    current_state = agent_obj.get("current_state", "initial")
-    symptom_level = agent_obj.get("symptom_level", 0)
-    treatment_detected = agent_obj.get("treatment_detected", False)
-    treatment_accepted = agent_obj.get("treatment_accepted", False)
+def get_or_create_agent_for_session(session_id: str, scenario: str | None = None):
+    """
+    Create or retrieve LangGraph agent for session. A new session gets the
+    given scenario ("random", or DEFAULT_SCENARIO when None); raises
+    UnknownScenario (a KeyError) for an unknown scenario id.
+    """
+    agent_obj = SESSION_STORE.load(session_id)
+    if agent_obj is None:
+        agent_obj = create_agent_for_session(session_id, scenario)
+    
+    return agent_obj
+
+async def aget_or_create_agent_for_session(session_id: str, scenario: str | None = None):
+    """asyncio counterpart of get_or_create_agent_for_session"""
+    agent_obj = await SESSION_STORE.aload(session_id)
+    if agent_obj is None:
+        agent_obj = await acreate_agent_for_session(session_id, scenario)
     
-    # Create state for LangGraph
-    state: PatientState = {
+    return agent_obj
+
+def create_agent_for_session(session_id: str, scenario: str | None = None, overrides: dict | None = None):
+    """
+    Create a session under an id known to be new (e.g. a fresh uuid),
+    without looking it up first; a lookup miss may have to consult the
+    session journal. `overrides` replace fields of the scenario's patient
+    profile before the session is stored.
+    """
+    agent_obj = _new_session(scenario)
+    agent_obj["profile"].update(overrides or {})
+    SESSION_STORE.create(session_id, agent_obj)
+    _prefetch_opening(agent_obj["profile"])
+    print(f"[INFO] Created session: {session_id}")
+    return agent_obj
+
+async def acreate_agent_for_session(session_id: str, scenario: str | None = None):
+    """asyncio counterpart of create_agent_for_session"""
+    agent_obj = _new_session(scenario)
+    await SESSION_STORE.acreate(session_id, agent_obj)
+    _prefetch_opening(agent_obj["profile"])
+    print(f"[INFO] Created session: {session_id}")
+    return agent_obj
+
+# Wakes /api/logs long-poll and tail readers when a turn is saved
+TRANSCRIPT_EVENTS = transcript.TranscriptEvents()
+# Long-poll readers re-check the store this often for turns saved by other workers
+TRANSCRIPT_POLL_INTERVAL = float(os.environ.get("TRANSCRIPT_POLL_INTERVAL", 1.0))
+
+# Turns of one session run one at a time, in arrival order; beyond
+# SESSION_TURN_MAX_QUEUE waiting messages a session's new ones are refused
+SESSION_TURNS = SessionTurnQueue(max_depth=int(os.environ.get("SESSION_TURN_MAX_QUEUE", 16)))
+
+def session_turn(session_id: str):
+    """
+    Context manager held around load, handle and save of one turn; raises
+    TurnQueueFull if too many turns of the session are already waiting
+    """
+    return SESSION_TURNS.turn(session_id)
+
+def asession_turn(session_id: str):
+    """asyncio counterpart of session_turn (async with)"""
+    return SESSION_TURNS.aturn(session_id)
+
+def save_session_turn(session_id: str, agent_obj: dict):
+    """Persist session state after a turn; its transcript is the conversation history (one write)"""
+    SESSION_STORE.save_turn(session_id, agent_obj)
+    TRANSCRIPT_EVENTS.notify(session_id, transcript.last_id(agent_obj["conversation_history"]))
+
+async def asave_session_turn(session_id: str, agent_obj: dict):
+    await SESSION_STORE.asave_turn(session_id, agent_obj)
+    TRANSCRIPT_EVENTS.notify(session_id, transcript.last_id(agent_obj["conversation_history"]))
+
+def get_session_logs(session_id: str, since: int = 0, limit: int | None = None) -> tuple[list, int]:
+    """
+    Transcript entries with an id greater than since (at most limit of
+    them), and the id of the newest message in the transcript
+    """
+    agent_obj = SESSION_STORE.load(session_id)
+    if agent_obj is None:
+        return [], 0
+    history = agent_obj["conversation_history"]
+    return transcript.log_entries(history, since, limit), transcript.last_id(history)
+
+def wait_for_session_logs(session_id: str, since: int = 0, limit: int | None = None,
+                          timeout: float = 0) -> tuple[list, int]:
+    """get_session_logs, waiting up to timeout seconds for a message after since"""
+    deadline = time.monotonic() + timeout
+    while True:
+        entries, newest = get_session_logs(session_id, since, limit)
+        remaining = deadline - time.monotonic()
+        if entries or remaining <= 0:
+            return entries, newest
+        TRANSCRIPT_EVENTS.wait(session_id, since, min(remaining, TRANSCRIPT_POLL_INTERVAL))
+
+async def aget_session_logs(session_id: str, since: int = 0, limit: int | None = None) -> tuple[list, int]:
+    """asyncio counterpart of get_session_logs"""
+    agent_obj = await SESSION_STORE.aload(session_id)
+    if agent_obj is None:
+        return [], 0
+    history = agent_obj["conversation_history"]
+    return transcript.log_entries(history, since, limit), transcript.last_id(history)
+
+async def await_session_logs(session_id: str, since: int = 0, limit: int | None = None,
+                             timeout: float = 0) -> tuple[list, int]:
+    """asyncio counterpart of wait_for_session_logs"""
+    deadline = time.monotonic() + timeout
+    while True:
+        entries, newest = await aget_session_logs(session_id, since, limit)
+        remaining = deadline - time.monotonic()
+        if entries or remaining <= 0:
+            return entries, newest
+        await TRANSCRIPT_EVENTS.await_message(session_id, since, min(remaining, TRANSCRIPT_POLL_INTERVAL))
+
+def get_scenarios() -> list:
+    """Scenarios a session can be created with (id, name and age only)"""
+    return SCENARIOS.summaries()
+
+def get_scenario_stats() -> dict:
+    return SCENARIOS.stats()
+
+def get_session_store_stats() -> dict:
+    """Session counts, eviction counters and turn queues for the health endpoint"""
+    return dict(SESSION_STORE.stats(), turns=SESSION_TURNS.stats())
+
+def _build_state(agent_obj: dict, session_id: str, user_message: str) -> PatientState:
+    """Build the LangGraph state for one turn from the stored session"""
+    return {
         "session_id": session_id,
         "user_message": user_message,
         "patient_response": "",
-        "conversation_history": conversation_history,
-        "current_state": current_state,
-        "symptom_level": symptom_level,
-        "treatment_detected": treatment_detected,
-        "treatment_accepted": treatment_accepted,
-        "patient_profile": profile
+        "conversation_history": agent_obj.get("conversation_history", []),
+        "current_state": agent_obj.get("current_state", "initial"),
+        "symptom_level": agent_obj.get("symptom_level", 0),
+        "treatment_detected": agent_obj.get("treatment_detected", False),
+        "treatment_accepted": agent_obj.get("treatment_accepted", False),
+        "patient_profile": agent_obj["profile"],
+        "conversation_context": agent_obj.setdefault("conversation_context", new_context()),
+        "intent": route_message(user_message, agent_obj["profile"].get("scenario")),
     }
+
+def _select_node(state: PatientState) -> str:
+    """Pick the node that should answer this turn"""
+    # For first message, use initial_greeting node (failed turns leave the state at initial)
+    if state["current_state"] == "initial":
+        return "initial_greeting"
+    # Route to appropriate node based on the turn's intent and current state
+    intent = state["intent"]
+    if intent.treatment:
+        return "treatment"
+    if intent.detail and state["symptom_level"] < 2:
+        return "progressive_revelation"
+    return "questioning"
+
+def _commit_turn(agent_obj: dict, state: PatientState, result: PatientState) -> str:
+    """Write a node result back into the session and return the reply"""
+    agent_obj["conversation_history"] = transcript.commit(result["conversation_history"])
+    agent_obj["current_state"] = result.get("current_state", state["current_state"])
+    STATE_TRANSITIONS.inc(from_state=state["current_state"], to_state=agent_obj["current_state"])
+    agent_obj["symptom_level"] = result.get("symptom_level", state["symptom_level"])
+    agent_obj["treatment_detected"] = result.get("treatment_detected", state["treatment_detected"])
+    agent_obj["treatment_accepted"] = result.get("treatment_accepted", state["treatment_accepted"])
+    return result["patient_response"]
+
+def _commit_failed_turn(agent_obj: dict, state: PatientState, reply: str) -> str:
+    """
+    Record a turn that ended in an error message. It stays in the transcript
+    but is left out of later prompts, and the conversation state is unchanged.
+    """
+    agent_obj["conversation_history"] = transcript.commit(state["conversation_history"] + [
+        {"role": "user", "content": state["user_message"], "failed": True},
+        {"role": "patient", "content": reply, "failed": True},
+    ])
+    return reply
+
+def handle_user_message(agent_obj: dict, session_id: str, user_message: str) -> str:
+    """Handle user message using LangGraph state machine"""
+    state = _build_state(agent_obj, session_id, user_message)
+
+    pooled = _pooled_opening(state)
+    if pooled is not None:
+        return _commit_turn(agent_obj, state, _initial_greeting_result(state, pooled))
     
-    # Invoke LangGraph - but limit to single step to avoid recursion
-    # We'll call the appropriate node directly based on current state
+    # One graph invocation runs the routed node for this turn
     try:
-        # For first message, use initial_greeting node
-        if not conversation_history:
-            result = initial_greeting_node(state)
-        else:
-            # Route to appropriate node based on message content and current state
-            if any(word in user_message.lower() for word in ["prescribe", "medication", "treatment", "medicine", "drug"]):
-                result = treatment_node(state)
-            elif any(word in user_message.lower() for word in ["more", "detail", "tell me", "describe"]) and symptom_level < 2:
-                result = progressive_revelation_node(state)
-            else:
-                result = questioning_node(state)
-        
-        response = result["patient_response"]
-        
-        # Update session state
-        agent_obj["conversation_history"] = result["conversation_history"]
-        agent_obj["current_state"] = result.get("current_state", current_state)
-        agent_obj["symptom_level"] = result.get("symptom_level", symptom_level)
-        agent_obj["treatment_detected"] = result.get("treatment_detected", treatment_detected)
-        agent_obj["treatment_accepted"] = result.get("treatment_accepted", treatment_accepted)
-        
-        return response
+        result = get_patient_graph().invoke(state)
+        return _commit_turn(agent_obj, state, result)
     except Exception as e:
         error_msg = str(e)
         print(f"Error in LangGraph execution: {error_msg}")
         import traceback
         traceback.print_exc()
-        return f"I'm having trouble responding right now. Please try again. (Error: {error_msg[:100]})"
\ No newline at end of file
+        reply = f"I'm having trouble responding right now. Please try again. (Error: {error_msg[:100]})"
+        return _commit_failed_turn(agent_obj, state, reply)
+
+def handle_user_message_stream(agent_obj: dict, session_id: str, user_message: str):
+    """
+    Streaming variant of handle_user_message. Yields partial patient text as
+    it is generated; the full reply is committed to the session's
+    conversation_history once the stream ends. Uses the graph's router and
+    the node prompt/result steps directly, since the graph itself cannot
+    surface raw SDK chunks.
+    """
+    state = _build_state(agent_obj, session_id, user_message)
+    pooled = _pooled_opening(state)
+    if pooled is not None:
+        # committed up front, as a live stream would be if the client left
+        yield _commit_turn(agent_obj, state, _initial_greeting_result(state, pooled))
+        return
+    node = _select_node(state)
+    build_prompt, build_result = NODE_STEPS[node]
+
+    chunks = []
+    failed = False
+    started = time.perf_counter()
+    try:
+        instruction, prompt = build_prompt(state)
+        for text in generate_response_stream(prompt, instruction, node):
+            chunks.append(text)
+            yield text
+    except Exception as e:
+        error_msg = str(e)
+        print(f"Error in LangGraph streaming execution: {error_msg}")
+        if not chunks:
+            failed = True
+            text = f"I'm having trouble responding right now. Please try again. (Error: {error_msg[:100]})"
+            chunks.append(text)
+            yield text
+    finally:
+        NODE_SECONDS.observe(time.perf_counter() - started, node=node)
+        if failed:
+            _commit_failed_turn(agent_obj, state, chunks[0])
+        elif chunks:
+            _commit_turn(agent_obj, state, build_result(state, "".join(chunks)))
+
+async def handle_user_message_async(agent_obj: dict, session_id: str, user_message: str) -> str:
+    """asyncio counterpart of handle_user_message"""
+    state = _build_state(agent_obj, session_id, user_message)
+
+    pooled = _pooled_opening(state)
+    if pooled is not None:
+        return _commit_turn(agent_obj, state, _initial_greeting_result(state, pooled))
+
+    try:
+        result = await get_patient_graph().ainvoke(state)
+        return _commit_turn(agent_obj, state, result)
+    except Exception as e:
+        error_msg = str(e)
+        print(f"Error in LangGraph execution: {error_msg}")
+        import traceback
+        traceback.print_exc()
+        reply = f"I'm having trouble responding right now. Please try again. (Error: {error_msg[:100]})"
+        return _commit_failed_turn(agent_obj, state, reply)
+
+async def handle_user_message_stream_async(agent_obj: dict, session_id: str, user_message: str):
+    """asyncio counterpart of handle_user_message_stream"""
+    state = _build_state(agent_obj, session_id, user_message)
+    pooled = _pooled_opening(state)
+    if pooled is not None:
+        # committed up front, as a live stream would be if the client left
+        yield _commit_turn(agent_obj, state, _initial_greeting_result(state, pooled))
+        return
+    node = _select_node(state)
+    build_prompt, build_result = NODE_STEPS[node]
+
+    chunks = []
+    failed = False
+    started = time.perf_counter()
+    try:
+        instruction, prompt = build_prompt(state)
+        async for text in generate_response_stream_async(prompt, instruction, node):
+            chunks.append(text)
+            yield text
+    except Exception as e:
+        error_msg = str(e)
+        print(f"Error in LangGraph streaming execution: {error_msg}")
+        if not chunks:
+            failed = True
+            text = f"I'm having trouble responding right now. Please try again. (Error: {error_msg[:100]})"
+            chunks.append(text)
+            yield text
+    finally:
+        NODE_SECONDS.observe(time.perf_counter() - started, node=node)
+        if failed:
+            _commit_failed_turn(agent_obj, state, chunks[0])
+        elif chunks:
+            _commit_turn(agent_obj, state, build_result(state, "".join(chunks)))
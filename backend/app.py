@@ -1,10 +1,33 @@
 # backend/app.py
 import os
+import json
+import time
 import uuid
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 # Using LangGraph implementation for state management
-from agent_logic_langgraph import get_or_create_agent_for_session, handle_user_message
+from agent_logic_langgraph import (
+    create_agent_for_session,
+    get_or_create_agent_for_session,
+    get_prompt_cache_stats,
+    get_scenario_stats,
+    get_scenarios,
+    get_model_health_stats,
+    get_opening_pool_stats,
+    get_rate_limiter_stats,
+    get_response_cache_stats,
+    get_session_logs,
+    get_session_store_stats,
+    handle_user_message,
+    handle_user_message_stream,
+    save_session_turn,
+    session_turn,
+    start_model_warmup,
+    wait_for_session_logs,
+)
+from metrics import HTTP_SECONDS, render as render_metrics
+from scenarios import UnknownScenario
+from session_turns import TurnQueueFull
 
 
 from dotenv import load_dotenv
@@ -13,65 +36,211 @@ load_dotenv()
 app = Flask(__name__)
 # Enable CORS for frontend communication
 CORS(app)
+# Resolve the Gemini model in the background so no request waits on probing
+start_model_warmup()
 
-# Simple in-memory stores (for dev). Use Redis for production.
-AGENTS = {}     # session_id -> agent object
-LOGS = {}       # session_id -> list of {"role","text","ts"}
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    # Streams are observed when their headers go out (time to first byte)
+    if "request_started" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_SECONDS.observe(
+            time.perf_counter() - g.request_started,
+            route=route, method=request.method, status=response.status_code,
+        )
+    return response
 
 @app.route("/api/session", methods=["POST"])
 def create_session():
+    """Optional body: {"scenario": "<id>" | "random"}; defaults to DEFAULT_SCENARIO"""
     try:
+        data = request.get_json(silent=True) or {}
+        scenario = data.get("scenario") if isinstance(data, dict) else None
         session_id = str(uuid.uuid4())
-        agent = get_or_create_agent_for_session(session_id)  # initializes the LangGraph/agent
-        AGENTS[session_id] = agent
-        LOGS[session_id] = []
-        return jsonify({"session_id": session_id}), 201
+        agent = create_agent_for_session(session_id, scenario)  # initializes the session state
+        return jsonify({"session_id": session_id, "scenario": agent["profile"]["scenario"]}), 201
+    except UnknownScenario as e:
+        # names the configured default when the request gave none
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"Error in /api/session: {str(e)}")
         return jsonify({"error": "Failed to create session", "message": str(e)}), 500
 
+def _parse_message_request():
+    """Validate a message body; returns (session_id, text, error_response)"""
+    if not request.json:
+        return None, None, (jsonify({"error": "Request body must be JSON"}), 400)
+    
+    data = request.json
+    session_id = data.get("session_id")
+    text = data.get("message", "")
+    
+    if not session_id:
+        return None, None, (jsonify({"error": "session_id is required"}), 400)
+    
+    if not text:
+        return None, None, (jsonify({"error": "message cannot be empty"}), 400)
+    
+    return session_id, text, None
+
+# Upper bound on ?wait= for long-polling /api/logs, and the keep-alive
+# interval of a logs tail stream
+LOGS_MAX_WAIT = float(os.environ.get("LOGS_MAX_WAIT", 30))
+# A logs tail stream ends after this many seconds; EventSource reconnects
+# with Last-Event-ID, so a client sees no gap
+LOGS_MAX_TAIL = float(os.environ.get("LOGS_MAX_TAIL", 300))
+
+def _sse(data: dict, event: str | None = None, event_id: int | None = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    if event_id is not None:
+        prefix += f"id: {event_id}\n"
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def _stream_reply(session_id: str, text: str) -> Response:
+    """Stream the patient reply as Server-Sent Events"""
+    def events():
+        chunks = []
+        try:
+            # the turn is held for as long as the stream runs
+            with session_turn(session_id):
+                # created lazily if missing
+                agent = get_or_create_agent_for_session(session_id)
+                try:
+                    for delta in handle_user_message_stream(agent, session_id, text):
+                        chunks.append(delta)
+                        yield _sse({"delta": delta})
+                finally:
+                    # commit the full reply once the stream ends
+                    reply = "".join(chunks)
+                    save_session_turn(session_id, agent)
+        except TurnQueueFull as e:
+            yield _sse({"error": str(e)}, event="error")
+            return
+        except Exception as e:
+            # The 200 and its headers are already committed; end the stream with an error event
+            print(f"Error in SSE stream: {str(e)}")
+            yield _sse({"error": str(e)}, event="error")
+            return
+        yield _sse({"reply": reply}, event="done")
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.route("/api/message", methods=["POST"])
 def message():
     try:
-        if not request.json:
-            return jsonify({"error": "Request body must be JSON"}), 400
-        
-        data = request.json
-        session_id = data.get("session_id")
-        text = data.get("message", "")
-        
-        if not session_id:
-            return jsonify({"error": "session_id is required"}), 400
+        session_id, text, error = _parse_message_request()
+        if error:
+            return error
         
-        if not text:
-            return jsonify({"error": "message cannot be empty"}), 400
-        
-        if session_id not in AGENTS:
-            # create lazily if missing
-            AGENTS[session_id] = get_or_create_agent_for_session(session_id)
-            LOGS[session_id] = []
-
-        # add user message to logs
-        LOGS[session_id].append({"role": "user", "text": text})
-        # send to agent
-        reply = handle_user_message(AGENTS[session_id], session_id, text)
-        LOGS[session_id].append({"role": "agent", "text": reply})
+        if request.accept_mimetypes.best == "text/event-stream":
+            return _stream_reply(session_id, text)
+
+        # one turn at a time per session, so concurrent messages cannot lose a turn
+        with session_turn(session_id):
+            # created lazily if missing
+            agent = get_or_create_agent_for_session(session_id)
+            # send to agent
+            reply = handle_user_message(agent, session_id, text)
+            # persist state and transcript in one write
+            save_session_turn(session_id, agent)
         return jsonify({"reply": reply})
+    except TurnQueueFull as e:
+        return jsonify({"error": "Too many messages in flight for this session", "message": str(e)}), 429
     except Exception as e:
         print(f"Error in /api/message: {str(e)}")
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
+@app.route("/api/message/stream", methods=["POST"])
+def message_stream():
+    try:
+        session_id, text, error = _parse_message_request()
+        if error:
+            return error
+        return _stream_reply(session_id, text)
+    except Exception as e:
+        print(f"Error in /api/message/stream: {str(e)}")
+        return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+def _tail_logs(session_id: str, since: int) -> Response:
+    """Stream new transcript entries as Server-Sent Events, one per message, for up to LOGS_MAX_TAIL seconds"""
+    def events():
+        cursor = since
+        deadline = time.monotonic() + LOGS_MAX_TAIL
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            entries, _ = wait_for_session_logs(session_id, cursor, timeout=min(LOGS_MAX_WAIT, remaining))
+            if not entries:
+                yield ": keep-alive\n\n"
+            for entry in entries:
+                yield _sse(entry, event_id=entry["id"])
+                cursor = entry["id"]
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.route("/api/logs/<session_id>", methods=["GET"])
 def logs(session_id):
+    """
+    Transcript entries with an id greater than ?since= (default 0), at most
+    ?limit= of them. ?wait=<seconds> long-polls until a new message arrives;
+    Accept: text/event-stream tails the transcript instead.
+    """
     try:
-        return jsonify(LOGS.get(session_id, []))
+        since = request.args.get("since", default=0, type=int)
+        limit = request.args.get("limit", type=int)
+        if since < 0 or (limit is not None and limit < 1):
+            return jsonify({"error": "since must be >= 0 and limit >= 1"}), 400
+
+        if request.accept_mimetypes.best == "text/event-stream":
+            # EventSource resumes from the last id it received
+            return _tail_logs(session_id, request.headers.get("Last-Event-ID", since, type=int))
+
+        wait = min(request.args.get("wait", default=0, type=float), LOGS_MAX_WAIT)
+        entries, last_id = wait_for_session_logs(session_id, since, limit, wait)
+        # Messages never change once written, so the newest id identifies the content
+        response = jsonify(entries)
+        response.set_etag(str(last_id))
+        return response.make_conditional(request)
     except Exception as e:
         print(f"Error in /api/logs: {str(e)}")
         return jsonify({"error": "Failed to retrieve logs", "message": str(e)}), 500
 
+@app.route("/api/scenarios", methods=["GET"])
+def scenarios():
+    """Scenarios a session can be created with; conditions and symptoms stay hidden"""
+    return jsonify(get_scenarios())
+
 @app.route("/api/health", methods=["GET"])
 def health():
-    return jsonify({"status": "healthy", "service": "patient-chatbot-api"}), 200
+    return jsonify({
+        "status": "healthy",
+        "service": "patient-chatbot-api",
+        "sessions": get_session_store_stats(),
+        "scenarios": get_scenario_stats(),
+        "prompt_cache": get_prompt_cache_stats(),
+        "response_cache": get_response_cache_stats(),
+        "rate_limiter": get_rate_limiter_stats(),
+        "model_health": get_model_health_stats(),
+        "opening_pool": get_opening_pool_stats(),
+    }), 200
+
+@app.route("/api/metrics", methods=["GET"])
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 application = app
 
@@ -0,0 +1,399 @@
+# backend/asgi.py
+# ASGI entrypoint for uvicorn. The LLM-bound message routes and the
+# /api/logs long-poll and tail run natively on asyncio so one worker can hold
+# hundreds of in-flight Gemini calls and open readers; every other route is
+# handed to the Flask app unchanged (WsgiToAsgi runs those one at a time on
+# a single thread, so nothing that waits may go through it). /api/ws keeps one
+# WebSocket per chat open for all of its messages (see chat_socket).
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 8000
+import asyncio
+import contextlib
+import json
+import os
+import time
+import uuid
+from urllib.parse import parse_qs
+from asgiref.wsgi import WsgiToAsgi
+from agent_logic_langgraph import (
+    acreate_agent_for_session,
+    aget_or_create_agent_for_session,
+    asave_session_turn,
+    asession_turn,
+    await_session_logs,
+    handle_user_message_async,
+    handle_user_message_stream_async,
+)
+from app import LOGS_MAX_TAIL, LOGS_MAX_WAIT, app as flask_app
+from metrics import HTTP_SECONDS
+from scenarios import UnknownScenario
+from session_turns import TurnQueueFull
+import transcript
+
+flask_asgi = WsgiToAsgi(flask_app)
+
+# Matches flask_cors' default (CORS(app) allows any origin)
+CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        event = await receive()
+        body += event.get("body", b"")
+        if not event.get("more_body"):
+            return body
+
+
+async def _send_json(send, status: int, payload):
+    body = json.dumps(payload).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + CORS_HEADERS,
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_not_modified(send, etag: str):
+    await send({"type": "http.response.start", "status": 304, "headers": [(b"etag", etag.encode())] + CORS_HEADERS})
+    await send({"type": "http.response.body"})
+
+
+def _header(scope, name: bytes) -> str:
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return ""
+
+
+async def _parse_message_request(receive):
+    """Validate a message body; returns (session_id, text, error)"""
+    try:
+        data = json.loads(await _read_body(receive) or b"null")
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not data:
+        return None, None, (400, {"error": "Request body must be JSON"})
+
+    session_id = data.get("session_id")
+    text = data.get("message", "")
+
+    if not session_id:
+        return None, None, (400, {"error": "session_id is required"})
+
+    if not text:
+        return None, None, (400, {"error": "message cannot be empty"})
+
+    return session_id, text, None
+
+
+def _sse(data: dict, event: str | None = None, event_id: int | None = None) -> bytes:
+    prefix = f"event: {event}\n" if event else ""
+    if event_id is not None:
+        prefix += f"id: {event_id}\n"
+    return f"{prefix}data: {json.dumps(data)}\n\n".encode()
+
+
+SSE_HEADERS = [
+    (b"content-type", b"text/event-stream"),
+    (b"cache-control", b"no-cache"),
+    (b"x-accel-buffering", b"no"),
+] + CORS_HEADERS
+
+
+def _queue_full(e: TurnQueueFull):
+    return 429, {"error": "Too many messages in flight for this session", "message": str(e)}
+
+
+async def _stream_reply(send, session_id: str, text: str):
+    """
+    Stream the patient reply as Server-Sent Events. Errors before the
+    response starts propagate to the caller; after that they end the
+    stream with an error event, since the status line is already sent.
+    """
+    started = False
+    try:
+        # the turn is held for as long as the stream runs
+        async with asession_turn(session_id):
+            agent = await aget_or_create_agent_for_session(session_id)
+            await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+            started = True
+
+            chunks = []
+            try:
+                async for delta in handle_user_message_stream_async(agent, session_id, text):
+                    chunks.append(delta)
+                    await send({"type": "http.response.body", "body": _sse({"delta": delta}), "more_body": True})
+            finally:
+                # commit the full reply once the stream ends
+                reply = "".join(chunks)
+                await asave_session_turn(session_id, agent)
+        await send({"type": "http.response.body", "body": _sse({"reply": reply}, event="done")})
+    except Exception as e:
+        if not started:
+            raise
+        print(f"Error in SSE stream: {str(e)}")
+        # The client may already be gone; there is nothing more to report to
+        with contextlib.suppress(Exception):
+            await send({"type": "http.response.body", "body": _sse({"error": str(e)}, event="error")})
+
+
+async def message(scope, receive, send):
+    try:
+        session_id, text, error = await _parse_message_request(receive)
+        if error:
+            return await _send_json(send, *error)
+
+        if _header(scope, b"accept").startswith("text/event-stream"):
+            return await _stream_reply(send, session_id, text)
+
+        # one turn at a time per session, so concurrent messages cannot lose a turn
+        async with asession_turn(session_id):
+            agent = await aget_or_create_agent_for_session(session_id)
+            reply = await handle_user_message_async(agent, session_id, text)
+            await asave_session_turn(session_id, agent)
+        await _send_json(send, 200, {"reply": reply})
+    except TurnQueueFull as e:
+        await _send_json(send, *_queue_full(e))
+    except Exception as e:
+        print(f"Error in /api/message: {str(e)}")
+        await _send_json(send, 500, {"error": "Internal server error", "message": str(e)})
+
+
+async def message_stream(scope, receive, send):
+    try:
+        session_id, text, error = await _parse_message_request(receive)
+        if error:
+            return await _send_json(send, *error)
+        await _stream_reply(send, session_id, text)
+    except TurnQueueFull as e:
+        await _send_json(send, *_queue_full(e))
+    except Exception as e:
+        print(f"Error in /api/message/stream: {str(e)}")
+        await _send_json(send, 500, {"error": "Internal server error", "message": str(e)})
+
+
+def _query_number(query: dict, name: str, default, kind):
+    """Like Flask's request.args.get(name, default, type=kind): unparsable values give the default"""
+    try:
+        return kind(query[name][0])
+    except (KeyError, ValueError):
+        return default
+
+
+async def _tail_logs(send, session_id: str, since: int):
+    """Stream new transcript entries as Server-Sent Events, one per message, for up to LOGS_MAX_TAIL seconds"""
+    await send({"type": "http.response.start", "status": 200, "headers": SSE_HEADERS})
+    cursor = since
+    deadline = time.monotonic() + LOGS_MAX_TAIL
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        entries, _ = await await_session_logs(session_id, cursor, timeout=min(LOGS_MAX_WAIT, remaining))
+        body = b"".join(_sse(entry, event_id=entry["id"]) for entry in entries) or b": keep-alive\n\n"
+        if entries:
+            cursor = entries[-1]["id"]
+        await send({"type": "http.response.body", "body": body, "more_body": True})
+    await send({"type": "http.response.body"})
+
+
+async def logs(scope, receive, send):
+    """GET /api/logs/<session_id>; see app.logs for the parameters"""
+    session_id = scope["path"][len("/api/logs/"):]
+    try:
+        query = parse_qs(scope.get("query_string", b"").decode())
+        since = _query_number(query, "since", 0, int)
+        limit = _query_number(query, "limit", None, int)
+        if since < 0 or (limit is not None and limit < 1):
+            return await _send_json(send, 400, {"error": "since must be >= 0 and limit >= 1"})
+
+        if _header(scope, b"accept").startswith("text/event-stream"):
+            # EventSource resumes from the last id it received
+            resume = _header(scope, b"last-event-id")
+            return await _tail_logs(send, session_id, int(resume) if resume.isdigit() else since)
+
+        wait = min(_query_number(query, "wait", 0, float), LOGS_MAX_WAIT)
+        entries, last_id = await await_session_logs(session_id, since, limit, wait)
+        # Messages never change once written, so the newest id identifies the content
+        etag = f'"{last_id}"'
+        if etag in [tag.strip() for tag in _header(scope, b"if-none-match").split(",")]:
+            return await _send_not_modified(send, etag)
+        body = json.dumps(entries).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"etag", etag.encode()),
+            ] + CORS_HEADERS,
+        })
+        await send({"type": "http.response.body", "body": body})
+    except Exception as e:
+        print(f"Error in /api/logs: {str(e)}")
+        await _send_json(send, 500, {"error": "Failed to retrieve logs", "message": str(e)})
+
+
+# Messages a socket may have queued behind the one being answered
+WS_MAX_PENDING = int(os.environ.get("WS_MAX_PENDING", 8))
+
+
+async def _play_turns(session_id: str, pending: asyncio.Queue, send_json):
+    """Answer a socket's messages one by one, streaming each reply"""
+    while True:
+        turn = await pending.get()
+        if turn is None:
+            return
+        text, tag = turn
+        try:
+            async with asession_turn(session_id):
+                agent = await aget_or_create_agent_for_session(session_id)
+                chunks = []
+                try:
+                    async for delta in handle_user_message_stream_async(agent, session_id, text):
+                        chunks.append(delta)
+                        await send_json(dict(tag, delta=delta))
+                finally:
+                    # commit the full reply once the stream ends
+                    await asave_session_turn(session_id, agent)
+                newest = transcript.last_id(agent["conversation_history"])
+            await send_json(dict(tag, reply="".join(chunks), id=newest))
+        except Exception as e:
+            if isinstance(e, TurnQueueFull):
+                error = dict(tag, error="Too many messages in flight for this session", message=str(e))
+            else:
+                print(f"Error in /api/ws: {str(e)}")
+                error = dict(tag, error="Internal server error", message=str(e))
+            # The socket may be gone; the player must survive to answer the next message
+            with contextlib.suppress(Exception):
+                await send_json(error)
+
+
+async def chat_socket(scope, receive, send):
+    """
+    /api/ws?session_id=<id>: one connection for a whole chat. The client
+    sends {"message": "..."} frames and may send the next before the
+    previous reply is done; replies come back in order, each as
+    {"delta": "..."} frames and a final {"reply": "...", "id": <message id>}.
+    A "ref" sent with a message is echoed in every frame about it. Without
+    session_id a session is created (with ?scenario= if given) and
+    announced first as {"session_id": "...", "scenario": "..."}. Rejected
+    messages get {"error": "..."}.
+    """
+    if (await receive())["type"] != "websocket.connect":
+        return
+    query = parse_qs(scope.get("query_string", b"").decode())
+    session_id = query.get("session_id", [None])[0]
+    announce = None
+    if not session_id:
+        session_id = str(uuid.uuid4())
+        try:
+            agent = await acreate_agent_for_session(session_id, query.get("scenario", [None])[0])
+        except UnknownScenario:
+            # unknown scenario: refuse the handshake
+            return await send({"type": "websocket.close", "code": 1008})
+        announce = {"session_id": session_id, "scenario": agent["profile"]["scenario"]}
+    await send({"type": "websocket.accept"})
+    closed = False
+
+    async def send_json(payload: dict):
+        # replies still being produced after the client left are dropped
+        if not closed:
+            await send({"type": "websocket.send", "text": json.dumps(payload)})
+
+    if announce:
+        await send_json(announce)
+
+    pending = asyncio.Queue()
+    player = asyncio.create_task(_play_turns(session_id, pending, send_json))
+    try:
+        while True:
+            event = await receive()
+            if event["type"] == "websocket.disconnect":
+                break
+            if event["type"] != "websocket.receive":
+                continue
+            try:
+                data = json.loads(event.get("text") or event.get("bytes") or b"null")
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                data = {}
+            text = data.get("message")
+            tag = {"ref": data["ref"]} if "ref" in data else {}
+            if not text or not isinstance(text, str):
+                await send_json(dict(tag, error="Frames must be JSON with a non-empty \"message\""))
+            elif pending.qsize() >= WS_MAX_PENDING:
+                await send_json(dict(tag, error="Too many messages in flight for this session"))
+            else:
+                pending.put_nowait((text, tag))
+    finally:
+        closed = True
+        # Messages not yet started are dropped; the one in progress is finished and saved
+        while not pending.empty():
+            pending.get_nowait()
+        pending.put_nowait(None)
+        await player
+
+
+ASYNC_ROUTES = {
+    ("POST", "/api/message"): message,
+    ("POST", "/api/message/stream"): message_stream,
+}
+
+# Native routes with one path parameter: (method, prefix) -> (route label, handler)
+ASYNC_PREFIX_ROUTES = {
+    ("GET", "/api/logs/"): ("/api/logs/<session_id>", logs),
+}
+
+
+def _route(scope):
+    """(route label, handler) of a native HTTP route, or None for Flask"""
+    handler = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+    if handler:
+        return scope["path"], handler
+    for (method, prefix), route in ASYNC_PREFIX_ROUTES.items():
+        parameter = scope["path"][len(prefix):]
+        if scope["method"] == method and scope["path"].startswith(prefix) and parameter and "/" not in parameter:
+            return route
+    return None
+
+
+async def _timed(route: str, handler, scope, receive, send):
+    """Run a native route, observing it like the Flask routes (time to first byte)"""
+    started = time.perf_counter()
+
+    async def timed_send(event):
+        if event["type"] == "http.response.start":
+            HTTP_SECONDS.observe(
+                time.perf_counter() - started, route=route, method=scope["method"], status=event["status"],
+            )
+        await send(event)
+
+    return await handler(scope, receive, timed_send)
+
+
+async def _lifespan(receive, send):
+    while True:
+        event = await receive()
+        if event["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] == "http":
+        route = _route(scope)
+        if route:
+            return await _timed(*route, scope, receive, send)
+    if scope["type"] == "websocket":
+        if scope["path"] == "/api/ws":
+            return await chat_socket(scope, receive, send)
+        return await send({"type": "websocket.close", "code": 1008})
+    return await flask_asgi(scope, receive, send)
@@ -0,0 +1,192 @@
+# Batch evaluation: replay many scripted consultations concurrently.
+# Each script is a JSON line of doctor messages, for example
+#
+#   {"id": "migraine-01", "messages": ["Hello, what brings you in?", "..."], "profile": {"age": 52}}
+#
+# (a bare list of messages also works; "scenario" picks a case from
+# SCENARIO_DIR, "random" included, and "profile" overrides fields of its
+# patient profile). Scripts run on a bounded thread pool through
+# handle_user_message, one session each, with every Gemini call going
+# through the shared rate limiter. Callers queue instead of being shed:
+# the limiter's wait limits default to 10 minutes here. The model is
+# resolved before the first script starts, and the opening-reply pool is
+# off, so every scripted line gets a reply generated for it. Each finished
+# script is appended to the output as one JSON line with the reply and
+# state after every turn. The output doubles as the checkpoint: rerunning
+# with the same output skips the script ids already in it.
+#
+#   cd backend && python batch_eval.py scripts.jsonl --output results.jsonl --workers 16
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+os.environ.setdefault("RATE_LIMIT_MAX_WAIT", "600")
+os.environ.setdefault("RATE_LIMIT_MAX_WAIT_NEW", "600")
+os.environ.setdefault("RATE_LIMIT_MAX_QUEUE", "100000")
+# Pooled openings answer a canonical greeting, not the script's first line
+os.environ.setdefault("OPENING_POOL_ENABLED", "false")
+
+import agent_logic_langgraph as agent
+from metrics import FAILED_REPLIES
+
+
+def load_scripts(path: str) -> list:
+    """[{"id", "messages", "profile"}] from a JSONL file"""
+    scripts = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            script = json.loads(line)
+            if isinstance(script, list):
+                script = {"messages": script}
+            if not isinstance(script, dict) or not isinstance(script.get("messages"), list):
+                raise ValueError(f"{path}:{number}: expected a list of messages or an object with \"messages\"")
+            script.setdefault("id", f"script-{number}")
+            scripts.append(script)
+    return scripts
+
+
+def completed_ids(path: str) -> set:
+    """Script ids already in an output file (a torn last line is ignored)"""
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["id"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+    return done
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def run_script(script: dict) -> dict:
+    """Play one script in a fresh session; returns its result line"""
+    session_id = str(uuid.uuid4())
+    agent_obj = agent.create_agent_for_session(session_id, script.get("scenario"), script.get("profile"))
+    started = time.perf_counter()
+    turns = []
+    for number, message in enumerate(script["messages"], 1):
+        turn_started = time.perf_counter()
+        reply = agent.handle_user_message(agent_obj, session_id, message)
+        agent.save_session_turn(session_id, agent_obj)
+        history = agent_obj["conversation_history"]
+        turns.append({
+            "turn": number,
+            "message": message,
+            "reply": reply,
+            "current_state": agent_obj["current_state"],
+            "symptom_level": agent_obj["symptom_level"],
+            "treatment_detected": agent_obj["treatment_detected"],
+            "treatment_accepted": agent_obj["treatment_accepted"],
+            "failed": bool(history and history[-1].get("failed")),
+            "seconds": round(time.perf_counter() - turn_started, 3),
+        })
+    return {
+        "id": script["id"],
+        "session_id": session_id,
+        "scenario": agent_obj["profile"]["scenario"],
+        "turns": turns,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def resolve_model() -> str:
+    """
+    Resolve the model before any script runs (the server does it in the
+    background, where the first requests may still get the fallback) and
+    keep re-validating it during the batch
+    """
+    try:
+        model = agent.MODEL_RESOLVER.refresh()
+    except Exception as e:
+        model = agent.MODEL_RESOLVER.current()
+        print(f"[WARNING] Model resolution failed: {e}. Using fallback {model}.")
+    agent.start_model_warmup()
+    return model
+
+
+def run_batch(scripts: list, output: str, workers: int = 8) -> dict:
+    """
+    Run the scripts not yet in output and append their results as they
+    finish. At most 2 x workers scripts are in flight, so memory stays flat
+    for large batches.
+    """
+    done = completed_ids(output)
+    todo = [script for script in scripts if script["id"] not in done]
+    if done:
+        print(f"[INFO] Resuming: {len(scripts) - len(todo)} of {len(scripts)} scripts already in {output}")
+    fallbacks_before = FAILED_REPLIES.total()
+    started = time.monotonic()
+    finished = errors = 0
+
+    with open(output, "a") as out, ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as pool:
+        if out.tell() and not _ends_with_newline(output):
+            # Start after a line torn by an interrupted run
+            out.write("\n")
+        pending = {}
+        queued = iter(todo)
+        while True:
+            for script in queued:
+                pending[pool.submit(run_script, script)] = script
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                script = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # Left out of the output, so the next run retries it
+                    errors += 1
+                    print(f"[WARNING] Script {script['id']} failed: {e}")
+                    continue
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                finished += 1
+                if finished % 50 == 0:
+                    elapsed = time.monotonic() - started
+                    print(f"[INFO] {finished}/{len(todo)} scripts, {finished / elapsed * 60:.1f}/min")
+
+    return {
+        "scripts": len(scripts),
+        "skipped": len(scripts) - len(todo),
+        "completed": finished,
+        "errors": errors,
+        "fallback_replies": int(FAILED_REPLIES.total() - fallbacks_before),
+        "seconds": round(time.monotonic() - started, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay scripted consultations in parallel")
+    parser.add_argument("scripts", help="JSONL file, one script per line")
+    parser.add_argument("--output", default="batch_results.jsonl", help="results JSONL; also the resume checkpoint")
+    parser.add_argument("--workers", type=int, default=8, help="scripts run concurrently (default: 8)")
+    args = parser.parse_args()
+
+    scripts = load_scripts(args.scripts)
+    ids = [script["id"] for script in scripts]
+    if len(set(ids)) != len(ids):
+        parser.error("script ids must be unique")
+    model = resolve_model()
+    summary = dict(run_batch(scripts, args.output, workers=args.workers), model=model)
+    print(f"[INFO] Batch finished: {json.dumps(summary)}")
+    if summary["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# Micro-benchmark: per-call Python overhead of generate_response.
+# The Gemini client is replaced by an in-process stub that returns
+# immediately, so the numbers are pure framework/adapter cost.
+#
+#   cd backend && python benchmarks/bench_generation_overhead.py [calls]
+import contextlib
+import io
+import os
+import sys
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+# Measure overhead, not the rate limiter
+os.environ.setdefault("GEMINI_RPM", "1000000000")
+os.environ.setdefault("GEMINI_TPM", "1000000000000")
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import agent_logic_langgraph as agent
+
+
+class _StubResponse:
+    text = "I've had a mild headache since yesterday."
+
+
+class _StubModels:
+    def generate_content(self, model, contents, **kwargs):
+        return _StubResponse()
+
+
+class _StubClient:
+    models = _StubModels()
+
+
+def legacy_generate_response(prompt: str) -> str:
+    """generate_response as it was before the backend was built once"""
+    try:
+        _init_genai_client()  # noqa: F821 - undefined in the old module too
+    except Exception:
+        traceback.print_exc()
+
+    try:
+        from langchain.prompts import PromptTemplate
+        from langchain.chains import LLMChain
+        from langchain.llms.base import LLM
+
+        class _GeminiAdapterLLM(LLM):
+            def _call(self, prompt_text: str, stop: list | None = None) -> str:
+                return agent._call_gemini_llm_raw(prompt_text)
+
+            def _identifying_params(self):
+                return {"name": "gemini-adapter"}
+
+            @property
+            def _llm_type(self):
+                return "gemini-adapter"
+
+        try:
+            prompt_template = PromptTemplate(input_variables=["prompt"], template="{prompt}")
+            chain = LLMChain(llm=_GeminiAdapterLLM(), prompt=prompt_template)
+            return chain.run(prompt=prompt)
+        except Exception as chain_exc:
+            print("[WARNING] LangChain chain.run failed, falling back to raw calls:", str(chain_exc)[:200])
+    except Exception:
+        pass
+
+    return agent._call_gemini_llm_raw(prompt)
+
+
+def per_call_langchain_generate_response(prompt: str) -> str:
+    """Rebuilding a (working) LangChain chain on every call"""
+    from langchain_core.prompts import PromptTemplate
+
+    chain = PromptTemplate.from_template("{prompt}") | agent._gemini_adapter_llm()
+    return chain.invoke({"prompt": prompt})
+
+
+def bench(label: str, fn, calls: int):
+    prompt = "You are a simulated patient.\n\nDoctor: How are you?\nPatient:"
+    sink = io.StringIO()
+    with contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+        for _ in range(min(calls, 50)):  # warm-up
+            fn(prompt)
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn(prompt)
+        elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed / calls * 1e6:10.1f} us/call   log bytes: {len(sink.getvalue()):>10}")
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    agent.client = _StubClient()
+    agent.USE_NEW_CLIENT = True
+
+    print(f"{calls} calls per variant, stubbed Gemini client\n")
+    bench("before: legacy generate_response", legacy_generate_response, calls)
+    bench("before: LangChain chain rebuilt per call", per_call_langchain_generate_response, calls)
+
+    agent.GENERATION_BACKEND = agent.create_generation_backend("langchain")
+    bench("after: langchain backend (built once)", agent.generate_response, calls)
+    agent.GENERATION_BACKEND = agent.create_generation_backend("direct")
+    bench("after: direct backend", agent.generate_response, calls)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Benchmark: cold-start cost of the backend.
+# Each measurement runs in a fresh interpreter with `python -X importtime`,
+# which is what a serverless cold start pays. Reports the time to import
+# app.py, to answer the first /api/health and /api/session, and what the
+# pieces deferred to first use (Gemini SDK, LangGraph, LangChain) cost
+# when they do load.
+#
+#   cd backend && python benchmarks/bench_import_time.py [runs]
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that used to load with `import app` and now load on first use
+# (langgraph.graph pulls in langchain_core)
+DEFERRED = ["google.genai", "google.generativeai", "langgraph.graph"]
+
+FIRST_REQUESTS = """
+import time
+started = time.perf_counter()
+import app
+client = app.app.test_client()
+imported = time.perf_counter()
+client.get("/api/health")
+health = time.perf_counter()
+client.post("/api/session")
+session = time.perf_counter()
+print("RESULT", imported - started, health - started, session - started)
+"""
+
+FIRST_USE = "import agent_logic_langgraph as agent; agent._init_genai_client(); agent.get_patient_graph()"
+
+
+def _env() -> dict:
+    env = dict(os.environ)
+    env.setdefault("GEMINI_API_KEY", "benchmark-key")
+    env["MODEL_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="rockfrog-bench-"), "models.json")
+    # Nothing in the background: measure only what the importing thread does
+    env["WARM_UP_ENABLED"] = "false"
+    env["MODEL_REVALIDATE_INTERVAL"] = "1e9"
+    env["OPENING_POOL_ENABLED"] = "false"
+    return env
+
+
+def importtime(code: str) -> dict:
+    """
+    Cumulative import time in ms per module, from -X importtime, plus the
+    modules imported directly by the top-level import under "__direct__"
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=BACKEND, env=_env(), capture_output=True, text=True, check=True,
+    )
+    modules = {"__direct__": []}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if name.startswith("   ") and not name.startswith("    "):
+            # Indented one level below the top-level import
+            modules["__direct__"].append(name.strip())
+        modules.setdefault(name.strip(), int(cumulative) / 1000)
+    return modules
+
+
+def first_requests() -> tuple:
+    result = subprocess.run(
+        [sys.executable, "-c", FIRST_REQUESTS], cwd=BACKEND, env=_env(), capture_output=True, text=True, check=True,
+    )
+    # Other output (e.g. session creation logs) may surround the marked line
+    line = next(line for line in result.stdout.splitlines() if line.startswith("RESULT "))
+    return tuple(float(value) * 1000 for value in line.split()[1:])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    imports = [importtime("import app") for _ in range(runs)]
+    requests = [first_requests() for _ in range(runs)]
+    first_use = [importtime(FIRST_USE) for _ in range(runs)]
+
+    print(f"median of {runs} fresh interpreters\n")
+    print(f"{'import app':<40}{statistics.median(run['app'] for run in imports):8.0f} ms")
+    for index, label in enumerate(["app imported, test client ready", "first /api/health answered", "first /api/session answered"]):
+        print(f"{label:<40}{statistics.median(run[index] for run in requests):8.0f} ms")
+
+    print("\nheaviest direct imports of app.py:")
+    direct = sorted(imports[0]["__direct__"], key=lambda name: -imports[0][name])
+    for name in direct[:6]:
+        print(f"  {name:<38}{statistics.median(run.get(name, 0) for run in imports):8.0f} ms")
+
+    print("\ndeferred to first use / warm-up (no longer paid by `import app`):")
+    deferred = 0.0
+    for name in DEFERRED:
+        if name in first_use[0]:
+            cost = statistics.median(run.get(name, 0) for run in first_use)
+            deferred += cost
+            note = "  (still imported by app!)" if any(name in run for run in imports) else ""
+            print(f"  {name:<38}{cost:8.0f} ms{note}")
+    print(f"  {'total':<38}{deferred:8.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Benchmark: intent routing over a large synthetic corpus of doctor messages.
+# Compares the old per-turn keyword scans (router + node result, each
+# lowercasing the message and scanning its own list) with the compiled
+# single-pass IntentRouter, for speed and for accuracy against the labels
+# the corpus was generated with.
+#
+#   cd backend && python benchmarks/bench_intent_router.py [messages]
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from intent_router import DEFAULT_ROUTER
+
+# (template, label); label is the node the message should be routed to
+TEMPLATES = [
+    ("How long have you had the {symptom}?", "questioning"),
+    ("Does the {symptom} get worse at night?", "questioning"),
+    ("How long does it take for the {symptom} to go away?", "questioning"),
+    ("Did you take your temperature this morning?", "questioning"),
+    ("Have you noticed anything that triggers the {symptom}?", "questioning"),
+    ("Any family history of {condition}?", "questioning"),
+    ("Can you tell me more about the {symptom}?", "progressive_revelation"),
+    ("Could you describe the {symptom} in a bit more detail?", "progressive_revelation"),
+    ("Please elaborate on when the {symptom} started.", "progressive_revelation"),
+    ("Explain what the {symptom} feels like.", "progressive_revelation"),
+    ("I'm going to prescribe {drug} for the {symptom}.", "treatment"),
+    ("I'd like to start you on {drug}, twice a day.", "treatment"),
+    ("Take these tablets with food: {drug}.", "treatment"),
+    ("My recommended treatment is {drug} and rest.", "treatment"),
+    ("Here's a prescription for {drug}.", "treatment"),
+    ("I don't want to prescribe anything yet, tell me more about the {symptom}.", "progressive_revelation"),
+    ("We won't need medication for now. How is your sleep?", "questioning"),
+    ("No drugs for the moment; does the {symptom} come and go?", "questioning"),
+]
+FILLERS = {
+    "symptom": ["headache", "cough", "back pain", "nausea", "dizziness", "rash", "fatigue"],
+    "condition": ["migraine", "diabetes", "asthma", "heart disease"],
+    "drug": ["ibuprofen", "paracetamol", "amoxicillin", "sumatriptan", "an inhaler"],
+}
+
+
+def build_corpus(size: int, seed: int = 7):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        template, label = rng.choice(TEMPLATES)
+        text = template.format(**{key: rng.choice(values) for key, values in FILLERS.items()})
+        corpus.append((text, label))
+    return corpus
+
+
+def legacy_route(message: str, symptom_level: int = 0) -> str:
+    """
+    The scans a turn ran before: _select_node, then the node result
+    re-scanning with its own (different) lists to set treatment_detected
+    """
+    if any(word in message.lower() for word in ["prescribe", "medication", "treatment", "medicine", "drug"]):
+        node = "treatment"
+    elif any(word in message.lower() for word in ["more", "detail", "tell me", "describe"]) and symptom_level < 2:
+        node = "progressive_revelation"
+    else:
+        node = "questioning"
+    treatment_keywords = ["prescribe", "medication", "treatment", "take", "medicine", "drug"]
+    any(keyword in message.lower() for keyword in treatment_keywords)
+    any(word in message.lower() for word in ["more", "detail", "tell me", "describe"])
+    return node
+
+
+def router_route(message: str, symptom_level: int = 0) -> str:
+    intent = DEFAULT_ROUTER.route(message)
+    if intent.treatment:
+        return "treatment"
+    if intent.detail and symptom_level < 2:
+        return "progressive_revelation"
+    return "questioning"
+
+
+def bench(label: str, fn, corpus):
+    started = time.perf_counter()
+    decisions = [fn(text) for text, _ in corpus]
+    elapsed = time.perf_counter() - started
+    correct = sum(decision == expected for decision, (_, expected) in zip(decisions, corpus))
+    print(f"{label:<28} {elapsed / len(corpus) * 1e6:8.2f} us/msg  {len(corpus) / elapsed:>12,.0f} msg/s  "
+          f"accuracy {correct / len(corpus):6.1%}")
+    return decisions
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    corpus = build_corpus(size)
+    print(f"{size:,} synthetic doctor messages\n")
+    legacy = bench("before: keyword scans", legacy_route, corpus)
+    routed = bench("after: IntentRouter", router_route, corpus)
+
+    # Where the two disagree, and who was right
+    examples = {}
+    for (text, expected), old, new in zip(corpus, legacy, routed):
+        if old != new:
+            examples.setdefault(text, (expected, old, new))
+    print(f"\n{len(examples)} distinct messages routed differently, e.g.:")
+    for text, (expected, old, new) in list(examples.items())[:8]:
+        print(f"  {text!r}\n    expected {expected}, before {old}, after {new}")
+
+
+if __name__ == "__main__":
+    main()
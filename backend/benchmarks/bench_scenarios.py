@@ -0,0 +1,88 @@
+# Benchmark: scenario registry.
+# Writes a directory of synthetic case files, then measures how long the
+# registry takes to load and pre-render them, the cost of a node
+# instruction per turn, a scenario pick at session creation, and a hot
+# reload after one file changes. Per turn, the old three-field f-string is
+# the floor; rendering a full case (condition, symptoms by level,
+# treatments) every turn is what scenarios would cost without
+# pre-rendering.
+#
+#   cd backend && python benchmarks/bench_scenarios.py [scenarios]
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scenarios import NODE_TEMPLATES, ScenarioRegistry
+
+
+def write_cases(directory: str, count: int, per_file: int = 50):
+    for start in range(0, count, per_file):
+        cases = [
+            {
+                "id": f"case-{number:05d}",
+                "condition": f"condition {number}",
+                "profile": {"patient_name": f"Patient {number}", "age": 20 + number % 60, "med_history": "asthma"},
+                "symptoms": [f"mild symptom {number}", f"moderate symptom {number}", f"detailed symptom {number}"],
+                "acceptable_treatments": ["rest", f"drug {number % 17}"],
+            }
+            for number in range(start, min(start + per_file, count))
+        ]
+        with open(os.path.join(directory, f"cases-{start:05d}.json"), "w") as f:
+            json.dump(cases, f)
+
+
+def legacy_instruction(profile: dict, node: str) -> str:
+    """What each node did every turn before: rebuild the whole instruction"""
+    return f"""You are a simulated patient. Your patient profile:
+- Name: {profile["patient_name"]}
+- Age: {profile["age"]}
+- MedicalHistory: {profile["med_history"]}{NODE_TEMPLATES[node]}"""
+
+
+def per_call(label: str, fn, calls: int):
+    started = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<40} {elapsed / calls * 1e6:8.2f} us")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    nodes = list(NODE_TEMPLATES)
+    with tempfile.TemporaryDirectory() as directory:
+        write_cases(directory, count)
+        started = time.perf_counter()
+        registry = ScenarioRegistry(directory, reload_interval=0)
+        load = time.perf_counter() - started
+        print(f"\nloaded and pre-rendered {count:,} scenarios in {load * 1000:.0f} ms "
+              f"({load / count * 1e6:.0f} us each)\n")
+
+        ids = [f"case-{number:05d}" for number in range(count)]
+        calls = 200_000
+        turns = [
+            (registry.get(ids[i % count]).new_profile(), nodes[i % len(nodes)], i % 3)
+            for i in range(calls)
+        ]
+        per_call("instruction, old: 3-field f-string",
+                 lambda i: legacy_instruction(turns[i][0], turns[i][1]), calls)
+        per_call("instruction, full case rendered per turn",
+                 lambda i: registry.for_profile(turns[i][0]).render(turns[i][1], turns[i][2], turns[i][0]), calls)
+        per_call("instruction, pre-rendered lookup",
+                 lambda i: registry.for_profile(turns[i][0]).instruction(turns[i][1], turns[i][2], turns[i][0]), calls)
+        per_call("pick scenario by id", lambda i: registry.pick(ids[i % count]).new_profile(), calls)
+        per_call("pick random scenario", lambda i: registry.pick("random").new_profile(), calls)
+
+        path = os.path.join(directory, "cases-00000.json")
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 10**9))
+        started = time.perf_counter()
+        registry.reload()
+        print(f"\nhot reload after one file changed: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
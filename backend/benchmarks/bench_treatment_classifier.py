@@ -0,0 +1,72 @@
+# Benchmark: grading the patient's reply to a treatment.
+# Scores the old substring check ("accept" and "treatment" anywhere in the
+# reply) and TreatmentClassifier against the labelled replies in
+# treatment_eval.jsonl, which the classifier is not trained on, then times
+# both over the evaluation set repeated. The substring check only answers
+# accepted or not, so both are compared on that, and the classifier also on
+# its three labels.
+#
+#   cd backend && python benchmarks/bench_treatment_classifier.py [repeats]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from treatment_classifier import DEFAULT_EXAMPLES, LABELS, TreatmentClassifier, load_examples
+
+EVAL_SET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "treatment_eval.jsonl")
+
+
+def legacy_accepted(reply: str) -> bool:
+    """What _treatment_result did before"""
+    return "accept" in reply.lower() and "treatment" in reply.lower()
+
+
+def timed(label: str, fn, replies: list):
+    started = time.perf_counter()
+    for reply in replies:
+        fn(reply)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<28} {elapsed / len(replies) * 1e6:8.2f} us/reply  {len(replies) / elapsed:>12,.0f} replies/s")
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    started = time.perf_counter()
+    classifier = TreatmentClassifier(load_examples(DEFAULT_EXAMPLES))
+    print(f"trained on {classifier.examples} examples ({len(classifier._weights):,} features) "
+          f"in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    evaluation = load_examples(EVAL_SET)
+    legacy = [legacy_accepted(text) for text, _ in evaluation]
+    graded = [classifier.classify(text) for text, _ in evaluation]
+    print(f"\n{len(evaluation)} held-out replies")
+    for name, accepted in (("before: substring check", legacy), ("after: classifier", [g.accepted for g in graded])):
+        correct = sum(a == (label == "accept") for a, (_, label) in zip(accepted, evaluation))
+        false_accepts = sum(a and label != "accept" for a, (_, label) in zip(accepted, evaluation))
+        missed = sum(not a and label == "accept" for a, (_, label) in zip(accepted, evaluation))
+        print(f"{name:<28} accepted/not {correct / len(evaluation):6.1%}  "
+              f"false accepts {false_accepts:3}  missed accepts {missed:3}")
+    correct = sum(g.label == label for g, (_, label) in zip(graded, evaluation))
+    print(f"{'after: classifier':<28} three labels {correct / len(evaluation):6.1%}  "
+          f"({sum(g.source == 'rules' for g in graded)} by rules)")
+    print("\nconfusion (rows expected, columns graded):")
+    print(" " * 15 + "".join(f"{label:>15}" for label in LABELS))
+    for expected in LABELS:
+        row = [sum(g.label == got and label == expected for g, (_, label) in zip(graded, evaluation)) for got in LABELS]
+        print(f"{expected:<15}" + "".join(f"{count:>15}" for count in row))
+
+    print("\nmisgraded:")
+    for g, (text, label) in zip(graded, evaluation):
+        if g.label != label:
+            print(f"  {text!r}\n    expected {label}, graded {g.label} ({g.source}, {g.confidence:.2f})")
+
+    replies = [text for text, _ in evaluation] * repeats
+    print(f"\n{len(replies):,} replies")
+    timed("before: substring check", legacy_accepted, replies)
+    timed("after: classifier", classifier.classify, replies)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+# Offline load test: many simulated clinicians against the Flask app.
+# The Gemini client is replaced by a simulated one with configurable
+# latency (lognormal), stalls, errors and 429s, so no quota is spent.
+# Each clinician runs scripted consultations through /api/session and
+# /api/message with the Flask test client (one thread per clinician).
+# Reports requests/sec, p50/p95/p99 per endpoint and per graph node, and
+# memory per session.
+#
+#   cd backend && python benchmarks/load_test.py --clinicians 50 --consultations 2
+#   cd backend && python benchmarks/load_test.py --stall-rate 0.02 --stall 20 --json
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark-key")
+# Keep the real model cache untouched and let the harness, not the quota, set the pace
+os.environ.setdefault("MODEL_CACHE_PATH", os.path.join(tempfile.mkdtemp(prefix="rockfrog-bench-"), "models.json"))
+os.environ.setdefault("GEMINI_RPM", "1000000")
+os.environ.setdefault("GEMINI_TPM", "1000000000")
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import agent_logic_langgraph as agent
+
+# Scripted consultations; the wording exercises every graph node
+CONSULTATIONS = [
+    [
+        "Hello, I'm Dr. Smith. What brings you in today?",
+        "When did the headaches start?",
+        "Can you tell me more about the pain?",
+        "Does anything make it better or worse?",
+        "Describe how it affects your sleep.",
+        "I'd like to prescribe a mild pain medication.",
+        "Does that treatment plan sound okay to you?",
+    ],
+    [
+        "Good morning, how are you feeling?",
+        "Have you had any fever?",
+        "Tell me more about your stress at work.",
+        "Any history of migraines in your family?",
+        "I think a short course of medication would help.",
+        "Okay, take the medicine twice a day with food.",
+    ],
+    [
+        "Hi there, I'm the doctor on call.",
+        "How long has this been going on?",
+        "Can you describe the pain in more detail?",
+        "Do you take any drugs or supplements?",
+        "What do you think about starting treatment?",
+    ],
+]
+
+
+class _Response:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage_metadata = usage
+
+
+class _Usage:
+    def __init__(self, prompt_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.cached_content_token_count = 0
+
+
+class SimulatedGemini:
+    """
+    Stand-in for genai.Client(). Latency is lognormal around `latency`
+    seconds; a `stall_rate` fraction of calls take `stall` seconds instead;
+    `failure_rate` calls raise a 500 and `rate_limit_rate` calls a 429.
+    """
+
+    REPLIES = [
+        "I've had this headache for about three days now.",
+        "It's a dull ache, mostly behind my eyes.",
+        "Work has been really stressful lately, and I'm not sleeping well.",
+        "I guess that sounds reasonable, thank you doctor.",
+    ]
+
+    def __init__(self, latency=0.8, jitter=0.3, stall_rate=0.0, stall=20.0, failure_rate=0.0,
+                 rate_limit_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.models = types.SimpleNamespace(
+            generate_content=self._generate, generate_content_stream=self._generate_stream
+        )
+        self.caches = types.SimpleNamespace(create=self._create_cache)
+        self.aio = types.SimpleNamespace(
+            models=types.SimpleNamespace(
+                generate_content=self._agenerate, generate_content_stream=self._agenerate_stream
+            ),
+            caches=types.SimpleNamespace(create=self._acreate_cache),
+        )
+
+    def _draw(self):
+        """(delay seconds, error to raise or None) for one call"""
+        with self._lock:
+            self.calls += 1
+            roll = self.random.random()
+            if roll < self.stall_rate:
+                delay = self.stall
+            elif self.latency > 0:
+                delay = self.random.lognormvariate(0, self.jitter) * self.latency
+            else:
+                delay = 0.0
+            roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return delay * 0.1, Exception("429 RESOURCE_EXHAUSTED: simulated quota exceeded")
+        if roll < self.rate_limit_rate + self.failure_rate:
+            return delay, Exception("500 INTERNAL: simulated model error")
+        return delay, None
+
+    def _reply(self, contents):
+        return _Response(self.random.choice(self.REPLIES), _Usage(len(str(contents)) // 4 + 1))
+
+    def _generate(self, model, contents, config=None):
+        delay, error = self._draw()
+        time.sleep(delay)
+        if error:
+            raise error
+        return self._reply(contents)
+
+    def _generate_stream(self, model, contents, config=None):
+        delay, error = self._draw()
+        time.sleep(delay)
+        if error:
+            raise error
+        response = self._reply(contents)
+        for word in response.text.split(" "):
+            yield _Response(word + " ")
+        yield _Response("", response.usage_metadata)
+
+    async def _agenerate(self, model, contents, config=None):
+        delay, error = self._draw()
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return self._reply(contents)
+
+    async def _agenerate_stream(self, model, contents, config=None):
+        delay, error = self._draw()
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        response = self._reply(contents)
+
+        async def chunks():
+            for word in response.text.split(" "):
+                yield _Response(word + " ")
+            yield _Response("", response.usage_metadata)
+        return chunks()
+
+    def _create_cache(self, model, config):
+        return types.SimpleNamespace(name=f"cachedContents/bench-{abs(hash(config['system_instruction'])) % 10**8}")
+
+    async def _acreate_cache(self, model, config):
+        return self._create_cache(model, config)
+
+
+class Recorder:
+    """Thread-safe latency samples keyed by endpoint or node"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, seconds, ok=True):
+        with self._lock:
+            self.samples.setdefault(key, []).append(seconds)
+            if not ok:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def summary(self):
+        with self._lock:
+            return {
+                key: dict(_percentiles(values), count=len(values), errors=self.errors.get(key, 0))
+                for key, values in sorted(self.samples.items())
+            }
+
+
+def _percentiles(values):
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000, 1)
+
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+
+def _instrument_nodes(recorder):
+    """Time every generate_response call by the node that made it"""
+    original = agent.generate_response
+
+    def timed(prompt, system_instruction=None, node=None):
+        started = time.perf_counter()
+        reply = original(prompt, system_instruction, node)
+        recorder.add(f"node:{node}", time.perf_counter() - started, ok=not reply.startswith("I'm "))
+        return reply
+
+    agent.generate_response = timed
+    return original
+
+
+def _clinician(app, recorder, consultations, think_time, rng):
+    client = app.test_client()
+    for _ in range(consultations):
+        started = time.perf_counter()
+        response = client.post("/api/session")
+        recorder.add("POST /api/session", time.perf_counter() - started, ok=response.status_code == 201)
+        if response.status_code != 201:
+            continue
+        session_id = response.get_json()["session_id"]
+        if think_time:
+            time.sleep(rng.uniform(0, think_time))
+        for turn, text in enumerate(rng.choice(CONSULTATIONS)):
+            started = time.perf_counter()
+            response = client.post("/api/message", json={"session_id": session_id, "message": text})
+            elapsed = time.perf_counter() - started
+            recorder.add("POST /api/message", elapsed, ok=response.status_code == 200)
+            if not turn:
+                # Opening turns may be served from the pre-generated pool
+                recorder.add("POST /api/message (opening)", elapsed, ok=response.status_code == 200)
+            if think_time:
+                time.sleep(rng.uniform(0, think_time))
+
+
+def run_load(app, clinicians, consultations, think_time, seed):
+    recorder = Recorder()
+    original = _instrument_nodes(recorder)
+    rng = random.Random(seed)
+    threads = [
+        threading.Thread(
+            target=_clinician, args=(app, recorder, consultations, think_time, random.Random(rng.random()))
+        )
+        for _ in range(clinicians)
+    ]
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        agent.generate_response = original
+    elapsed = time.perf_counter() - started
+    requests = sum(len(values) for key, values in recorder.samples.items() if key.startswith("POST"))
+    return {
+        "clinicians": clinicians,
+        "requests": requests,
+        "seconds": round(elapsed, 2),
+        "requests_per_second": round(requests / elapsed, 2) if elapsed else 0.0,
+        "latency": recorder.summary(),
+    }
+
+
+def measure_session_memory(app, sessions):
+    """Bytes allocated per session for a full scripted consultation (no LLM latency)"""
+    client = app.test_client()
+    previous = agent.client
+    agent.client = SimulatedGemini(latency=0.0, seed=0)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            for index in range(sessions):
+                session_id = client.post("/api/session").get_json()["session_id"]
+                for text in CONSULTATIONS[index % len(CONSULTATIONS)]:
+                    client.post("/api/message", json={"session_id": session_id, "message": text})
+            after = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+    finally:
+        agent.client = previous
+    return {
+        "sessions": sessions,
+        "bytes_per_session": round((after - before) / sessions) if sessions else 0,
+        "store": agent.get_session_store_stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test with a simulated Gemini backend")
+    parser.add_argument("--clinicians", type=int, default=50, help="concurrent simulated clinicians")
+    parser.add_argument("--consultations", type=int, default=2, help="consultations per clinician")
+    parser.add_argument("--think-time", type=float, default=0.0, help="max seconds between messages")
+    parser.add_argument("--latency", type=float, default=0.8, help="median simulated LLM latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.3, help="lognormal sigma of the latency")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="fraction of calls that stall")
+    parser.add_argument("--stall", type=float, default=20.0, help="stall duration (s)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of calls that fail with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of calls that fail with a 429")
+    parser.add_argument("--memory-sessions", type=int, default=200, help="sessions for the memory measurement (0: skip)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    simulated = SimulatedGemini(
+        latency=args.latency, jitter=args.jitter, stall_rate=args.stall_rate, stall=args.stall,
+        failure_rate=args.failure_rate, rate_limit_rate=args.rate_limit_rate, seed=args.seed,
+    )
+    agent.client = simulated
+    agent.USE_NEW_CLIENT = True
+    with contextlib.redirect_stdout(io.StringIO()):
+        from app import app
+        # Measure steady state, not the one-off graph compile of a cold start
+        agent.get_patient_graph()
+
+    report = run_load(app, args.clinicians, args.consultations, args.think_time, args.seed)
+    report["llm_calls"] = simulated.calls
+    report["opening_pool"] = agent.get_opening_pool_stats()
+    if args.memory_sessions:
+        report["memory"] = measure_session_memory(app, args.memory_sessions)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{report['clinicians']} clinicians, {report['requests']} requests in {report['seconds']}s "
+          f"-> {report['requests_per_second']} req/s ({report['llm_calls']} simulated LLM calls)\n")
+    print(f"{'':<34}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for key, row in report["latency"].items():
+        print(f"{key:<34}{row['count']:>7}{row['errors']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    print(f"\nopening pool: {report['opening_pool']}")
+    if "memory" in report:
+        memory = report["memory"]
+        print(f"\nmemory: {memory['bytes_per_session']} bytes/session over {memory['sessions']} "
+              f"scripted consultations (store: {memory['store']})")
+
+
+if __name__ == "__main__":
+    main()
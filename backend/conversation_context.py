@@ -0,0 +1,121 @@
+# Token-budgeted conversation history for prompts.
+# Recent messages are rendered verbatim; once they no longer fit in the
+# token budget the oldest ones are folded into a short running summary, so
+# early facts survive long consultations without the prompt growing.
+# Rendered lines are cached per session and only the new messages of each
+# turn are rendered.
+import os
+import re
+from collections import deque
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token for English)"""
+    return len(text) // 4 + 1
+
+
+def new_context() -> dict:
+    """
+    Persistent part of a session's context: the number of history messages
+    already folded into the summary, and the summary notes themselves.
+    Keys starting with an underscore are a per-process cache and are never
+    serialized.
+    """
+    return {"folded_upto": 0, "notes": []}
+
+
+class ContextWindow:
+    """Renders conversation history within a token budget"""
+
+    def __init__(self, budget_tokens=1200, summary_tokens=300, message_tokens=300, note_words=25):
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = summary_tokens
+        self.message_tokens = message_tokens
+        self.note_words = note_words
+
+    def render(self, context: dict, history: list) -> str:
+        """Return the prompt text for history, updating context in place"""
+        # Indexes count every message of the session; the history itself
+        # only keeps the newest ones (see transcript.py)
+        offset = history[0].get("id", 1) - 1 if history else 0
+        end = offset + len(history)
+        cache = context.get("_cache")
+        if cache is None or cache["upto"] > end or cache["upto"] < context["folded_upto"]:
+            # No cache in this process yet (new worker, reloaded session)
+            cache = {"lines": deque(), "total": 0, "upto": context["folded_upto"], "text": None}
+            context["_cache"] = cache
+
+        if cache["upto"] < end:
+            for index in range(max(cache["upto"], offset), end):
+                line = self._render_line(history[index - offset])
+                if line is not None:
+                    tokens = estimate_tokens(line)
+                    cache["lines"].append((index, line, tokens))
+                    cache["total"] += tokens
+            cache["upto"] = end
+            self._fold(context, cache)
+            cache["text"] = None
+
+        if cache["text"] is None:
+            cache["text"] = self._join(context, cache)
+        return cache["text"]
+
+    def _render_line(self, msg: dict) -> str | None:
+        if msg.get("failed"):
+            # Error replies stay in the transcript, not in the prompt
+            return None
+        role = msg.get("role", "unknown")
+        content = msg.get("content", "")
+        max_chars = self.message_tokens * 4
+        if len(content) > max_chars:
+            # One pasted wall of text must not blow the whole budget
+            content = content[:max_chars].rstrip() + "…"
+        if role == "user":
+            return f"Doctor: {content}"
+        if role == "patient":
+            return f"Patient: {content}"
+        return None
+
+    def _fold(self, context: dict, cache: dict):
+        notes = context["notes"]
+        summary_total = sum(estimate_tokens(note) for note in notes)
+        # Always keep the latest message verbatim
+        while len(cache["lines"]) > 1 and cache["total"] + summary_total > self.budget_tokens:
+            index, line, tokens = cache["lines"].popleft()
+            cache["total"] -= tokens
+            note = self._note(line)
+            notes.append(note)
+            summary_total += estimate_tokens(note)
+            context["folded_upto"] = index + 1
+
+        while notes and summary_total > self.summary_tokens:
+            # Doctor questions are cheaper to lose than what the patient said
+            drop = next((i for i, note in enumerate(notes) if note.startswith("Doctor")), 0)
+            summary_total -= estimate_tokens(notes.pop(drop))
+
+    def _note(self, line: str) -> str:
+        speaker, _, content = line.partition(": ")
+        first = _SENTENCE_END.split(content.strip(), maxsplit=1)[0]
+        words = first.split()
+        if len(words) > self.note_words:
+            first = " ".join(words[:self.note_words]) + "…"
+        verb = "asked" if speaker == "Doctor" else "said"
+        return f"{speaker} {verb}: {first}"
+
+    def _join(self, context: dict, cache: dict) -> str:
+        recent = "\n".join(line for _, line, _ in cache["lines"])
+        if not context["notes"]:
+            return recent or "No previous conversation."
+        summary = "\n".join(f"- {note}" for note in context["notes"])
+        return f"Summary of earlier conversation:\n{summary}\n\nMost recent messages:\n{recent}"
+
+
+def create_context_window() -> ContextWindow:
+    """Budgets from CONTEXT_TOKEN_BUDGET / CONTEXT_SUMMARY_TOKENS / CONTEXT_MESSAGE_TOKENS"""
+    return ContextWindow(
+        budget_tokens=int(os.environ.get("CONTEXT_TOKEN_BUDGET", 1200)),
+        summary_tokens=int(os.environ.get("CONTEXT_SUMMARY_TOKENS", 300)),
+        message_tokens=int(os.environ.get("CONTEXT_MESSAGE_TOKENS", 300)),
+    )
@@ -0,0 +1,188 @@
+# Intent routing for doctor messages.
+# The vocabulary (treatment terms, "tell me more" terms, negation cues) is
+# compiled once into a single regex, so each message is scanned in one
+# pass. Terms match on word boundaries, and a term shortly after a negation
+# cue ("don't prescribe", "no medication") counts as negated instead of
+# present. The decision is made once per turn, stored in the graph state,
+# and reused by the router and the nodes. Scenarios can ship their own
+# vocabulary as <scenario>.json in INTENT_VOCAB_DIR.
+import json
+import os
+import re
+import threading
+from typing import NamedTuple
+
+DEFAULT_VOCABULARY = {
+    "treatment": [
+        "prescribe*", "prescription*", "medication*", "medicine*", "treatment*", "drug", "drugs",
+        "dose", "doses", "dosage", "tablet", "tablets", "pill", "pills", "capsule", "capsules",
+        "take this", "take these", "take one", "take two", "you should take", "i'd like you to take",
+        "start you on", "put you on",
+    ],
+    "detail": [
+        "more", "detail*", "tell me", "describe", "elaborate", "explain", "go on",
+    ],
+    "negation": [
+        "not", "no", "don't", "do not", "won't", "will not", "never", "without", "nothing",
+        "can't", "cannot", "shouldn't", "avoid", "instead of", "rather than",
+    ],
+}
+
+# Words between a negation cue and a term for the cue to still apply
+NEGATION_SCOPE_WORDS = 4
+
+
+class Intent(NamedTuple):
+    """Routing decision for one doctor message"""
+    matched: frozenset
+    negated: frozenset = frozenset()
+
+    @property
+    def treatment(self) -> bool:
+        return "treatment" in self.matched
+
+    @property
+    def detail(self) -> bool:
+        return "detail" in self.matched
+
+
+def _term_units(term: str) -> list:
+    """'prescri*' matches word prefixes, spaces match any whitespace, ' is optional"""
+    units = []
+    for char in term.strip().lower():
+        if char == "*":
+            units.append(r"\w*")
+        elif char == " ":
+            units.append(r"\s+")
+        elif char == "'":
+            units.append("['’]?")
+        else:
+            units.append(re.escape(char))
+    return units
+
+
+def _trie_pattern(vocabulary: dict) -> tuple[str, dict]:
+    """
+    One alternation of every term, factored by common prefix
+    ("n(?:ever|o(?:t)?)"), so the regex engine rejects a word after its
+    first character or two instead of trying each term in turn. Each term
+    ends in an empty named group; returns the pattern and a map from those
+    group names to the term's kind.
+    """
+    root = {}
+    for kind, terms in vocabulary.items():
+        for term in terms:
+            node = root
+            for unit in _term_units(term):
+                node = node.setdefault(unit, {})
+            node.setdefault("", kind)
+
+    kinds = {}
+
+    def render(node) -> str:
+        branches = [unit + render(child) for unit, child in sorted(node.items()) if unit]
+        if "" in node:
+            # Longer terms are tried first; \b backtracks to this one
+            group = f"_t{len(kinds)}"
+            kinds[group] = node[""]
+            branches.append(f"(?P<{group}>)")
+        return branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+
+    return render(root), kinds
+
+
+class IntentRouter:
+    """Single-pass intent matcher compiled from a vocabulary dict"""
+
+    def __init__(self, vocabulary: dict | None = None, negation_scope: int = NEGATION_SCOPE_WORDS):
+        vocabulary = dict(DEFAULT_VOCABULARY if vocabulary is None else vocabulary)
+        self.negation_scope = negation_scope
+        negation = vocabulary.pop("negation", [])
+        self.intents = [name for name, terms in vocabulary.items() if terms]
+        for name in self.intents:
+            if name.startswith("_"):
+                raise ValueError(f"Invalid intent name: {name!r}")
+
+        # Punctuation and "but" end a clause, and with it any negation
+        terms = {"_neg": negation, "_stop": ["but"]}
+        terms.update((name, vocabulary[name]) for name in self.intents)
+        trie, self._kinds = _trie_pattern(terms)
+        self.pattern = re.compile(r"[.,;!?]|\b" + trie + r"\b")
+        self._bits = {name: 1 << index for index, name in enumerate(self.intents)}
+        self._decisions = {}  # (matched bits, negated bits) -> shared Intent
+
+    def route(self, message: str) -> Intent:
+        matched = negated = 0
+        negation_end = None
+        bits, kinds = self._bits, self._kinds
+        message = message.lower()
+        for match in self.pattern.finditer(message):
+            kind = kinds.get(match.lastgroup, "_stop")
+            if kind == "_stop":
+                # Negation does not cross clause boundaries
+                negation_end = None
+            elif kind == "_neg":
+                negation_end = match.end()
+            elif negation_end is not None and len(message[negation_end:match.start()].split()) <= self.negation_scope:
+                negated |= bits[kind]
+            else:
+                matched |= bits[kind]
+        return self._decision(matched, negated & ~matched)
+
+    def _decision(self, matched: int, negated: int) -> Intent:
+        intent = self._decisions.get((matched, negated))
+        if intent is None:
+            intent = Intent(
+                frozenset(name for name, bit in self._bits.items() if matched & bit),
+                frozenset(name for name, bit in self._bits.items() if negated & bit),
+            )
+            self._decisions[(matched, negated)] = intent
+        return intent
+
+
+def load_vocabulary(path: str) -> dict:
+    """Vocabulary file: {"treatment": [...], "detail": [...], "negation": [...]}"""
+    with open(path) as f:
+        vocabulary = json.load(f)
+    if not isinstance(vocabulary, dict) or not all(isinstance(terms, list) for terms in vocabulary.values()):
+        raise ValueError(f"{path}: expected an object of term lists")
+    return vocabulary
+
+
+DEFAULT_ROUTER = IntentRouter()
+_ROUTERS = {}
+_ROUTERS_LOCK = threading.Lock()
+
+
+def get_router(scenario: str | None = None) -> IntentRouter:
+    """
+    Router for a scenario: compiled from INTENT_VOCAB_DIR/<scenario>.json
+    the first time it is needed, or the default router if there is none.
+    """
+    if not scenario:
+        return DEFAULT_ROUTER
+    router = _ROUTERS.get(scenario)
+    if router is None:
+        with _ROUTERS_LOCK:
+            router = _ROUTERS.get(scenario)
+            if router is None:
+                router = _ROUTERS[scenario] = _load_router(scenario)
+    return router
+
+
+def _load_router(scenario: str) -> IntentRouter:
+    directory = os.environ.get("INTENT_VOCAB_DIR")
+    path = os.path.join(directory, f"{os.path.basename(scenario)}.json") if directory else None
+    if not path or not os.path.exists(path):
+        return DEFAULT_ROUTER
+    try:
+        router = IntentRouter(load_vocabulary(path))
+    except (OSError, ValueError) as e:
+        print(f"[WARNING] Could not load intent vocabulary {path}: {e}; using the default")
+        return DEFAULT_ROUTER
+    print(f"[INFO] Loaded intent vocabulary for scenario {scenario!r}")
+    return router
+
+
+def route_message(message: str, scenario: str | None = None) -> Intent:
+    return get_router(scenario).route(message)
@@ -0,0 +1,218 @@
+# In-process metrics in Prometheus text format, plus optional tracing.
+# Histograms and counters are plain dicts behind a lock (a bisect and two
+# additions per observation), cheap enough to leave on in production.
+# /api/metrics renders them for Prometheus to scrape; each worker process
+# exposes its own numbers. With TRACING_ENABLED=true and the
+# opentelemetry-api package installed, span() opens an OpenTelemetry span;
+# otherwise it costs a single check.
+import bisect
+import contextlib
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() != "false"
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "false").lower() == "true"
+
+# Seconds; covers fast cache hits up to the 20s+ stalls seen on Gemini
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Monotonic counter with labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def total(self) -> float:
+        """Sum over every label combination"""
+        with self._lock:
+            return sum(self._values.values())
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Histogram:
+    """Cumulative-bucket histogram with labels"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 2)
+            row[index] += 1
+            row[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with-block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        row = self._values.get(key)
+        return sum(row[:-1]) if row else 0
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted((key, list(row)) for key, row in self._values.items())
+        lines = []
+        for key, row in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), row[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {row[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_SECONDS = REGISTRY.histogram(
+    "rockfrog_http_request_seconds", "Time spent handling an HTTP request (to first byte for streams)",
+    ("route", "method", "status"),
+)
+NODE_SECONDS = REGISTRY.histogram(
+    "rockfrog_node_seconds", "Time spent in a graph node, prompt building and generation included", ("node",),
+)
+PROMPT_SECONDS = REGISTRY.histogram(
+    "rockfrog_prompt_build_seconds", "Time spent building a node prompt, history formatting included", ("node",),
+)
+GENERATE_SECONDS = REGISTRY.histogram(
+    "rockfrog_generate_response_seconds", "Time spent in generate_response, retries and cache lookups included",
+    ("node",),
+)
+LLM_CALL_SECONDS = REGISTRY.histogram(
+    "rockfrog_llm_call_seconds", "Time spent in _call_gemini_llm_raw, rate-limit waits and fallbacks included",
+    ("node",),
+)
+SDK_CALL_SECONDS = REGISTRY.histogram(
+    "rockfrog_sdk_call_seconds", "Duration of a single Gemini SDK call", ("model", "outcome"),
+)
+TOKENS = REGISTRY.counter(
+    "rockfrog_tokens_total", "Tokens reported by Gemini usage metadata", ("node", "kind"),
+)
+RETRIES = REGISTRY.counter(
+    "rockfrog_retries_total", "Generation attempts retried after a 429", ("node",),
+)
+RATE_LIMITED = REGISTRY.counter(
+    "rockfrog_rate_limited_total", "429 / RESOURCE_EXHAUSTED responses from Gemini", ("model",),
+)
+FAILED_REPLIES = REGISTRY.counter(
+    "rockfrog_failed_replies_total", "Turns answered with a fallback message instead of a model reply",
+    ("node", "reason"),
+)
+STATE_TRANSITIONS = REGISTRY.counter(
+    "rockfrog_state_transitions_total", "Conversation state changes per turn", ("from_state", "to_state"),
+)
+TREATMENT_RESPONSES = REGISTRY.counter(
+    "rockfrog_treatment_responses_total", "Patient replies to a treatment by grade and grading stage",
+    ("label", "source"),
+)
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+_TRACER = None
+
+
+def _tracer():
+    global _TRACER
+    if _TRACER is None:
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            print("[WARNING] TRACING_ENABLED is set but opentelemetry-api is not installed; spans are disabled")
+            _TRACER = False
+        else:
+            _TRACER = trace.get_tracer("rockfrog")
+    return _TRACER
+
+
+def span(name: str, **attributes):
+    """OpenTelemetry span when tracing is enabled, else a no-op context"""
+    if not TRACING_ENABLED:
+        return contextlib.nullcontext()
+    tracer = _tracer()
+    if not tracer:
+        return contextlib.nullcontext()
+    return tracer.start_as_current_span(
+        name, attributes={key: value for key, value in attributes.items() if value is not None}
+    )
@@ -0,0 +1,162 @@
+# Per-model health tracking for request-time fallback and hedging.
+# Each candidate model has a circuit breaker fed by the outcome and latency
+# of real calls. A model that keeps failing is skipped (open) until a
+# cooldown passes, then gets a single trial call (half-open) before it is
+# trusted again; each failed trial doubles the cooldown. Successful-call latencies give a per-model p95, which is
+# how long a hedged call waits before also asking the next healthy model.
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Rolling error rate and latency for one model"""
+
+    def __init__(self, window=50, min_calls=5, error_threshold=0.5, consecutive_failures=3,
+                 cooldown=30.0, max_cooldown=600.0):
+        self.min_calls = min_calls
+        self.error_threshold = error_threshold
+        self.consecutive_failures = consecutive_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = CLOSED
+        self._open_for = cooldown
+        self._outcomes = deque(maxlen=window)   # True for success
+        self._latencies = deque(maxlen=window)  # seconds, successful calls only
+        self._failures_in_row = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may be sent to this model now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self._open_for:
+                self.state = HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def is_available(self) -> bool:
+        """Like allow() but without claiming the half-open trial call"""
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() - self._opened_at >= self._open_for
+            return self.state == CLOSED or not self._trial_in_flight
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self._outcomes.append(True)
+            self._latencies.append(latency)
+            self._failures_in_row = 0
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self._open_for = self.cooldown
+                self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            self._failures_in_row += 1
+            if self.state == HALF_OPEN:
+                # Still broken (e.g. a retired model): back off further
+                self._open_for = min(self._open_for * 2, self.max_cooldown)
+            if self.state == HALF_OPEN or self._should_open():
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+    def record_neutral(self):
+        """The call ended without saying anything about the model (e.g. a 429)"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def p95(self, min_samples: int = 20) -> float | None:
+        with self._lock:
+            if len(self._latencies) < min_samples:
+                return None
+            ordered = sorted(self._latencies)
+            return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = len(self._outcomes)
+            errors = calls - sum(self._outcomes)
+            ordered = sorted(self._latencies)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else None
+        return {
+            "state": self.state,
+            "error_rate": round(errors / calls, 4) if calls else 0.0,
+            "p95_seconds": round(p95, 3) if p95 is not None else None,
+        }
+
+    def _should_open(self) -> bool:
+        if self._failures_in_row >= self.consecutive_failures:
+            return True
+        calls = len(self._outcomes)
+        if calls < self.min_calls:
+            return False
+        return (calls - sum(self._outcomes)) / calls >= self.error_threshold
+
+
+class ModelPool:
+    """Circuit breakers for every candidate model, in fallback order"""
+
+    def __init__(self, candidates, **breaker_options):
+        self.candidates = list(candidates)
+        self.breaker_options = breaker_options
+        self.breakers = {model: CircuitBreaker(**breaker_options) for model in self.candidates}
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.hedges_skipped = 0
+        self.speculative_failures = 0
+        self._lock = threading.Lock()
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            with self._lock:
+                if model not in self.breakers:
+                    # e.g. a GEMINI_MODEL override outside the candidate list
+                    self.breakers[model] = CircuitBreaker(**self.breaker_options)
+                    self.candidates.insert(0, model)
+        return self.breakers[model]
+
+    def healthy_models(self, primary: str) -> list:
+        """primary first, then the other candidates, skipping open circuits"""
+        self.breaker(primary)
+        ordered = [primary] + [model for model in self.candidates if model != primary]
+        return [model for model in ordered if self.breakers[model].is_available()]
+
+    def record_hedge(self, won: bool):
+        """A hedge request was fired; `won` if it answered before the primary"""
+        with self._lock:
+            self.hedges_fired += 1
+            self.hedges_won += int(won)
+
+    def record_hedge_skipped(self):
+        """A hedge was due but there was no spare worker or rate-limit capacity"""
+        with self._lock:
+            self.hedges_skipped += 1
+
+    def record_speculative_failure(self):
+        """A background pre-generation failed; kept out of the breakers so it cannot open a circuit"""
+        with self._lock:
+            self.speculative_failures += 1
+
+    def stats(self) -> dict:
+        return {
+            "models": {model: breaker.stats() for model, breaker in self.breakers.items()},
+            "hedges_fired": self.hedges_fired,
+            "hedges_won": self.hedges_won,
+            "hedges_skipped": self.hedges_skipped,
+            "speculative_failures": self.speculative_failures,
+        }
+
@@ -0,0 +1,155 @@
+# Model resolution for the Gemini client.
+# Probing which model the API key can use costs one network round trip per
+# candidate, so it happens in a background thread at startup and the result
+# is cached on disk where every worker process can reuse it. The request
+# path only ever reads the cached answer.
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, workers may probe twice
+    fcntl = None
+
+
+class ModelResolver:
+    """
+    Resolves and caches the model name to use for generation.
+
+    `probe(model_name)` must return normally when the model is usable and
+    raise otherwise; a stub probe is enough to exercise everything here.
+    """
+
+    def __init__(self, probe, candidates, fallback, cache_path=None, ttl=6 * 3600, revalidate_interval=1800):
+        self.probe = probe
+        self.candidates = list(candidates)
+        self.fallback = fallback
+        self.cache_path = cache_path or os.path.join(tempfile.gettempdir(), "rockfrog_model_cache.json")
+        self.ttl = ttl
+        self.revalidate_interval = revalidate_interval
+        self._model = None
+        self._resolved_at = 0.0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def current(self) -> str:
+        """Model to use right now. Never touches the network."""
+        if self._model is None or self._is_stale(self._resolved_at):
+            # Another worker may have resolved already; look at most once a second
+            now = time.time()
+            if now - self._checked_at > 1.0:
+                self._checked_at = now
+                self._load_cache()
+        return self._model or self.fallback
+
+    def warm_up(self):
+        """Resolve in the background and keep re-validating periodically"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="model-resolver", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def refresh(self, max_age: float | None = None) -> str:
+        """
+        Probe candidates and publish the result to the disk cache. A cache
+        entry younger than max_age (default: the TTL), possibly written by
+        another worker, is reused instead; pass 0 to always probe.
+        """
+        with self._cache_lock():
+            if self._load_cache(max_age):
+                return self._model
+            model = self._probe_candidates()
+            self._model = model
+            self._resolved_at = time.time()
+            self._write_cache()
+            return model
+
+    def _run(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"[WARNING] Model warm-up failed: {e}. Using fallback {self.fallback}.")
+        while not self._stop.wait(self.revalidate_interval):
+            try:
+                # Re-validate: the cached model may have been retired or the
+                # key's quota may have changed. If another worker re-validated
+                # recently, its result is adopted instead of probing again.
+                self.refresh(max_age=self.revalidate_interval)
+            except Exception as e:
+                print(f"[WARNING] Model re-validation failed: {e}. Keeping {self.current()}.")
+
+    def _probe_candidates(self) -> str:
+        for model_name in self.candidates:
+            try:
+                self.probe(model_name)
+                print(f"[INFO] Using model: {model_name}")
+                return model_name
+            except Exception as e:
+                error_msg = str(e)
+                if "404" not in error_msg and "not found" not in error_msg.lower() and "429" not in error_msg:
+                    print(f"[INFO] Using model: {model_name} (test had minor issue, but will try)")
+                    return model_name
+                print(f"[ERROR] Model {model_name} not available: {error_msg[:50]}")
+
+        raise ValueError("No available Gemini models found. Check API key and quota.")
+
+    def _is_stale(self, resolved_at: float, max_age: float | None = None) -> bool:
+        return time.time() - resolved_at > (self.ttl if max_age is None else max_age)
+
+    def _load_cache(self, max_age: float | None = None) -> bool:
+        """Adopt the disk cache if it is fresh; returns True on success"""
+        try:
+            with open(self.cache_path) as f:
+                data = json.load(f)
+            model, resolved_at = data["model"], float(data["resolved_at"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if model not in self.candidates or self._is_stale(resolved_at, max_age):
+            return False
+        self._model, self._resolved_at = model, resolved_at
+        return True
+
+    def _write_cache(self):
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"model": self._model, "resolved_at": self._resolved_at}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"[WARNING] Could not write model cache {self.cache_path}: {e}")
+
+    def _cache_lock(self):
+        return _FileLock(self.cache_path + ".lock")
+
+
+class _FileLock:
+    """Exclusive lock shared by worker processes (no-op without fcntl)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            try:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except OSError:
+                self._fd = None
+        return self
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
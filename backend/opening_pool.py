@@ -0,0 +1,130 @@
+# Speculative opening replies.
+# A session's first turn is almost always a generic greeting ("Hello, what
+# brings you in today?"), and the patient's answer to it depends only on
+# the initial_greeting instruction, which is fixed per profile. The pool
+# keeps a few such replies per instruction, generated in the background
+# ahead of time. A first message that matches GENERIC_GREETING takes one
+# (each reply is served once), which schedules a replacement; anything
+# else, or an empty pool, is generated live as before. A profile whose pool
+# runs dry gets a deeper one, up to a cap. Generation runs on
+# a small thread pool at the lowest rate-limit priority, and failed
+# generations are simply not pooled.
+import re
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Greeting the pooled replies are generated for
+CANONICAL_GREETING = "Hello, what brings you in today?"
+
+_PUNCT = r"[\s,.!?;:\-]*"
+GENERIC_GREETING = re.compile(
+    r"^" + _PUNCT
+    + r"(?:(?:hi|hello|hey|hiya|greetings|welcome|good\s+(?:morning|afternoon|evening|day))(?:\s+there)?" + _PUNCT + r")?"
+    + r"(?:(?:i['’]?m|i\s+am|my\s+name\s+is|this\s+is)\s+"
+    + r"(?:(?:dr\.?|doctor)\s+[a-z'’-]+|(?:the|your)\s+doctor(?:\s+on\s+call)?(?:\s+today)?)" + _PUNCT + r")?"
+    + r"(?:(?:what\s+brings\s+you\s+(?:in|here|to\s+(?:the\s+clinic|see\s+me))"
+    + r"|what\s+can\s+i\s+(?:do\s+for\s+you|help\s+you\s+with)"
+    + r"|how\s+(?:can|may)\s+i\s+help(?:\s+you)?"
+    + r"|how\s+are\s+you(?:\s+(?:feeling|doing))?"
+    + r"|what\s+seems\s+to\s+be\s+the\s+(?:problem|trouble)"
+    + r"|(?:please\s+)?(?:come\s+in|have\s+a\s+seat|take\s+a\s+seat))"
+    + r"(?:\s+today)?" + _PUNCT + r")*$",
+    re.IGNORECASE,
+)
+
+
+def is_generic_greeting(message: str) -> bool:
+    return bool(message.strip()) and GENERIC_GREETING.match(message) is not None
+
+
+class OpeningPool:
+    """
+    Pre-generated replies per initial_greeting instruction: `size` at
+    first, one more after each miss up to `max_size`, for at most
+    `max_profiles` instructions (least recently used dropped).
+    `generate(instruction)` returns a reply or raises.
+    """
+
+    def __init__(self, generate, size: int = 2, max_size: int = 8, max_profiles: int = 256, workers: int = 2):
+        self.generate = generate
+        self.size = size
+        self.max_size = max(max_size, size)
+        self.max_profiles = max_profiles
+        self._pools = OrderedDict()  # instruction -> deque of replies, LRU first
+        self._targets = {}           # instruction -> replies to keep ready
+        self._filling = {}           # instruction -> generations in flight
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="opening-pool")
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.failed = 0
+        self.evicted = 0
+
+    def take(self, instruction: str) -> str | None:
+        """A pooled reply for this instruction, or None; either way the pool is topped up"""
+        with self._lock:
+            replies = self._pools.get(instruction)
+            reply = replies.popleft() if replies else None
+            if reply is None:
+                self.misses += 1
+                if replies is not None:
+                    # Demand outran the pool: keep more ready for this profile
+                    self._targets[instruction] = min(self._targets.get(instruction, self.size) + 1, self.max_size)
+            else:
+                self.hits += 1
+        self.prefetch(instruction)
+        return reply
+
+    def prefetch(self, instruction: str):
+        """Schedule generations until the instruction's pool is (or will be) full"""
+        with self._lock:
+            replies = self._pools.get(instruction)
+            if replies is None:
+                replies = self._pools[instruction] = deque()
+                while len(self._pools) > self.max_profiles:
+                    evicted, _ = self._pools.popitem(last=False)
+                    self._targets.pop(evicted, None)
+                    self._filling.pop(evicted, None)
+                    self.evicted += 1
+            else:
+                self._pools.move_to_end(instruction)
+            missing = self._targets.get(instruction, self.size) - len(replies) - self._filling.get(instruction, 0)
+            if missing <= 0:
+                return
+            self._filling[instruction] = self._filling.get(instruction, 0) + missing
+        for _ in range(missing):
+            self._executor.submit(self._fill, instruction)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "profiles": len(self._pools),
+                "ready": sum(len(replies) for replies in self._pools.values()),
+                "generating": sum(self._filling.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "generated": self.generated,
+                "failed": self.failed,
+                "evicted": self.evicted,
+            }
+
+    def _fill(self, instruction: str):
+        try:
+            reply = self.generate(instruction)
+        except Exception:
+            reply = None
+        with self._lock:
+            if instruction in self._filling:
+                self._filling[instruction] -= 1
+                if not self._filling[instruction]:
+                    del self._filling[instruction]
+            if not reply:
+                self.failed += 1
+                return
+            self.generated += 1
+            replies = self._pools.get(instruction)
+            # Dropped while generating if the profile was evicted
+            if replies is not None and len(replies) < self._targets.get(instruction, self.size):
+                replies.append(reply)
@@ -0,0 +1,116 @@
+# Gemini context caching for the static part of node prompts.
+# Each node prompt is split into a stable prefix (persona + node
+# instructions, identical for every turn of a profile) sent as the system
+# instruction, and a per-turn suffix (history + doctor message). The prefix
+# is registered once as an explicit cached content per model so the model
+# does not re-process it each turn. Gemini rejects caches below a minimum
+# token count, so prefixes estimated below min_tokens are never offered
+# for caching; they go as a plain system instruction, which still lets the
+# API apply implicit prefix caching. Cached contents are created on a
+# background thread: the turn that finds none sends the plain prefix, and
+# later turns use the cache once it exists.
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from conversation_context import estimate_tokens
+
+
+class PromptPrefixCache:
+    """Maps (model, prefix) to a Gemini cached content and tracks cache hits"""
+
+    def __init__(self, ttl_seconds=3600, enabled=True, min_tokens=1024):
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.min_tokens = min_tokens
+        self._entries = {}  # (model, prefix hash) -> (cached content name or None, expires_at)
+        self._creating = set()  # keys with a creation in flight
+        self._lock = threading.Lock()  # bookkeeping only, never held across a network call
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prompt-cache")
+        self._usage = {}    # node -> {"requests", "prompt_tokens", "cached_tokens"}
+        self._usage_lock = threading.Lock()
+
+    def config_for(self, client, model: str, prefix: str) -> dict:
+        """GenerateContentConfig fields that carry the prefix for this call; never waits on the network"""
+        if not self.enabled or estimate_tokens(prefix) < self.min_tokens:
+            return self._config(None, prefix)
+        key = self._key(model, prefix)
+        name = self._lookup(key)
+        if name is False:
+            self._schedule(client, key, model, prefix)
+            name = None
+        return self._config(name, prefix)
+
+    async def aconfig_for(self, client, model: str, prefix: str) -> dict:
+        """asyncio counterpart of config_for (it does not block either)"""
+        return self.config_for(client, model, prefix)
+
+    def record_usage(self, node: str | None, usage_metadata):
+        """Accumulate prompt/cached token counts from a response's usage_metadata"""
+        if usage_metadata is None:
+            return
+        prompt_tokens = getattr(usage_metadata, "prompt_token_count", None) or 0
+        cached_tokens = getattr(usage_metadata, "cached_content_token_count", None) or 0
+        with self._usage_lock:
+            usage = self._usage.setdefault(node or "unknown", {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0})
+            usage["requests"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["cached_tokens"] += cached_tokens
+
+    def stats(self) -> dict:
+        """Per-node cached-token hit ratio (cached / total prompt tokens)"""
+        with self._usage_lock:
+            return {
+                node: dict(usage, hit_ratio=round(usage["cached_tokens"] / usage["prompt_tokens"], 4) if usage["prompt_tokens"] else 0.0)
+                for node, usage in self._usage.items()
+            }
+
+    def _key(self, model: str, prefix: str):
+        return model, hashlib.sha1(prefix.encode()).hexdigest()
+
+    def _lookup(self, key):
+        """Cached content name, None if not cacheable, False if unknown/expired"""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            return False
+        return entry[0]
+
+    def _schedule(self, client, key, model: str, prefix: str):
+        """Create the cached content in the background, once per key"""
+        with self._lock:
+            if key in self._creating:
+                return
+            self._creating.add(key)
+        self._executor.submit(self._create, client, key, model, prefix)
+
+    def _create(self, client, key, model: str, prefix: str):
+        try:
+            try:
+                name = client.caches.create(model=model, config=self._create_config(prefix)).name
+            except Exception as e:
+                name = self._not_cacheable(e)
+            self._store(key, name)
+        finally:
+            with self._lock:
+                self._creating.discard(key)
+
+    def _create_config(self, prefix: str) -> dict:
+        return {"system_instruction": prefix, "ttl": f"{int(self.ttl_seconds)}s"}
+
+    def _not_cacheable(self, error) -> None:
+        # Usually "too few tokens" for short personas; retried after the TTL
+        print(f"[INFO] Prompt prefix not cached explicitly: {str(error)[:120]}")
+        return None
+
+    def _store(self, key, name):
+        # Refresh a little before Gemini expires the cache on its side
+        with self._lock:
+            self._entries[key] = (name, time.time() + self.ttl_seconds * 0.9)
+
+    def _config(self, name, prefix: str) -> dict:
+        if name:
+            return {"cached_content": name}
+        return {"system_instruction": prefix}
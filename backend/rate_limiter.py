@@ -0,0 +1,230 @@
+# Shared rate limiter for Gemini calls.
+# A token bucket for requests/minute and one for tokens/minute sit in front
+# of every SDK call. Callers wait in a priority queue, so turns of
+# conversations already in progress go before the opening turn of new
+# sessions. The effective limits adapt to the quota Gemini actually grants:
+# each 429 halves them and empties the buckets, and each success raises
+# them again by a small step. Requests that would wait too long are shed.
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+PRIORITY_ACTIVE = 0  # turn of a conversation already in progress
+PRIORITY_NEW = 1     # opening turn of a new session
+PRIORITY_BACKGROUND = 2  # speculative work nobody is waiting for
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request is shed instead of queued"""
+
+
+class AdaptiveRateLimiter:
+    """
+    Process-wide limiter. With `redis_url`, the requests/minute budget is
+    also enforced across workers with a per-minute counter in Redis.
+    """
+
+    def __init__(self, rpm=60, tpm=1_000_000, max_wait=30.0, max_wait_new=10.0, max_queue=500,
+                 burst_seconds=10.0, redis_url=None, prefix="rockfrog"):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_wait = max_wait
+        self.max_wait_new = max_wait_new
+        self.max_queue = max_queue
+        self.burst_seconds = burst_seconds
+        self.scale = 1.0  # learned fraction of the configured limits
+        self._requests = self._capacity(rpm)
+        self._tokens = self._capacity(tpm)
+        self._refilled_at = time.monotonic()
+        self._last_decrease = 0.0
+        self._queue = []  # heap of [priority, seq, cancelled]
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.shed = 0
+        self.rate_limited = 0
+        self.redis = None
+        self.prefix = prefix
+        if redis_url:
+            import redis
+
+            self.redis = redis.Redis.from_url(redis_url)
+
+    def acquire(self, tokens: int = 1, priority: int = PRIORITY_ACTIVE):
+        """Block until the call may proceed; raises RateLimitExceeded if shed"""
+        ticket, deadline = self._enqueue(priority)
+        try:
+            while True:
+                with self._cond:
+                    while True:
+                        wait = self._try_take(ticket, tokens, deadline)
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                # Network I/O, so outside the lock
+                if self._take_shared():
+                    return
+                self._requeue(ticket, tokens)
+        except BaseException:
+            self._abandon(ticket)
+            raise
+
+    async def aacquire(self, tokens: int = 1, priority: int = PRIORITY_ACTIVE):
+        """asyncio counterpart of acquire; waits without blocking the loop"""
+        ticket, deadline = self._enqueue(priority)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_take(ticket, tokens, deadline)
+                if wait > 0:
+                    await asyncio.sleep(min(wait, 0.05))
+                    continue
+                if self.redis is None or await asyncio.to_thread(self._take_shared):
+                    return
+                self._requeue(ticket, tokens)
+        except BaseException:
+            # Cancelled (client gone, timeout) or shed: leave the line
+            self._abandon(ticket)
+            raise
+
+    def try_acquire(self, tokens: int = 1) -> bool:
+        """Take capacity only if it is free right now and nobody is queued"""
+        with self._cond:
+            self._refill(time.monotonic())
+            while self._queue and self._queue[0][2]:
+                heapq.heappop(self._queue)
+            if self._queue or self._wait_for(tokens) > 0:
+                return False
+            self._requests -= 1
+            self._tokens -= tokens
+        if self._take_shared():
+            return True
+        self._refund(tokens)
+        return False
+
+    def on_success(self):
+        with self._cond:
+            self.scale = min(1.0, self.scale + 0.02)
+
+    def on_rate_limited(self):
+        """Gemini answered 429: back off the learned limits"""
+        with self._cond:
+            self.rate_limited += 1
+            now = time.monotonic()
+            # Concurrent in-flight calls fail together; count them as one signal
+            if now - self._last_decrease > 2.0:
+                self._last_decrease = now
+                self.scale = max(0.05, self.scale * 0.5)
+            self._requests = min(self._requests, 0.0)
+            self._tokens = min(self._tokens, 0.0)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "effective_rpm": round(self.rpm * self.scale, 2),
+                "effective_tpm": round(self.tpm * self.scale),
+                "queued": sum(1 for entry in self._queue if not entry[2]),
+                "shed": self.shed,
+                "rate_limited": self.rate_limited,
+            }
+
+    def _capacity(self, per_minute: float) -> float:
+        return max(1.0, per_minute / 60.0 * self.burst_seconds)
+
+    def _enqueue(self, priority: int):
+        with self._cond:
+            waiting = sum(1 for entry in self._queue if not entry[2])
+            if waiting >= self.max_queue and priority != PRIORITY_ACTIVE:
+                self.shed += 1
+                raise RateLimitExceeded("Request queue is full")
+            ticket = [priority, next(self._seq), False]
+            heapq.heappush(self._queue, ticket)
+            max_wait = self.max_wait if priority == PRIORITY_ACTIVE else self.max_wait_new
+            return ticket, time.monotonic() + max_wait
+
+    def _abandon(self, ticket):
+        """Drop a waiter's ticket so the ones behind it move up"""
+        with self._cond:
+            ticket[2] = True
+            self._cond.notify_all()
+
+    def _try_take(self, ticket, tokens: int, deadline: float) -> float:
+        """Take capacity if `ticket` is first in line; else seconds to wait. Holds _cond."""
+        now = time.monotonic()
+        self._refill(now)
+        while self._queue and self._queue[0][2]:
+            heapq.heappop(self._queue)
+
+        if self._queue and self._queue[0] is ticket:
+            wait = self._wait_for(tokens)
+            if wait <= 0:
+                # Taken locally; the caller still checks the shared budget
+                heapq.heappop(self._queue)
+                self._requests -= 1
+                self._tokens -= tokens
+                self._cond.notify_all()
+                return 0.0
+            wait = max(wait, 0.05)
+        else:
+            wait = 0.05
+
+        if now + wait > deadline:
+            ticket[2] = True
+            self.shed += 1
+            self._cond.notify_all()
+            raise RateLimitExceeded("Timed out waiting for rate limit capacity")
+        return wait
+
+    def _refill(self, now: float):
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        rpm, tpm = self.rpm * self.scale, self.tpm * self.scale
+        self._requests = min(self._capacity(rpm), self._requests + elapsed * rpm / 60.0)
+        self._tokens = min(self._capacity(tpm), self._tokens + elapsed * tpm / 60.0)
+
+    def _wait_for(self, tokens: int) -> float:
+        rpm, tpm = self.rpm * self.scale, self.tpm * self.scale
+        # A prompt larger than the bucket only needs the bucket to be full
+        tokens = min(tokens, self._capacity(tpm))
+        return max(
+            (1 - self._requests) * 60.0 / rpm if self._requests < 1 else 0.0,
+            (tokens - self._tokens) * 60.0 / tpm if self._tokens < tokens else 0.0,
+        )
+
+    def _refund(self, tokens: int):
+        """Give back capacity taken locally when the shared budget is spent"""
+        with self._cond:
+            self._requests += 1
+            self._tokens += tokens
+            # Budget for this minute is spent; let the local bucket pace retries
+            self._requests = min(self._requests, 0.0)
+            self._cond.notify_all()
+
+    def _requeue(self, ticket, tokens: int):
+        """Back to the head of the line (same priority and seq) after _refund"""
+        with self._cond:
+            self._refund(tokens)
+            heapq.heappush(self._queue, ticket)
+
+    def _take_shared(self) -> bool:
+        """
+        Cross-worker requests/minute check (always true without Redis).
+        Does network I/O: call it without holding _cond. If Redis fails,
+        the local bucket alone decides.
+        """
+        if self.redis is None:
+            return True
+        key = f"{self.prefix}:ratelimit:{int(time.time() // 60)}"
+        try:
+            pipe = self.redis.pipeline()
+            pipe.incr(key)
+            pipe.expire(key, 120)
+            count = pipe.execute()[0]
+            if count <= self.rpm * self.scale:
+                return True
+            self.redis.decr(key)
+            return False
+        except Exception as e:
+            print(f"[WARNING] Shared rate limit check failed, using local limit only: {e}")
+            return True
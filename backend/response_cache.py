@@ -0,0 +1,183 @@
+# Opt-in cache of patient replies for identical prompts.
+# Scripted assessments send many byte-identical prompts (the same opening
+# line to the same profile). Entries are keyed on a hash of the normalized
+# prompt and the model name. Each key holds a small pool of distinct replies:
+# the first `variants` requests for a key are generated live to fill the
+# pool, later ones are served from it at random so trainees don't all read
+# the same sentence. The Redis tier is best effort: an error there counts as
+# a miss or a skipped write, so the cache never decides how a turn ends.
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(text: str) -> str:
+    """Case, punctuation and whitespace differences don't change the reply"""
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", text.lower())).strip()
+
+
+def cache_key(model: str, prompt: str, system_instruction: str | None = None) -> str:
+    normalized = normalize_prompt(f"{system_instruction or ''}\n{prompt}")
+    return hashlib.sha256(f"{model}\x00{normalized}".encode()).hexdigest()
+
+
+class ResponseCache:
+    """LRU memory tier with an optional Redis tier shared by workers"""
+
+    def __init__(self, max_entries=1024, ttl=3600, variants=3, redis_url=None, prefix="rockfrog"):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        self.prefix = prefix
+        self._entries = OrderedDict()  # key -> {"replies": [...], "latency": avg seconds, "expires": ts}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self.redis = self.aredis = None
+        self.redis_errors = 0
+        self._redis_failing = False  # warn once per outage, not per call
+        self._redis_exceptions = ()
+        if redis_url:
+            import redis
+            import redis.asyncio
+
+            self.redis = redis.Redis.from_url(redis_url)
+            self.aredis = redis.asyncio.Redis.from_url(redis_url)
+            # ValueError/KeyError/TypeError: an unreadable stored entry
+            self._redis_exceptions = (redis.RedisError, OSError, ValueError, KeyError, TypeError)
+
+    def get(self, key: str) -> str | None:
+        """A cached reply once the key's variant pool is full, else None"""
+        entry = self._memory_get(key)
+        if entry is None and self.redis is not None:
+            try:
+                entry = self._redis_get(self.redis.get(self._redis_key(key)))
+            except self._redis_exceptions as e:
+                self._redis_error("read", e)
+            else:
+                self._redis_ok()
+                entry = self._adopt(key, entry)
+        return self._serve(entry)
+
+    async def aget(self, key: str) -> str | None:
+        entry = self._memory_get(key)
+        if entry is None and self.aredis is not None:
+            try:
+                entry = self._redis_get(await self.aredis.get(self._redis_key(key)))
+            except self._redis_exceptions as e:
+                self._redis_error("read", e)
+            else:
+                self._redis_ok()
+                entry = self._adopt(key, entry)
+        return self._serve(entry)
+
+    def put(self, key: str, reply: str, latency: float):
+        """Add a freshly generated reply (and its latency) to the key's pool"""
+        entry = self._memory_put(key, reply, latency)
+        if self.redis is not None and entry is not None:
+            try:
+                self.redis.set(self._redis_key(key), self._redis_value(entry), ex=self.ttl)
+            except self._redis_exceptions as e:
+                self._redis_error("write", e)
+            else:
+                self._redis_ok()
+
+    async def aput(self, key: str, reply: str, latency: float):
+        entry = self._memory_put(key, reply, latency)
+        if self.aredis is not None and entry is not None:
+            try:
+                await self.aredis.set(self._redis_key(key), self._redis_value(entry), ex=self.ttl)
+            except self._redis_exceptions as e:
+                self._redis_error("write", e)
+            else:
+                self._redis_ok()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "latency_saved_seconds": round(self.latency_saved, 3),
+            "redis_errors": self.redis_errors,
+        }
+
+    def _redis_error(self, action: str, error: Exception):
+        with self._lock:
+            self.redis_errors += 1
+            first = not self._redis_failing
+            self._redis_failing = True
+        if first:
+            print(f"[WARNING] Response cache Redis {action} failed, using the memory tier only: {error}")
+
+    def _redis_ok(self):
+        if self._redis_failing:
+            self._redis_failing = False
+            print("[INFO] Response cache Redis tier is reachable again")
+
+    def _memory_get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires"] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _memory_put(self, key: str, reply: str, latency: float):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["expires"] <= time.time():
+                entry = {"replies": [], "latency": 0.0, "expires": time.time() + self.ttl}
+                self._entries[key] = entry
+            if len(entry["replies"]) >= self.variants or reply in entry["replies"]:
+                return None
+            count = len(entry["replies"])
+            entry["latency"] = (entry["latency"] * count + latency) / (count + 1)
+            entry["replies"].append(reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return entry
+
+    def _serve(self, entry) -> str | None:
+        with self._lock:
+            if entry is None or len(entry["replies"]) < self.variants:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.latency_saved += entry["latency"]
+            return random.choice(entry["replies"])
+
+    def _adopt(self, key: str, entry):
+        """Copy an entry found in Redis into the memory tier"""
+        if entry is None:
+            return None
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def _redis_key(self, key: str) -> str:
+        return f"{self.prefix}:rcache:{key}"
+
+    def _redis_value(self, entry) -> str:
+        return json.dumps({"replies": entry["replies"], "latency": entry["latency"]})
+
+    def _redis_get(self, data):
+        if data is None:
+            return None
+        value = json.loads(data)
+        # Redis enforces the TTL; the memory copy gets a fresh one
+        return {"replies": value["replies"], "latency": value["latency"], "expires": time.time() + self.ttl}
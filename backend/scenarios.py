@@ -0,0 +1,285 @@
+# Patient scenarios.
+# A scenario is a case: the patient profile, the underlying condition, the
+# symptoms the patient can reveal at each symptom_level and the treatments
+# they would accept. Scenarios are JSON files in SCENARIO_DIR, one object
+# (or a list of objects) per file, for example
+#
+#   {"id": "migraine-01", "condition": "migraine with aura",
+#    "profile": {"patient_name": "Sam", "age": 52, "med_history": "hypertension"},
+#    "symptoms": ["headache", "throbbing, one-sided, light hurts", "zigzag lights 20 minutes before"],
+#    "acceptable_treatments": ["sumatriptan", "ibuprofen"]}
+#
+# Every node instruction (the cacheable prompt prefix) of every scenario and
+# symptom level is rendered once when its file is loaded, so a turn only
+# looks its instruction up by scenario id. The directory is re-scanned every
+# SCENARIO_RELOAD_INTERVAL seconds; changed files are re-rendered and
+# swapped in without a restart. The built-in "default" scenario is the
+# original "Alex, 35" patient.
+import glob
+import json
+import os
+import random
+import threading
+import time
+
+DEFAULT_PROFILE = {
+    "patient_name": "Alex",
+    "age": 35,
+    "med_history": "no known chronic diseases",
+}
+
+# Highest symptom_level a conversation reaches (0=mild, 1=moderate, 2=detailed)
+MAX_SYMPTOM_LEVEL = 2
+
+PROFILE_TEMPLATE = """You are a simulated patient. Your patient profile:
+- Name: {patient_name}
+- Age: {age}
+- MedicalHistory: {med_history}"""
+
+CONDITION_TEMPLATE = """
+- Condition: {condition} (you have not been diagnosed; never name it yourself)"""
+
+SYMPTOMS_TEMPLATE = """
+- Symptoms you can describe: {symptoms}
+Do not mention any other symptoms yet."""
+
+NODE_TEMPLATES = {
+    "initial_greeting": """
+
+You are starting a conversation with a doctor. Introduce yourself briefly and mention only MILD symptoms. Keep it short and natural.""",
+    "questioning": """
+
+You are answering the doctor's questions. Be concise and factual. If asked about symptoms, reveal a bit more detail than before, but still keep it moderate.""",
+    "progressive_revelation": """
+
+The doctor is asking for more details. Reveal MORE detailed symptoms now. Be more specific about:
+- When symptoms started
+- Severity and frequency
+- Any triggers or patterns
+- Impact on daily life""",
+    "treatment": """
+
+The doctor has prescribed a treatment. Evaluate if it's reasonable for your condition:
+- If reasonable: Accept it clearly by saying "I accept the treatment: [treatment name]"
+- If unclear: Ask clarifying questions
+- If unreasonable: Politely express concern""",
+}
+
+TREATMENTS_TEMPLATE = """
+Treatments you would consider reasonable: {treatments}."""
+
+
+class Scenario:
+    """One case, with its node instructions pre-rendered per symptom level"""
+
+    __slots__ = ("id", "profile", "condition", "symptoms", "acceptable_treatments", "_session_profile", "_instructions")
+
+    def __init__(self, scenario_id: str, profile: dict | None = None, condition: str = "",
+                 symptoms=(), acceptable_treatments=()):
+        self.id = scenario_id
+        self.profile = dict(DEFAULT_PROFILE, **(profile or {}))
+        self.condition = condition
+        self.symptoms = tuple(symptoms)[:MAX_SYMPTOM_LEVEL + 1]
+        self.acceptable_treatments = tuple(acceptable_treatments)
+        self._session_profile = dict(self.profile, scenario=self.id)
+        # node -> instruction per symptom level
+        self._instructions = {node: self._prerender(node) for node in NODE_TEMPLATES}
+
+    def new_profile(self) -> dict:
+        """Profile for a new session; "scenario" ties the session back to this case"""
+        return dict(self._session_profile)
+
+    def instruction(self, node: str, level: int, profile: dict | None = None) -> str:
+        """
+        The node's instruction at a symptom level. Pre-rendered unless the
+        session's profile was edited after creation (e.g. batch overrides).
+        """
+        level = min(max(level, 0), MAX_SYMPTOM_LEVEL)
+        if profile is None or profile == self._session_profile:
+            return self._instructions[node][level]
+        return self.render(node, level, profile)
+
+    def render(self, node: str, level: int, profile: dict) -> str:
+        text = PROFILE_TEMPLATE.format_map(profile)
+        if self.condition:
+            text += CONDITION_TEMPLATE.format(condition=self.condition)
+        if self.symptoms:
+            text += SYMPTOMS_TEMPLATE.format(symptoms="; ".join(self.symptoms[:level + 1]))
+        text += NODE_TEMPLATES[node]
+        if node == "treatment" and self.acceptable_treatments:
+            text += TREATMENTS_TEMPLATE.format(treatments=", ".join(self.acceptable_treatments))
+        return text
+
+    def _prerender(self, node: str) -> tuple:
+        rendered = []
+        for level in range(MAX_SYMPTOM_LEVEL + 1):
+            if level and level >= len(self.symptoms):
+                # Nothing new to reveal at this level: share the previous string
+                rendered.append(rendered[-1])
+            else:
+                rendered.append(self.render(node, level, self.profile))
+        return tuple(rendered)
+
+    def summary(self) -> dict:
+        """What a client may see before the consultation (no condition or symptoms)"""
+        return {"id": self.id, "patient_name": self.profile["patient_name"], "age": self.profile["age"]}
+
+
+DEFAULT_SCENARIO = Scenario("default")
+
+
+class UnknownScenario(KeyError):
+    """No scenario with this id is loaded"""
+
+    def __init__(self, scenario_id: str):
+        super().__init__(scenario_id)
+        self.scenario_id = scenario_id
+
+    def __str__(self) -> str:
+        return f"Unknown scenario: {self.scenario_id}"
+
+
+def parse_scenario(data: dict, fallback_id: str) -> Scenario:
+    if not isinstance(data, dict):
+        raise ValueError("expected a scenario object")
+    profile = data.get("profile") or {}
+    symptoms = data.get("symptoms") or []
+    treatments = data.get("acceptable_treatments") or []
+    if not isinstance(profile, dict) or not isinstance(symptoms, list) or not isinstance(treatments, list):
+        raise ValueError("profile must be an object; symptoms and acceptable_treatments lists")
+    return Scenario(
+        str(data.get("id") or fallback_id),
+        profile=profile,
+        condition=str(data.get("condition") or ""),
+        # a level may list several symptoms
+        symptoms=["; ".join(s) if isinstance(s, list) else str(s) for s in symptoms],
+        acceptable_treatments=[str(t) for t in treatments],
+    )
+
+
+def load_scenario_file(path: str) -> list:
+    """Scenarios in one file (an object, or a list of objects)"""
+    with open(path) as f:
+        data = json.load(f)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if isinstance(data, list):
+        return [parse_scenario(item, f"{stem}-{number}") for number, item in enumerate(data, 1)]
+    return [parse_scenario(data, stem)]
+
+
+class ScenarioRegistry:
+    """
+    Scenarios by id. Lookups read a dict that is replaced, never mutated, on
+    reload, so they take no lock.
+    """
+
+    def __init__(self, directory: str | None = None, default: str = "default", reload_interval: float = 5.0):
+        self.directory = directory
+        self.default = default
+        self._files = {}  # path -> (mtime, [Scenario])
+        self._failed = {}  # path -> mtime of a version that did not load
+        self._index = {DEFAULT_SCENARIO.id: DEFAULT_SCENARIO}
+        self._ids = ()    # loaded scenario ids, for random picks
+        self._lock = threading.Lock()
+        self.reloads = 0
+        if directory:
+            self.reload()
+            if reload_interval:
+                thread = threading.Thread(target=self._reload_loop, args=(reload_interval,), name="scenario-reload", daemon=True)
+                thread.start()
+
+    def get(self, scenario_id: str | None) -> Scenario | None:
+        return self._index.get(scenario_id or DEFAULT_SCENARIO.id)
+
+    def for_profile(self, profile: dict) -> Scenario:
+        """A session's scenario; the default if its file has since been removed"""
+        return self._index.get(profile.get("scenario")) or DEFAULT_SCENARIO
+
+    def pick(self, scenario_id: str | None = None) -> Scenario:
+        """
+        Scenario for a new session: by id, "random", or the configured
+        default. Raises UnknownScenario (a KeyError) for an unknown id.
+        """
+        scenario_id = scenario_id or self.default
+        if scenario_id == "random":
+            ids = self._ids
+            return self._index[random.choice(ids)] if ids else DEFAULT_SCENARIO
+        scenario = self._index.get(scenario_id)
+        if scenario is None:
+            raise UnknownScenario(scenario_id)
+        return scenario
+
+    def summaries(self) -> list:
+        return [scenario.summary() for scenario in self._index.values()]
+
+    def stats(self) -> dict:
+        return {"scenarios": len(self._index), "files": len(self._files), "reloads": self.reloads}
+
+    def reload(self) -> bool:
+        """Re-read new and changed files and drop removed ones; True if anything changed"""
+        with self._lock:
+            paths = set(glob.glob(os.path.join(self.directory, "*.json")))
+            changed = False
+            for path in list(self._files):
+                if path not in paths:
+                    del self._files[path]
+                    changed = True
+            for path in sorted(paths):
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                if (path in self._files and self._files[path][0] == mtime) or self._failed.get(path) == mtime:
+                    continue
+                try:
+                    self._files[path] = (mtime, load_scenario_file(path))
+                except (OSError, ValueError) as e:
+                    # Keep serving the previous version until the file is fixed
+                    self._failed[path] = mtime
+                    print(f"[WARNING] Could not load scenario file {path}: {e}")
+                    continue
+                self._failed.pop(path, None)
+                changed = True
+            if changed:
+                self._rebuild()
+            return changed
+
+    def _rebuild(self):
+        index = {DEFAULT_SCENARIO.id: DEFAULT_SCENARIO}
+        loaded = []
+        for path in sorted(self._files):
+            for scenario in self._files[path][1]:
+                if scenario.id in index and scenario.id != DEFAULT_SCENARIO.id:
+                    print(f"[WARNING] Duplicate scenario id {scenario.id!r} in {path}; keeping the first")
+                    continue
+                index[scenario.id] = scenario
+                loaded.append(scenario.id)
+        self._index, self._ids = index, tuple(loaded)
+        self.reloads += 1
+        print(f"[INFO] Loaded {len(loaded)} scenarios from {self.directory}")
+
+    def _reload_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"[WARNING] Scenario reload failed: {e}")
+
+
+def create_scenario_registry() -> ScenarioRegistry:
+    """
+    Scenarios from SCENARIO_DIR when set; otherwise only the default patient.
+    Raises ValueError at startup if DEFAULT_SCENARIO is not one of them.
+    """
+    registry = ScenarioRegistry(
+        os.environ.get("SCENARIO_DIR"),
+        default=os.environ.get("DEFAULT_SCENARIO", "default"),
+        reload_interval=float(os.environ.get("SCENARIO_RELOAD_INTERVAL", 5)),
+    )
+    if registry.default != "random" and registry.get(registry.default) is None:
+        raise ValueError(
+            f"DEFAULT_SCENARIO {registry.default!r} is not a loaded scenario "
+            f"(SCENARIO_DIR={registry.directory!r}); use an id from there, 'default' or 'random'"
+        )
+    return registry
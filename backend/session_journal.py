@@ -0,0 +1,458 @@
+# Durable, append-only session journal.
+# Every create and every turn appends one JSON line to a segment file in
+# JOURNAL_DIR: the session's state fields plus only the messages added
+# since its previous line. A background thread writes the queued lines in
+# batches and fsyncs once per batch, so turns never wait on the disk. Each
+# process start opens a new segment; nothing is rewritten in place, and a
+# torn last line from a crash is skipped on read. A batch that fails to
+# write marks its sessions for a resync: their next line carries the whole
+# retained history again, and replay merges lines by message id.
+# Sessions missing from the live store are rebuilt from their lines on
+# first access, so a restarted worker picks up where the old one stopped.
+# Earlier segments are indexed by a background thread at startup, reading
+# only the [session_id, timestamp prefix of each line; sessions idle for
+# longer than the session TTL drop out of the index. With a retention
+# period, startup also deletes earlier segments whose newest line is older
+# than that, unless their writer is still running (each writer holds a
+# shared flock on its segment).
+# The same files give a bulk export of every transcript:
+#
+#   python session_journal.py export [--dir DIR] > transcripts.jsonl
+import argparse
+import asyncio
+import atexit
+import contextlib
+import glob
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import transcript
+from session_store import SessionStore, decode_session, serialize_session
+
+try:
+    import fcntl
+except ImportError:  # Windows: no way to tell a live segment, so none are removed
+    fcntl = None
+
+# `["<session id>", <timestamp>,` at the start of every line (see _write)
+_LINE_PREFIX = re.compile(rb'\["((?:[^"\\]|\\.)*)", (-?[0-9][0-9.eE+-]*),')
+
+
+def _session_id(raw: bytes) -> str:
+    # json.dumps escapes anything outside printable ASCII
+    return json.loads(b'"' + raw + b'"') if b"\\" in raw else raw.decode()
+
+
+def _snapshot(session: dict, messages: list) -> dict:
+    """Copy of the fields a journal line needs, safe to encode on another thread"""
+    context = session.get("conversation_context") or {"folded_upto": 0, "notes": []}
+    return {
+        "profile": session["profile"],
+        "conversation_history": messages,
+        "current_state": session.get("current_state", "initial"),
+        "symptom_level": session.get("symptom_level", 0),
+        "treatment_detected": session.get("treatment_detected", False),
+        "treatment_accepted": session.get("treatment_accepted", False),
+        "conversation_context": {"folded_upto": context["folded_upto"], "notes": list(context["notes"])},
+    }
+
+
+def replay(payloads, max_messages: int | None = transcript.MAX_MESSAGES) -> dict | None:
+    """
+    Rebuild a session from its journal lines (oldest first). The history
+    keeps the newest max_messages messages, or all of them with None.
+    """
+    session = None
+    messages = {}
+    for payload in payloads:
+        session = decode_session(payload)
+        # By id, not "after the newest so far": a resync line re-sends older messages
+        for msg in session["conversation_history"]:
+            messages.setdefault(msg["id"], msg)
+    if session is None:
+        return None
+    history = transcript.commit([messages[message_id] for message_id in sorted(messages)], max_messages)
+    if history and transcript.last_id(history) != history[-1]["id"]:
+        # Lines lost before they could be resynced: renumber so ids stay
+        # contiguous, keeping the newest message's id
+        print(f"[WARNING] Journal is missing messages of a session; renumbering {len(history)} messages")
+        start = history[-1]["id"] - len(history) + 1
+        for offset, msg in enumerate(history):
+            msg["id"] = start + offset
+    session["conversation_history"] = history
+    return session
+
+
+class SessionJournal:
+    """
+    Write-behind JSONL journal with a per-session index. With `ttl`,
+    sessions with no line for that many seconds are dropped from the index;
+    with `retention`, earlier segments with no line for that many seconds
+    are deleted at startup.
+    """
+
+    def __init__(self, directory: str, flush_interval: float = 0.2, fsync: bool = True, ttl: float | None = None,
+                 retention: float | None = None):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.ttl = ttl
+        self.retention = retention
+        stamp = time.strftime("%Y%m%dT%H%M%S")
+        self.path = os.path.join(directory, f"journal-{stamp}-{os.getpid()}.jsonl")
+        self._file = None  # this process's segment, opened on first write
+        self._queue = queue.Queue()
+        # session_id -> [newest line's timestamp, [(path, offset), ...] in write order],
+        # least recently written first
+        self._index = OrderedDict()
+        self._pending = {}  # session_id -> lines queued but not yet written
+        self._resync = set()  # sessions whose lines were lost in a failed write
+        self._scanned = threading.Event()
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self.records = 0
+        self.batches = 0
+        self.write_errors = 0
+        self.segments_removed = 0
+        self._writer = threading.Thread(target=self._write_loop, name="session-journal", daemon=True)
+        self._writer.start()
+        # File I/O without _lock, so writers never wait on it
+        threading.Thread(target=self._scan, name="session-journal-scan", daemon=True).start()
+        atexit.register(self.flush)
+
+    def append(self, session_id: str, session: dict, messages: list):
+        """Queue one line; returns immediately"""
+        with self._lock:
+            self._pending[session_id] = self._pending.get(session_id, 0) + 1
+        self._queue.put((session_id, time.time(), _snapshot(session, messages)))
+
+    def flush(self):
+        """Block until every queued line is on disk"""
+        self._queue.join()
+
+    def needs_resync(self, session_id: str) -> bool:
+        """True once after a write of this session's lines failed"""
+        with self._lock:
+            if session_id in self._resync:
+                self._resync.discard(session_id)
+                return True
+            return False
+
+    def load(self, session_id: str) -> dict | None:
+        """Rebuild a session from the journal, or None if it has no lines"""
+        self._scanned.wait()
+        with self._lock:
+            # Its latest lines may still be queued
+            self._written.wait_for(lambda: session_id not in self._pending)
+            entry = self._index.get(session_id)
+            locations = list(entry[1]) if entry else []
+        return replay(payload for _, payload in self._read(locations)) if locations else None
+
+    def session_ids(self) -> list:
+        self._scanned.wait()
+        with self._lock:
+            return list(self._index)
+
+    def export(self):
+        """Yield every journaled session with its full transcript"""
+        self.flush()
+        for session_id in self.session_ids():
+            with self._lock:
+                entry = self._index.get(session_id)
+                locations = list(entry[1]) if entry else []
+            records = list(self._read(locations))
+            if not records:
+                continue
+            session = replay((payload for _, payload in records), max_messages=None)
+            history = session["conversation_history"]
+            yield {
+                "session_id": session_id,
+                "updated_at": records[-1][0],
+                "profile": session["profile"],
+                "current_state": session["current_state"],
+                "symptom_level": session["symptom_level"],
+                "treatment_detected": session["treatment_detected"],
+                "treatment_accepted": session["treatment_accepted"],
+                "messages": [
+                    dict(entry, failed=True) if msg.get("failed") else entry
+                    for msg, entry in zip(history, transcript.log_entries(history))
+                ],
+            }
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "indexed_sessions": len(self._index),
+            "queued": self._queue.qsize(),
+            "records": self.records,
+            "batches": self.batches,
+            "write_errors": self.write_errors,
+            "segments_removed": self.segments_removed,
+        }
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            # Group commit: take whatever queues up within flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                self.write_errors += 1
+                print(f"[WARNING] Session journal write failed, {len(batch)} records lost: {e}")
+                with self._lock:
+                    self._resync.update(session_id for session_id, _, _ in batch)
+            finally:
+                with self._lock:
+                    for session_id, _, _ in batch:
+                        self._pending[session_id] -= 1
+                        if not self._pending[session_id]:
+                            del self._pending[session_id]
+                    self._written.notify_all()
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch: list):
+        lines = []
+        for session_id, at, session in batch:
+            prefix = json.dumps([session_id, round(at, 3)])[:-1].encode()
+            lines.append((session_id, prefix + b"," + serialize_session(session) + b"]\n"))
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(self.path, "ab")
+            if fcntl is not None:
+                # Held until exit: tells other processes' retention the segment is live
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_SH)
+        offset = self._file.tell()
+        self._file.write(b"".join(line for _, line in lines))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        with self._lock:
+            for (session_id, line), (_, at, _) in zip(lines, batch):
+                entry = self._index.pop(session_id, None) or [at, []]
+                entry[0] = at
+                entry[1].append((self.path, offset))
+                self._index[session_id] = entry
+                offset += len(line)
+            self._expire()
+        self.records += len(batch)
+        self.batches += 1
+
+    def _scan(self):
+        """Index the segments left by earlier processes (once, at startup)"""
+        earlier = {}
+        newest = {}  # path -> timestamp of its newest line
+        try:
+            for path in sorted(glob.glob(os.path.join(self.directory, "journal-*.jsonl"))):
+                if path == self.path:
+                    continue
+                offset = 0
+                with open(path, "rb") as f:
+                    for line in f:
+                        match = _LINE_PREFIX.match(line)
+                        if match is None or not line.endswith(b"]\n"):
+                            # A torn line from a crash mid-write
+                            print(f"[WARNING] Skipping unreadable journal line in {path} at byte {offset}")
+                        else:
+                            session_id, at = _session_id(match.group(1)), float(match.group(2))
+                            entry = earlier.setdefault(session_id, [at, []])
+                            entry[0] = at
+                            entry[1].append((path, offset))
+                            newest[path] = max(newest.get(path, at), at)
+                        offset += len(line)
+        except OSError as e:
+            print(f"[WARNING] Could not index earlier journal segments: {e}")
+        removed = self._remove_segments(newest)
+        if removed:
+            for session_id in list(earlier):
+                entry = earlier[session_id]
+                entry[1] = [location for location in entry[1] if location[0] not in removed]
+                if not entry[1]:
+                    del earlier[session_id]
+        with self._lock:
+            # Lines of this process come after everything from earlier segments
+            for session_id, (at, locations) in self._index.items():
+                entry = earlier.setdefault(session_id, [at, []])
+                entry[0] = at
+                entry[1].extend(locations)
+            self._index = OrderedDict(sorted(earlier.items(), key=lambda item: item[1][0]))
+            self._expire()
+            indexed = len(self._index)
+        self._scanned.set()
+        if earlier:
+            print(f"[INFO] Indexed session journal: {indexed} sessions")
+
+    def _remove_segments(self, newest: dict) -> set:
+        """Delete earlier segments past retention whose writer has exited; returns their paths"""
+        if not self.retention or fcntl is None:
+            return set()
+        cutoff = time.time() - self.retention
+        removed = set()
+        for path, at in newest.items():
+            if at >= cutoff:
+                continue
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                # Fails while the writing process still holds its shared lock
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(path)
+                removed.add(path)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+        if removed:
+            self.segments_removed += len(removed)
+            print(f"[INFO] Removed {len(removed)} journal segments past retention")
+        return removed
+
+    def _expire(self):
+        """Drop sessions idle for longer than ttl (oldest first). Holds _lock."""
+        if not self.ttl:
+            return
+        cutoff = time.time() - self.ttl
+        while self._index:
+            session_id, (at, _) = next(iter(self._index.items()))
+            if at >= cutoff:
+                break
+            del self._index[session_id]
+
+    def _read(self, locations: list):
+        """(timestamp, session payload) for each indexed line"""
+        files = {}
+        try:
+            for path, offset in locations:
+                if path not in files:
+                    try:
+                        files[path] = open(path, "rb")
+                    except FileNotFoundError:
+                        # Removed by another process's retention since it was indexed
+                        files[path] = None
+                f = files[path]
+                if f is None:
+                    continue
+                f.seek(offset)
+                try:
+                    _, at, payload = json.loads(f.readline())
+                except ValueError:
+                    continue
+                yield at, payload
+        finally:
+            for f in files.values():
+                if f is not None:
+                    f.close()
+
+
+class JournaledSessionStore(SessionStore):
+    """
+    Wraps a session store with a SessionJournal: writes go to both (the
+    journal in the background), and sessions the wrapped store does not
+    have are rehydrated from the journal.
+    """
+
+    def __init__(self, store: SessionStore, journal: SessionJournal):
+        self.store = store
+        self.journal = journal
+        # session_id -> (newest message id already queued, time), least recently journaled first
+        self._journaled = OrderedDict()
+        self._lock = threading.Lock()
+        self.rehydrated = 0
+
+    def load(self, session_id: str) -> dict | None:
+        session = self.store.load(session_id)
+        if session is None:
+            session = self._rehydrate(session_id)
+            if session is not None:
+                self.store.create(session_id, session)
+        return session
+
+    def create(self, session_id: str, session: dict):
+        self.store.create(session_id, session)
+        self._journal(session_id, session)
+
+    def save_turn(self, session_id: str, session: dict):
+        self.store.save_turn(session_id, session)
+        self._journal(session_id, session)
+
+    def stats(self) -> dict:
+        return dict(self.store.stats(), rehydrated=self.rehydrated, journal=self.journal.stats())
+
+    async def aload(self, session_id: str) -> dict | None:
+        session = await self.store.aload(session_id)
+        if session is None:
+            session = await asyncio.to_thread(self._rehydrate, session_id)
+            if session is not None:
+                await self.store.acreate(session_id, session)
+        return session
+
+    async def acreate(self, session_id: str, session: dict):
+        await self.store.acreate(session_id, session)
+        self._journal(session_id, session)
+
+    async def asave_turn(self, session_id: str, session: dict):
+        await self.store.asave_turn(session_id, session)
+        self._journal(session_id, session)
+
+    def _journal(self, session_id: str, session: dict):
+        history = session["conversation_history"]
+        now = time.monotonic()
+        with self._lock:
+            done = self._journaled.pop(session_id, (0, now))[0]
+            if self.journal.needs_resync(session_id):
+                done = 0
+            self._remember(session_id, transcript.last_id(history), now)
+        start = max(done - transcript.first_id(history) + 1, 0)
+        self.journal.append(session_id, session, history[start:])
+
+    def _rehydrate(self, session_id: str) -> dict | None:
+        session = self.journal.load(session_id)
+        if session is not None:
+            with self._lock:
+                self._journaled.pop(session_id, None)
+                self._remember(session_id, transcript.last_id(session["conversation_history"]), time.monotonic())
+            self.rehydrated += 1
+            print(f"[INFO] Rehydrated session from journal: {session_id}")
+        return session
+
+    def _remember(self, session_id: str, newest_id: int, now: float):
+        """Holds _lock. A forgotten session just re-sends its retained history once."""
+        self._journaled[session_id] = (newest_id, now)
+        if self.journal.ttl:
+            while self._journaled:
+                oldest, (_, at) = next(iter(self._journaled.items()))
+                if now - at <= self.journal.ttl:
+                    break
+                del self._journaled[oldest]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session journal tools")
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--dir", default=os.environ.get("JOURNAL_DIR"), help="journal directory (default: JOURNAL_DIR)")
+    args = parser.parse_args()
+    if not args.dir:
+        parser.error("--dir or JOURNAL_DIR is required")
+    out = sys.stdout
+    # Keep progress messages out of the exported JSONL
+    with contextlib.redirect_stdout(sys.stderr):
+        for record in SessionJournal(args.dir).export():
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+# Session storage for patient conversations.
+# The in-memory store keeps live session dicts in this process (dev, single
+# worker). The Redis store keeps a compact serialized copy of each session
+# so any worker can pick up any conversation. A session's transcript is its
+# conversation_history (see transcript.py); it is not stored separately.
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import transcript
+
+# Compact encodings for the PatientState fields that change every turn
+STATE_CODES = {"initial": 0, "questioning": 1, "progressive": 2, "treatment": 3}
+STATE_NAMES = {code: name for name, code in STATE_CODES.items()}
+ROLE_CODES = {"user": 0, "patient": 1}
+ROLE_NAMES = {code: name for name, code in ROLE_CODES.items()}
+SERIAL_VERSION = 1
+
+
+def serialize_session(session: dict) -> bytes:
+    """
+    Encode a session as a compact JSON array:
+    [version, profile, state, symptom_level, flags, [[role, content], ...],
+     [folded_upto, summary_notes], first_message_id]
+    where flags bit 0 is treatment_detected and bit 1 is treatment_accepted.
+    Messages of failed turns are [role, content, 1]; message ids are
+    consecutive from first_message_id. The trailing context and id elements
+    are optional when decoding.
+    """
+    flags = (1 if session.get("treatment_detected") else 0) | (2 if session.get("treatment_accepted") else 0)
+    messages = session.get("conversation_history", [])
+    history = [
+        [ROLE_CODES.get(msg.get("role"), 0), msg.get("content", "")] + ([1] if msg.get("failed") else [])
+        for msg in messages
+    ]
+    payload = [
+        SERIAL_VERSION,
+        session["profile"],
+        STATE_CODES.get(session.get("current_state", "initial"), 0),
+        session.get("symptom_level", 0),
+        flags,
+        history,
+    ]
+    context = session.get("conversation_context")
+    first_id = messages[0].get("id", 1) if messages else 1
+    if context or first_id > 1:
+        context = context or {"folded_upto": 0, "notes": []}
+        payload.append([context["folded_upto"], context["notes"]])
+    if first_id > 1:
+        payload.append(first_id)
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def deserialize_session(data: bytes) -> dict:
+    """Inverse of serialize_session"""
+    return decode_session(json.loads(data))
+
+
+def decode_session(payload: list) -> dict:
+    """deserialize_session for an already parsed JSON array"""
+    version, profile, state, symptom_level, flags, history, *rest = payload
+    if version != SERIAL_VERSION:
+        raise ValueError(f"Unsupported session encoding version: {version}")
+    folded_upto, notes = rest[0] if rest else (0, [])
+    first_id = rest[1] if len(rest) > 1 else 1
+    messages = []
+    for index, (role, content, *failed) in enumerate(history):
+        msg = {"role": ROLE_NAMES[role], "content": content, "id": first_id + index}
+        if failed:
+            msg["failed"] = True
+        messages.append(msg)
+    return {
+        "profile": profile,
+        "conversation_history": messages,
+        "current_state": STATE_NAMES[state],
+        "symptom_level": symptom_level,
+        "treatment_detected": bool(flags & 1),
+        "treatment_accepted": bool(flags & 2),
+        "conversation_context": {"folded_upto": folded_upto, "notes": notes},
+    }
+
+
+class SessionStore:
+    """
+    Interface for session storage. A turn is one load() and one save_turn();
+    implementations should make each a single round trip to their backend.
+    The async methods default to the sync ones for stores that never block.
+    """
+
+    def load(self, session_id: str) -> dict | None:
+        """Return the session, or None if it does not exist"""
+        raise NotImplementedError
+
+    def create(self, session_id: str, session: dict):
+        """Store a brand new session"""
+        raise NotImplementedError
+
+    def save_turn(self, session_id: str, session: dict):
+        """Persist the session after a turn"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Counters reported by /api/health"""
+        return {}
+
+    async def aload(self, session_id: str) -> dict | None:
+        return self.load(session_id)
+
+    async def acreate(self, session_id: str, session: dict):
+        self.create(session_id, session)
+
+    async def asave_turn(self, session_id: str, session: dict):
+        self.save_turn(session_id, session)
+
+
+# Approximate encoded bytes of one message beyond its text ([role, "..."],)
+MESSAGE_OVERHEAD = 8
+
+
+class _Footprint:
+    """
+    Running approximate size of one session. Messages are measured once,
+    when first saved, and subtracted when the transcript drops them, so a
+    save costs the new messages rather than the whole transcript.
+    """
+
+    __slots__ = ("first_id", "message_sizes", "message_bytes", "total")
+
+    def __init__(self):
+        self.first_id = 1
+        self.message_sizes = deque()  # bytes per message, oldest (first_id) first
+        self.message_bytes = 0
+        self.total = 0
+
+    def update(self, session: dict) -> int:
+        """Re-measure after a save; returns the change in total"""
+        history = session.get("conversation_history", [])
+        first = history[0].get("id", 1) if history else 1
+        measured_upto = self.first_id + len(self.message_sizes)  # next id not yet measured
+        if first < self.first_id or measured_upto > first + len(history):
+            # A different transcript (e.g. recreated): start over
+            self.message_sizes.clear()
+            self.message_bytes = 0
+            self.first_id = measured_upto = first
+        while self.message_sizes and self.first_id < first:
+            self.message_bytes -= self.message_sizes.popleft()
+            self.first_id += 1
+        if not self.message_sizes:
+            self.first_id = measured_upto = max(measured_upto, first)
+        for msg in history[measured_upto - first:]:
+            size = len(msg.get("content", "")) + MESSAGE_OVERHEAD
+            self.message_sizes.append(size)
+            self.message_bytes += size
+        context = session.get("conversation_context") or {}
+        fixed = len(json.dumps(session["profile"], ensure_ascii=False)) + 32
+        fixed += sum(len(note) + 3 for note in context.get("notes", ()))
+        total = fixed + self.message_bytes
+        change, self.total = total - self.total, total
+        return change
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    Process-local store; sessions are live dicts mutated in place.
+
+    Sessions idle for longer than `idle_ttl` seconds are dropped, and when
+    there are more than `max_sessions` sessions or their approximate size
+    exceeds `memory_budget` bytes the least recently used ones are evicted.
+    A background thread sweeps every `sweep_interval` seconds; a limit of
+    None disables it.
+    """
+
+    def __init__(self, idle_ttl=None, max_sessions=None, memory_budget=None, sweep_interval=60):
+        self.sessions = OrderedDict()  # session_id -> session dict, LRU first
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.memory_budget = memory_budget
+        self._last_access = {}  # session_id -> monotonic time
+        self._sizes = {}        # session_id -> _Footprint
+        self._total_size = 0
+        self._lock = threading.Lock()
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+        self.evicted_memory = 0
+        if idle_ttl or max_sessions or memory_budget:
+            thread = threading.Thread(target=self._sweep_loop, args=(sweep_interval,), name="session-sweeper", daemon=True)
+            thread.start()
+
+    def load(self, session_id: str) -> dict | None:
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            if self._is_idle(session_id, time.monotonic()):
+                self._evict(session_id)
+                self.evicted_idle += 1
+                return None
+            self._touch(session_id)
+            return session
+
+    def create(self, session_id: str, session: dict):
+        with self._lock:
+            self.sessions[session_id] = session
+            self._touch(session_id)
+            self._forget_size(session_id)
+            self._resize(session_id)
+            self._enforce_limits()
+
+    def save_turn(self, session_id: str, session: dict):
+        with self._lock:
+            self.sessions[session_id] = session
+            self._touch(session_id)
+            self._resize(session_id)
+            self._enforce_limits()
+
+    def sweep(self):
+        """Drop idle sessions and enforce the size limits"""
+        with self._lock:
+            if self.idle_ttl:
+                now = time.monotonic()
+                for session_id in list(self.sessions):
+                    if not self._is_idle(session_id, now):
+                        # Ordered by last access: everything after is newer
+                        break
+                    self._evict(session_id)
+                    self.evicted_idle += 1
+            self._enforce_limits()
+
+    def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "sessions": len(self.sessions),
+            "approx_bytes": self._total_size,
+            "evicted_idle": self.evicted_idle,
+            "evicted_lru": self.evicted_lru,
+            "evicted_memory": self.evicted_memory,
+        }
+
+    def _sweep_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"[WARNING] Session sweep failed: {e}")
+
+    def _is_idle(self, session_id: str, now: float) -> bool:
+        return bool(self.idle_ttl) and now - self._last_access.get(session_id, now) > self.idle_ttl
+
+    def _touch(self, session_id: str):
+        self.sessions.move_to_end(session_id)
+        self._last_access[session_id] = time.monotonic()
+
+    def _resize(self, session_id: str):
+        # Approximate encoded size, a stable proxy for the live objects' footprint
+        footprint = self._sizes.get(session_id)
+        if footprint is None:
+            footprint = self._sizes[session_id] = _Footprint()
+        self._total_size += footprint.update(self.sessions[session_id])
+
+    def _forget_size(self, session_id: str):
+        footprint = self._sizes.pop(session_id, None)
+        if footprint is not None:
+            self._total_size -= footprint.total
+
+    def _enforce_limits(self):
+        while self.max_sessions and len(self.sessions) > self.max_sessions:
+            self._evict(next(iter(self.sessions)))
+            self.evicted_lru += 1
+        while self.memory_budget and self._total_size > self.memory_budget and len(self.sessions) > 1:
+            self._evict(next(iter(self.sessions)))
+            self.evicted_memory += 1
+
+    def _evict(self, session_id: str):
+        self.sessions.pop(session_id, None)
+        self._last_access.pop(session_id, None)
+        self._forget_size(session_id)
+
+
+# Key of a loaded session dict holding the id of the newest message it was
+# loaded with; not serialized
+LOADED_ID = "_loaded_id"
+
+
+def merge_turn(stored: dict, session: dict) -> dict:
+    """
+    `session` with its messages newer than session[LOADED_ID] appended after
+    the messages of `stored` (saved meanwhile by another worker) instead of
+    replacing them; the other fields stay as `session` has them. Updates
+    and returns `session`.
+    """
+    loaded_id = session.get(LOADED_ID, 0)
+    ours = [
+        {key: value for key, value in msg.items() if key != "id"}
+        for msg in session["conversation_history"]
+        if msg.get("id", 0) > loaded_id
+    ]
+    session["conversation_history"] = transcript.commit(list(stored["conversation_history"]) + ours)
+    return session
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis-backed store shared by all workers. Each session is one string key
+    holding serialize_session() output, transcript included; it expires
+    after `ttl` seconds without activity. Turns are only serialized within
+    a worker, so save_turn is a compare-and-set (WATCH/MULTI) on the newest
+    message id: a turn that raced one saved by another worker is merged
+    after it rather than overwriting it.
+    """
+
+    # Compare-and-set attempts before a save gives up
+    SAVE_ATTEMPTS = 8
+
+    def __init__(self, url: str, ttl: int = 86400, prefix: str = "rockfrog"):
+        import redis
+        import redis.asyncio
+
+        self.redis = redis.Redis.from_url(url)
+        self.aredis = redis.asyncio.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.merged_turns = 0
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}:session:{session_id}"
+
+    def load(self, session_id: str) -> dict | None:
+        return self._decode(self.redis.get(self._key(session_id)))
+
+    def create(self, session_id: str, session: dict):
+        self.redis.set(self._key(session_id), serialize_session(session), ex=self.ttl)
+        session[LOADED_ID] = transcript.last_id(session["conversation_history"])
+
+    def save_turn(self, session_id: str, session: dict):
+        import redis
+
+        key = self._key(session_id)
+        with self.redis.pipeline() as pipe:
+            for _ in range(self.SAVE_ATTEMPTS):
+                try:
+                    pipe.watch(key)
+                    self._reconcile(session_id, pipe.get(key), session)
+                    pipe.multi()
+                    pipe.set(key, serialize_session(session), ex=self.ttl)
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+            else:
+                raise RuntimeError(f"Session {session_id} kept changing while its turn was saved")
+        session[LOADED_ID] = transcript.last_id(session["conversation_history"])
+
+    def stats(self) -> dict:
+        # Redis expires idle sessions itself (see ttl)
+        return {"backend": "redis", "ttl": self.ttl, "merged_turns": self.merged_turns}
+
+    async def aload(self, session_id: str) -> dict | None:
+        return self._decode(await self.aredis.get(self._key(session_id)))
+
+    async def acreate(self, session_id: str, session: dict):
+        await self.aredis.set(self._key(session_id), serialize_session(session), ex=self.ttl)
+        session[LOADED_ID] = transcript.last_id(session["conversation_history"])
+
+    async def asave_turn(self, session_id: str, session: dict):
+        import redis
+
+        key = self._key(session_id)
+        async with self.aredis.pipeline() as pipe:
+            for _ in range(self.SAVE_ATTEMPTS):
+                try:
+                    await pipe.watch(key)
+                    self._reconcile(session_id, await pipe.get(key), session)
+                    pipe.multi()
+                    pipe.set(key, serialize_session(session), ex=self.ttl)
+                    await pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+            else:
+                raise RuntimeError(f"Session {session_id} kept changing while its turn was saved")
+        session[LOADED_ID] = transcript.last_id(session["conversation_history"])
+
+    def _decode(self, data: bytes | None) -> dict | None:
+        if data is None:
+            return None
+        session = deserialize_session(data)
+        session[LOADED_ID] = transcript.last_id(session["conversation_history"])
+        return session
+
+    def _reconcile(self, session_id: str, data: bytes | None, session: dict):
+        """Merge session onto the stored copy if another worker saved a turn since it was loaded"""
+        if data is None or LOADED_ID not in session:
+            return
+        stored = deserialize_session(data)
+        if transcript.last_id(stored["conversation_history"]) != session[LOADED_ID]:
+            merge_turn(stored, session)
+            session[LOADED_ID] = transcript.last_id(stored["conversation_history"])
+            self.merged_turns += 1
+            print(f"[WARNING] Session {session_id} was saved by another worker during this turn; merged")
+
+
+def create_session_store() -> SessionStore:
+    """
+    Redis store when REDIS_URL is set, otherwise in-memory; journaled to
+    JOURNAL_DIR when that is set (see session_journal.py)
+    """
+    redis_url = os.environ.get("REDIS_URL")
+    if redis_url:
+        print("[INFO] Using Redis session store")
+        store = RedisSessionStore(redis_url, ttl=int(os.environ.get("SESSION_TTL", 86400)))
+    else:
+        print("[INFO] Using in-memory session store")
+        budget_mb = float(os.environ.get("SESSION_MEMORY_BUDGET_MB", 0))
+        store = InMemorySessionStore(
+            idle_ttl=float(os.environ.get("SESSION_TTL", 86400)),
+            max_sessions=int(os.environ.get("SESSION_MAX", 10000)),
+            memory_budget=int(budget_mb * 1024 * 1024) or None,
+            sweep_interval=float(os.environ.get("SESSION_SWEEP_INTERVAL", 60)),
+        )
+
+    journal_dir = os.environ.get("JOURNAL_DIR")
+    if journal_dir:
+        from session_journal import JournaledSessionStore, SessionJournal
+
+        print(f"[INFO] Journaling sessions to {journal_dir}")
+        ttl = float(os.environ.get("SESSION_TTL", 86400))
+        # 0 keeps every segment; never shorter than the TTL, or live sessions would lose lines
+        retention = float(os.environ.get("JOURNAL_RETENTION", 30 * 86400))
+        journal = SessionJournal(
+            journal_dir,
+            flush_interval=float(os.environ.get("JOURNAL_FLUSH_INTERVAL", 0.2)),
+            fsync=os.environ.get("JOURNAL_FSYNC", "true").lower() != "false",
+            ttl=ttl,
+            retention=max(retention, ttl) if retention else None,
+        )
+        store = JournaledSessionStore(store, journal)
+    return store
@@ -0,0 +1,131 @@
+# Per-session turn serialization.
+# A turn loads the session, runs the graph and saves the result; two turns
+# of the same session running at once would both read the same history and
+# one of them would be lost. Every turn therefore runs inside
+# SessionTurnQueue.turn() (threads) or .aturn() (asyncio): turns of one
+# session run one at a time in arrival order, turns of different sessions
+# never wait on each other. The queue of a session exists only while it has
+# a turn running or waiting, and threads and event-loop tasks share it, so
+# Flask and the native ASGI routes stay ordered in the same process.
+# Sessions shared by several worker processes (REDIS_URL) are only
+# serialized within each worker; across workers RedisSessionStore.save_turn
+# merges a turn that raced another instead of overwriting it.
+import asyncio
+import contextlib
+import threading
+from collections import deque
+
+
+class TurnQueueFull(Exception):
+    """Raised when a session already has max_depth turns waiting"""
+
+
+class _Waiter:
+    __slots__ = ("event", "loop", "future", "granted")
+
+    def __init__(self, loop=None, future=None):
+        self.event = None if future else threading.Event()
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+    def wake(self):
+        self.granted = True
+        if self.future is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _SessionQueue:
+    __slots__ = ("busy", "waiters")
+
+    def __init__(self):
+        self.busy = False
+        self.waiters = deque()
+
+
+class SessionTurnQueue:
+    """FIFO turn queues keyed by session id, created and dropped on demand"""
+
+    def __init__(self, max_depth: int = 16):
+        self.max_depth = max_depth
+        self._queues = {}  # session_id -> _SessionQueue, only while in use
+        self._lock = threading.Lock()  # held for bookkeeping only, never across a turn
+        self.waited = 0
+        self.rejected = 0
+
+    @contextlib.contextmanager
+    def turn(self, session_id: str):
+        """Run the body as the session's only turn; blocks while others go first"""
+        waiter = self._enqueue(session_id)
+        if waiter is not None:
+            waiter.event.wait()
+        try:
+            yield
+        finally:
+            self._release(session_id)
+
+    @contextlib.asynccontextmanager
+    async def aturn(self, session_id: str):
+        """asyncio counterpart of turn(); waiting does not block the event loop"""
+        loop = asyncio.get_running_loop()
+        waiter = self._enqueue(session_id, loop)
+        if waiter is not None:
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                self._abandon(session_id, waiter)
+                raise
+        try:
+            yield
+        finally:
+            self._release(session_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "active_sessions": len(self._queues),
+                "waiting": sum(len(queue.waiters) for queue in self._queues.values()),
+                "waited": self.waited,
+                "rejected": self.rejected,
+            }
+
+    def _enqueue(self, session_id: str, loop=None) -> _Waiter | None:
+        """None if the turn may start now, else the waiter to block on"""
+        with self._lock:
+            queue = self._queues.get(session_id)
+            if queue is None:
+                queue = self._queues[session_id] = _SessionQueue()
+            if not queue.busy:
+                queue.busy = True
+                return None
+            if len(queue.waiters) >= self.max_depth:
+                self.rejected += 1
+                raise TurnQueueFull(f"Too many messages waiting for session {session_id}")
+            waiter = _Waiter(loop, loop.create_future()) if loop else _Waiter()
+            queue.waiters.append(waiter)
+            self.waited += 1
+            return waiter
+
+    def _release(self, session_id: str):
+        with self._lock:
+            queue = self._queues[session_id]
+            if queue.waiters:
+                # Hand the turn straight to the next in line
+                queue.waiters.popleft().wake()
+            else:
+                del self._queues[session_id]
+
+    def _abandon(self, session_id: str, waiter: _Waiter):
+        """A waiting task was cancelled: leave the line, or pass on a turn already handed to it"""
+        with self._lock:
+            if not waiter.granted:
+                self._queues[session_id].waiters.remove(waiter)
+                return
+        self._release(session_id)
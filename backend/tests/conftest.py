@@ -0,0 +1,7 @@
+# Backend modules are flat files in backend/; make them importable from tests/.
+#
+#   cd backend && python -m pytest tests
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import tempfile
+import time
+import types
+
+import pytest
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+os.environ.setdefault("MODEL_CACHE_PATH", os.path.join(tempfile.mkdtemp(prefix="rockfrog-test-"), "models.json"))
+os.environ.setdefault("WARM_UP_ENABLED", "false")
+
+import agent_logic_langgraph as agent  # noqa: E402
+from model_health import ModelPool  # noqa: E402
+from rate_limiter import AdaptiveRateLimiter  # noqa: E402
+
+
+class StubModels:
+    """Answers after a per-model delay; honours the SDK's http_options timeout (ms)"""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.calls = []
+
+    def _plan(self, model, config):
+        timeout = ((config or {}).get("http_options") or {}).get("timeout")
+        self.calls.append((model, timeout))
+        delay = self.delays[model]
+        if timeout is not None and timeout / 1000 < delay:
+            return timeout / 1000, TimeoutError("Read timed out")
+        return delay, None
+
+    def generate_content(self, model, contents, config=None):
+        delay, error = self._plan(model, config)
+        time.sleep(delay)
+        if error:
+            raise error
+        return types.SimpleNamespace(text=f"{model} says hi", usage_metadata=None)
+
+
+class StubAsyncModels(StubModels):
+    async def generate_content(self, model, contents, config=None):
+        delay, error = self._plan(model, config)
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return types.SimpleNamespace(text=f"{model} says hi", usage_metadata=None)
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """Fake client with two models; the primary's hedge delay is 0.2s"""
+    def install(primary_delay, backup_delay=0.05):
+        delays = {"primary": primary_delay, "backup": backup_delay}
+        client = types.SimpleNamespace(models=StubModels(delays), aio=types.SimpleNamespace(models=StubAsyncModels(delays)))
+        monkeypatch.setattr(agent, "client", client)
+        monkeypatch.setattr(agent, "USE_NEW_CLIENT", True)
+        monkeypatch.setattr(agent, "MODEL_POOL", ModelPool(["primary", "backup"]))
+        monkeypatch.setattr(agent, "RATE_LIMITER", AdaptiveRateLimiter(rpm=1e6, tpm=1e9))
+        monkeypatch.setattr(agent, "_hedge_delay", lambda model_name: 0.2)
+        return client
+    return install
+
+
+def _timed(call):
+    started = time.monotonic()
+    return call(), time.monotonic() - started
+
+
+def test_fast_primary_is_not_hedged(gemini):
+    client = gemini(primary_delay=0.05)
+    result, elapsed = _timed(lambda: agent._call_hedged("primary", ["backup"], "hi", None, "questioning", 10))
+    assert result == "primary says hi"
+    assert [model for model, _ in client.models.calls] == ["primary"]
+    assert agent.MODEL_POOL.stats()["hedges_fired"] == 0
+
+
+def test_stalled_blocking_primary_is_abandoned_for_the_backup(gemini):
+    client = gemini(primary_delay=5.0)
+    result, elapsed = _timed(lambda: agent._call_hedged("primary", ["backup"], "hi", None, "questioning", 10))
+    assert result == "backup says hi"
+    assert elapsed < 1.0
+    assert client.models.calls == [("primary", 200), ("backup", None)]
+    stats = agent.MODEL_POOL.stats()
+    assert (stats["hedges_fired"], stats["hedges_won"]) == (1, 1)
+    # Giving up on a slow call is not a failure of the model
+    assert stats["models"]["primary"]["error_rate"] == 0.0
+
+
+def test_no_hedge_without_a_healthy_backup(gemini):
+    client = gemini(primary_delay=0.3)
+    breaker = agent.MODEL_POOL.breaker("backup")
+    for _ in range(10):
+        breaker.record_failure()
+    result, _ = _timed(lambda: agent._call_hedged("primary", ["backup"], "hi", None, "questioning", 10))
+    assert result == "primary says hi"
+    assert client.models.calls == [("primary", None)]
+
+
+def test_async_path_returns_whichever_answers_first(gemini):
+    client = gemini(primary_delay=1.0)
+    result, elapsed = _timed(lambda: asyncio.run(
+        agent._acall_hedged("primary", ["backup"], "hi", None, "questioning", 10)
+    ))
+    assert result == "backup says hi"
+    assert elapsed < 0.8
+    assert [model for model, _ in client.aio.models.calls] == ["primary", "backup"]
+    assert agent.MODEL_POOL.stats()["hedges_won"] == 1
+
+
+def test_async_fast_primary_is_not_hedged(gemini):
+    client = gemini(primary_delay=0.05)
+    result = asyncio.run(agent._acall_hedged("primary", ["backup"], "hi", None, "questioning", 10))
+    assert result == "primary says hi"
+    assert [model for model, _ in client.aio.models.calls] == ["primary"]
@@ -0,0 +1,134 @@
+import threading
+import time
+
+import pytest
+
+import model_resolver
+from model_resolver import ModelResolver
+
+CANDIDATES = ["model-a", "model-b", "model-c"]
+
+
+class StubProbe:
+    """Counts probes; models in `missing` answer 404, every probe takes `delay`"""
+
+    def __init__(self, missing=(), delay=0.0):
+        self.missing = set(missing)
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, model_name):
+        with self._lock:
+            self.calls.append(model_name)
+        time.sleep(self.delay)
+        if model_name in self.missing:
+            raise RuntimeError(f"404 {model_name} is not found")
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "models.json")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Wall clock of model_resolver, advanced by hand"""
+    now = [1_000_000.0]
+    monkeypatch.setattr(model_resolver.time, "time", lambda: now[0])
+    return now
+
+
+def _resolver(probe, cache_path, **options):
+    return ModelResolver(probe, CANDIDATES, fallback="fallback-model", cache_path=cache_path, **options)
+
+
+def test_fallback_until_resolved_then_first_usable_candidate(cache_path):
+    probe = StubProbe(missing={"model-a"})
+    resolver = _resolver(probe, cache_path)
+    assert resolver.current() == "fallback-model"
+    assert resolver.refresh() == "model-b"
+    assert resolver.current() == "model-b"
+    assert probe.calls == ["model-a", "model-b"]
+
+
+def test_no_usable_candidate_raises_and_keeps_the_fallback(cache_path):
+    resolver = _resolver(StubProbe(missing=CANDIDATES), cache_path)
+    with pytest.raises(ValueError):
+        resolver.refresh()
+    assert resolver.current() == "fallback-model"
+
+
+def test_another_worker_adopts_the_disk_cache_without_probing(cache_path):
+    _resolver(StubProbe(missing={"model-a"}), cache_path).refresh()
+    probe = StubProbe()
+    other = _resolver(probe, cache_path)
+    assert other.current() == "model-b"
+    assert other.refresh() == "model-b"
+    assert probe.calls == []
+
+
+def test_cache_naming_a_model_outside_the_candidates_is_ignored(cache_path):
+    ModelResolver(StubProbe(), ["retired-model"], fallback="x", cache_path=cache_path).refresh()
+    probe = StubProbe()
+    assert _resolver(probe, cache_path).refresh() == "model-a"
+    assert probe.calls == ["model-a"]
+
+
+def test_ttl_expiry_probes_again(cache_path, clock):
+    probe = StubProbe()
+    resolver = _resolver(probe, cache_path, ttl=100)
+    resolver.refresh()
+    clock[0] += 50
+    resolver.refresh()
+    assert probe.calls == ["model-a"]
+    clock[0] += 51
+    probe.missing.add("model-a")
+    # Stale: current() keeps the last answer rather than dropping to the fallback
+    assert resolver.current() == "model-a"
+    assert resolver.refresh() == "model-b"
+    assert probe.calls == ["model-a", "model-a", "model-b"]
+
+
+def test_revalidation_adopts_a_recent_result_and_probes_an_older_one(cache_path, clock):
+    first = _resolver(StubProbe(), cache_path, revalidate_interval=30)
+    first.refresh()
+    probe = StubProbe(missing={"model-a"})
+    second = _resolver(probe, cache_path, revalidate_interval=30)
+    clock[0] += 10
+    # Another worker re-validated 10s ago: adopt it
+    assert second.refresh(max_age=30) == "model-a"
+    assert probe.calls == []
+    clock[0] += 25
+    assert second.refresh(max_age=30) == "model-b"
+    assert probe.calls == ["model-a", "model-b"]
+    # ...and the first worker picks up the re-validated answer from disk
+    assert first.refresh(max_age=30) == "model-b"
+
+
+def test_background_warm_up_resolves_and_revalidates(cache_path):
+    probe = StubProbe()
+    resolver = _resolver(probe, cache_path, revalidate_interval=0.05)
+    resolver.warm_up()
+    try:
+        deadline = time.monotonic() + 5
+        while len(probe.calls) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        resolver.stop()
+    assert resolver.current() == "model-a"
+    assert len(probe.calls) >= 3
+
+
+@pytest.mark.skipif(model_resolver.fcntl is None, reason="needs fcntl")
+def test_concurrent_workers_probe_once_under_the_file_lock(cache_path):
+    probe = StubProbe(delay=0.2)
+    resolvers = [_resolver(probe, cache_path) for _ in range(4)]
+    results = []
+    threads = [threading.Thread(target=lambda r=r: results.append(r.refresh())) for r in resolvers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["model-a"] * 4
+    assert probe.calls == ["model-a"]
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+import time
+
+import fakeredis
+import pytest
+import redis
+
+from rate_limiter import PRIORITY_ACTIVE, PRIORITY_NEW, AdaptiveRateLimiter, RateLimitExceeded
+
+
+def _limiter(**options):
+    # One request in the bucket, refilled every 0.25s
+    options.setdefault("rpm", 240)
+    options.setdefault("burst_seconds", 0.25)
+    return AdaptiveRateLimiter(**options)
+
+
+def test_burst_then_paced():
+    limiter = _limiter()
+    started = time.monotonic()
+    limiter.acquire()
+    assert not limiter.try_acquire()
+    limiter.acquire()
+    assert time.monotonic() - started >= 0.2
+
+
+def test_active_turns_go_before_new_sessions():
+    limiter = _limiter()
+    limiter.acquire()
+    order = []
+
+    def waiter(name, priority):
+        limiter.acquire(priority=priority)
+        order.append(name)
+
+    new = threading.Thread(target=waiter, args=("new", PRIORITY_NEW))
+    new.start()
+    time.sleep(0.05)
+    active = threading.Thread(target=waiter, args=("active", PRIORITY_ACTIVE))
+    active.start()
+    new.join()
+    active.join()
+    assert order == ["active", "new"]
+
+
+def test_waiters_past_their_deadline_are_shed():
+    limiter = _limiter(rpm=6, burst_seconds=10, max_wait_new=0.1)
+    limiter.acquire()
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(priority=PRIORITY_NEW)
+    assert limiter.stats()["shed"] == 1
+
+
+def test_full_queue_sheds_new_sessions_but_not_active_turns():
+    limiter = _limiter(max_queue=1)
+    limiter.acquire()
+    blocked = threading.Thread(target=limiter.acquire)
+    blocked.start()
+    time.sleep(0.05)
+    with pytest.raises(RateLimitExceeded, match="queue is full"):
+        limiter.acquire(priority=PRIORITY_NEW)
+    # An active turn still queues, behind the one already waiting
+    limiter.acquire(priority=PRIORITY_ACTIVE)
+    blocked.join()
+    assert limiter.stats()["shed"] == 1
+
+
+def test_429_halves_the_limits_and_successes_restore_them():
+    limiter = _limiter(rpm=100)
+    limiter.on_rate_limited()
+    assert limiter.stats()["effective_rpm"] == 50
+    assert not limiter.try_acquire()
+    for _ in range(25):
+        limiter.on_success()
+    assert limiter.stats()["effective_rpm"] == 100
+
+
+def test_cancelled_waiter_does_not_hold_up_the_line():
+    limiter = _limiter(rpm=60, burst_seconds=1)
+
+    async def scenario():
+        await limiter.aacquire()
+        first = asyncio.create_task(limiter.aacquire())
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(limiter.aacquire())
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.wait_for(second, 2)
+
+    asyncio.run(scenario())
+    assert limiter.stats()["queued"] == 0
+
+
+def test_shared_budget_across_workers(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", lambda url: fakeredis.FakeRedis(server=server))
+    # Each worker's own bucket would allow 3 requests; the shared minute allows 4 in total
+    workers = [_limiter(rpm=4, burst_seconds=45, redis_url="redis://test") for _ in range(2)]
+    granted = [worker.try_acquire() for worker in workers for _ in range(3)]
+    assert granted.count(True) == 4
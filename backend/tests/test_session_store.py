@@ -0,0 +1,124 @@
+import asyncio
+
+import fakeredis
+import pytest
+import redis
+import redis.asyncio
+
+import transcript
+from session_store import LOADED_ID, RedisSessionStore
+
+
+def _session(*texts):
+    history = [{"role": "user" if index % 2 == 0 else "patient", "content": text} for index, text in enumerate(texts)]
+    return {
+        "profile": {"name": "Alex", "scenario": "default"},
+        "conversation_history": transcript.commit(history),
+        "current_state": "initial",
+        "symptom_level": 0,
+        "treatment_detected": False,
+        "treatment_accepted": False,
+        "conversation_context": {"folded_upto": 0, "notes": []},
+    }
+
+
+def _turn(session, doctor, patient, state="questioning"):
+    session["conversation_history"].append({"role": "user", "content": doctor})
+    session["conversation_history"].append({"role": "patient", "content": patient})
+    session["conversation_history"] = transcript.commit(session["conversation_history"])
+    session["current_state"] = state
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    """Two RedisSessionStores, as in two worker processes, sharing one fake server"""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url", lambda url: fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(redis.asyncio.Redis, "from_url", lambda url: fakeredis.FakeAsyncRedis(server=server))
+    return RedisSessionStore("redis://test", ttl=60), RedisSessionStore("redis://test", ttl=60)
+
+
+def _contents(session):
+    return [(msg["id"], msg["content"]) for msg in session["conversation_history"]]
+
+
+def test_round_trip_and_ttl(workers):
+    store, _ = workers
+    store.create("s1", _session("hello", "hi doctor"))
+    loaded = store.load("s1")
+    assert _contents(loaded) == [(1, "hello"), (2, "hi doctor")]
+    assert loaded[LOADED_ID] == 2
+    assert 0 < store.redis.ttl(store._key("s1")) <= 60
+    assert store.load("missing") is None
+
+
+def test_sequential_turns_are_saved_in_place(workers):
+    store, _ = workers
+    store.create("s1", _session())
+    session = store.load("s1")
+    _turn(session, "what brings you in?", "my head hurts")
+    store.save_turn("s1", session)
+    session = store.load("s1")
+    _turn(session, "since when?", "two days")
+    store.save_turn("s1", session)
+    assert [text for _, text in _contents(store.load("s1"))] == [
+        "what brings you in?", "my head hurts", "since when?", "two days",
+    ]
+    assert store.merged_turns == 0
+
+
+def test_concurrent_turns_in_two_workers_are_both_kept(workers):
+    first, second = workers
+    first.create("s1", _session("hello", "hi doctor"))
+    # Both workers load the same state, then each saves a turn
+    a, b = first.load("s1"), second.load("s1")
+    _turn(a, "any fever?", "no", state="questioning")
+    _turn(b, "I prescribe rest", "I accept the treatment", state="treatment")
+    first.save_turn("s1", a)
+    second.save_turn("s1", b)
+
+    stored = first.load("s1")
+    assert _contents(stored) == [
+        (1, "hello"), (2, "hi doctor"), (3, "any fever?"), (4, "no"),
+        (5, "I prescribe rest"), (6, "I accept the treatment"),
+    ]
+    # The later save's state fields win, and its caller sees the merged transcript
+    assert stored["current_state"] == "treatment"
+    assert _contents(b) == _contents(stored)
+    assert b[LOADED_ID] == 6
+    assert second.merged_turns == 1
+
+
+def test_save_retries_when_the_key_changes_during_the_save(workers, monkeypatch):
+    first, second = workers
+    first.create("s1", _session())
+    a, b = first.load("s1"), second.load("s1")
+    _turn(b, "sneaky", "turn")
+    reconcile = first._reconcile
+
+    def racing_reconcile(session_id, data, session):
+        # Another worker saves between WATCH and EXEC, once
+        monkeypatch.setattr(first, "_reconcile", reconcile)
+        second.save_turn("s1", b)
+        reconcile(session_id, data, session)
+
+    monkeypatch.setattr(first, "_reconcile", racing_reconcile)
+    _turn(a, "hello", "hi")
+    first.save_turn("s1", a)
+    assert [text for _, text in _contents(first.load("s1"))] == ["sneaky", "turn", "hello", "hi"]
+
+
+def test_async_save_merges_like_the_sync_one(workers):
+    first, second = workers
+
+    async def scenario():
+        await first.acreate("s1", _session("hello", "hi doctor"))
+        a, b = await first.aload("s1"), await second.aload("s1")
+        _turn(a, "any fever?", "no")
+        _turn(b, "any cough?", "yes")
+        await asyncio.gather(first.asave_turn("s1", a), second.asave_turn("s1", b))
+        return await first.aload("s1")
+
+    stored = asyncio.run(scenario())
+    assert [msg["id"] for msg in stored["conversation_history"]] == [1, 2, 3, 4, 5, 6]
+    assert {"any fever?", "any cough?"} <= {msg["content"] for msg in stored["conversation_history"]}
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from session_turns import SessionTurnQueue, TurnQueueFull
+
+
+def test_turns_of_one_session_run_one_at_a_time_in_arrival_order():
+    turns = SessionTurnQueue()
+    events = []
+
+    def turn(name):
+        with turns.turn("s1"):
+            events.append(("start", name))
+            time.sleep(0.05)
+            events.append(("end", name))
+
+    threads = []
+    for name in range(4):
+        threads.append(threading.Thread(target=turn, args=(name,)))
+        threads[-1].start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    assert events == [(step, name) for name in range(4) for step in ("start", "end")]
+    assert turns.stats() == {"active_sessions": 0, "waiting": 0, "waited": 3, "rejected": 0}
+
+
+def test_different_sessions_do_not_wait_on_each_other():
+    turns = SessionTurnQueue()
+    with turns.turn("s1"):
+        entered = threading.Event()
+
+        def other():
+            with turns.turn("s2"):
+                entered.set()
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        assert entered.wait(1)
+        thread.join()
+
+
+def test_too_many_waiting_turns_are_refused():
+    turns = SessionTurnQueue(max_depth=1)
+    release = threading.Event()
+
+    def hold():
+        with turns.turn("s1"):
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    time.sleep(0.02)
+    waiter = threading.Thread(target=hold)
+    waiter.start()
+    time.sleep(0.02)
+    with pytest.raises(TurnQueueFull):
+        with turns.turn("s1"):
+            pass
+    assert turns.stats()["rejected"] == 1
+    release.set()
+    holder.join()
+    waiter.join()
+    assert turns.stats()["active_sessions"] == 0
+
+
+def test_threads_and_tasks_share_one_queue():
+    turns = SessionTurnQueue()
+    order = []
+
+    async def scenario():
+        held = threading.Event()
+        release = threading.Event()
+
+        def thread_turn():
+            with turns.turn("s1"):
+                held.set()
+                release.wait()
+                order.append("thread")
+
+        thread = threading.Thread(target=thread_turn)
+        thread.start()
+        held.wait()
+
+        async def task_turn():
+            async with turns.aturn("s1"):
+                order.append("task")
+
+        task = asyncio.create_task(task_turn())
+        await asyncio.sleep(0.05)
+        # The event loop stays free while the task waits
+        assert not task.done()
+        release.set()
+        await asyncio.wait_for(task, 1)
+        thread.join()
+
+    asyncio.run(scenario())
+    assert order == ["thread", "task"]
+
+
+def test_cancelled_waiter_leaves_the_line():
+    turns = SessionTurnQueue()
+
+    async def scenario():
+        async with turns.aturn("s1"):
+            waiting = asyncio.create_task(turns.aturn("s1").__aenter__())
+            await asyncio.sleep(0.01)
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+        # The cancelled waiter neither blocks the next turn nor keeps the queue alive
+        async with turns.aturn("s1"):
+            pass
+
+    asyncio.run(scenario())
+    assert turns.stats()["active_sessions"] == 0
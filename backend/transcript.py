@@ -0,0 +1,105 @@
+# Session transcripts.
+# A session's conversation_history is its only copy of the transcript: the
+# prompt history and /api/logs both read it. Each message gets a
+# monotonically increasing id when its turn is committed, and the list is
+# bounded to the newest TRANSCRIPT_MAX_MESSAGES messages (older ones have
+# long been folded into the prompt summary). Ids are contiguous, so reading
+# the messages after a given id is a slice, not a scan.
+import asyncio
+import os
+import threading
+
+MAX_MESSAGES = int(os.environ.get("TRANSCRIPT_MAX_MESSAGES", 1000))
+
+# Transcript roles as exposed by /api/logs
+LOG_ROLES = {"user": "user", "patient": "agent"}
+
+
+def first_id(history: list) -> int:
+    """Id of the oldest message still in the buffer (1 for legacy messages without ids)"""
+    return history[0].get("id", 1) if history else 1
+
+
+def last_id(history: list) -> int:
+    """Id of the newest message, 0 for an empty transcript"""
+    return first_id(history) + len(history) - 1
+
+
+def commit(history: list, max_messages: int = MAX_MESSAGES) -> list:
+    """
+    Number the messages appended since the last commit and drop the oldest
+    beyond max_messages. Returns the list to store in the session.
+    """
+    start = len(history)
+    while start and "id" not in history[start - 1]:
+        start -= 1
+    next_id = history[start - 1]["id"] + 1 if start else 1
+    for offset, msg in enumerate(history[start:]):
+        msg["id"] = next_id + offset
+    if max_messages and len(history) > max_messages:
+        history = history[-max_messages:]
+    return history
+
+
+def log_entries(history: list, since: int = 0, limit: int | None = None) -> list:
+    """Messages with an id greater than since, as {"id", "role", "text"} entries"""
+    start = max(since - first_id(history) + 1, 0)
+    end = start + limit if limit else len(history)
+    return [
+        {"id": msg["id"], "role": LOG_ROLES.get(msg.get("role"), msg.get("role")), "text": msg.get("content", "")}
+        for msg in history[start:end]
+    ]
+
+
+class TranscriptEvents:
+    """
+    Wakes long-poll and tail readers when a session's transcript grows.
+    Only sees turns saved by this process; readers re-check the session
+    store periodically to pick up turns saved by other workers.
+    """
+
+    def __init__(self, max_sessions: int = 10000):
+        self.max_sessions = max_sessions
+        self._last_ids = {}  # session_id -> newest id saved in this process
+        self._condition = threading.Condition()
+        self._waiters = set()  # (session_id, since, loop, future) of asyncio readers
+
+    def notify(self, session_id: str, newest_id: int):
+        with self._condition:
+            self._last_ids.pop(session_id, None)
+            self._last_ids[session_id] = newest_id
+            if len(self._last_ids) > self.max_sessions:
+                # Oldest-updated first; forgetting one only costs a re-check
+                del self._last_ids[next(iter(self._last_ids))]
+            self._condition.notify_all()
+            woken = [w for w in self._waiters if w[0] == session_id and newest_id > w[1]]
+        for _, _, loop, future in woken:
+            # notify may run on any thread; the future belongs to its loop
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def wait(self, session_id: str, since: int, timeout: float) -> bool:
+        """Block until this process saves a message after since, or timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._last_ids.get(session_id, 0) > since, timeout)
+
+    async def await_message(self, session_id: str, since: int, timeout: float) -> bool:
+        """asyncio counterpart of wait; waits without holding a thread"""
+        loop = asyncio.get_running_loop()
+        waiter = (session_id, since, loop, loop.create_future())
+        with self._condition:
+            if self._last_ids.get(session_id, 0) > since:
+                return True
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[3]), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._condition:
+                self._waiters.discard(waiter)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
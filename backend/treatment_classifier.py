@@ -0,0 +1,177 @@
+# Grading the patient's answer to a prescribed treatment.
+# The treatment node's reply is labelled "accept", "concern" or
+# "clarification" locally, after generation, instead of with a second model
+# call. Two stages:
+#   1. Rules, compiled into an IntentRouter: the wording the treatment
+#      instruction asks for ("I accept the treatment: ...") means accept, an
+#      explicit refusal means concern. Both are negation-aware, so "I don't
+#      accept this treatment" and "before I accept the treatment, ..." are not
+#      acceptances; those and every other reply go to stage 2.
+#   2. A multinomial naive Bayes model over words and word pairs, where words
+#      after a negation cue or hedge in the same clause are marked ("not sure"
+#      -> "not_sure", "before I accept" -> "not_accept") and a question mark
+#      is a feature of its own. It is trained from TREATMENT_EXAMPLES (JSONL
+#      of {"text", "label"}) the first time it is needed, which takes a few
+#      milliseconds.
+# Neither stage needs a network or a GPU; a reply is graded in tens of
+# microseconds.
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import NamedTuple
+
+from intent_router import IntentRouter
+
+LABELS = ("accept", "concern", "clarification")
+
+DEFAULT_EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "treatment_examples.jsonl")
+
+RULE_VOCABULARY = {
+    "accept": [
+        "i accept", "i'll accept", "i will accept", "i do accept", "i happily accept", "i gladly accept",
+        "accept the treatment", "accept this treatment", "accept your treatment", "accept the plan",
+    ],
+    "refuse": ["refuse", "refuses", "decline", "i'll pass", "no thank you", "no thanks"],
+    # Negation, and hedges that make an acceptance conditional
+    "negation": [
+        "not", "no", "don't", "do not", "won't", "will not", "never", "can't", "cannot", "couldn't",
+        "wouldn't", "shouldn't", "before", "if", "unless", "whether",
+    ],
+}
+
+# Cues that mark the following words of the clause for the model (hedges too)
+NEGATION_CUES = frozenset({
+    "not", "no", "never", "nor", "without", "don't", "won't", "can't", "cannot", "isn't", "aren't",
+    "doesn't", "didn't", "wouldn't", "shouldn't", "couldn't", "haven't", "hasn't",
+    "before", "if", "unless", "whether",
+})
+
+_TOKEN = re.compile(r"[a-z]+(?:'[a-z]+)?|[.,;:!?]")
+_CLAUSE_END = frozenset(".,;:!?")
+
+
+class TreatmentResponse(NamedTuple):
+    """Grade of one patient reply to a treatment"""
+    label: str
+    confidence: float
+    source: str  # "rules" or "model"
+
+    @property
+    def accepted(self) -> bool:
+        return self.label == "accept"
+
+
+def features(text: str) -> set:
+    """Words (negation-marked within their clause), consecutive word pairs and "?" """
+    found = set()
+    negated = False
+    previous = None
+    for token in _TOKEN.findall(text.lower().replace("’", "'")):
+        if token in _CLAUSE_END:
+            if token == "?":
+                found.add("?")
+            negated = False
+            previous = None
+            continue
+        word = "not_" + token if negated else token
+        found.add(word)
+        if previous is not None:
+            found.add(previous + " " + word)
+        if token in NEGATION_CUES:
+            negated = True
+        previous = word
+    return found
+
+
+class TreatmentClassifier:
+    """Rule stage plus a naive Bayes model trained from labelled examples"""
+
+    def __init__(self, examples: list, alpha: float = 1.0):
+        self.rules = IntentRouter(RULE_VOCABULARY)
+        self._train(examples, alpha)
+
+    def classify(self, reply: str) -> TreatmentResponse:
+        intent = self.rules.route(reply)
+        if intent.matched == {"accept"}:
+            return TreatmentResponse("accept", 1.0, "rules")
+        if intent.matched == {"refuse"}:
+            return TreatmentResponse("concern", 1.0, "rules")
+        return self._predict(reply)
+
+    def _train(self, examples: list, alpha: float):
+        counts = {label: Counter() for label in LABELS}
+        documents = Counter()
+        for text, label in examples:
+            if label not in counts:
+                raise ValueError(f"Unknown label {label!r}; expected one of {', '.join(LABELS)}")
+            counts[label].update(features(text))
+            documents[label] += 1
+        if not all(documents[label] for label in LABELS):
+            raise ValueError("Every label needs at least one example")
+        vocabulary = set().union(*counts.values())
+        totals = {label: sum(counts[label].values()) + alpha * len(vocabulary) for label in LABELS}
+        self.examples = sum(documents.values())
+        self._priors = tuple(math.log(documents[label] / self.examples) for label in LABELS)
+        # feature -> log P(feature | label) per label; unseen features are skipped when scoring
+        self._weights = {
+            feature: tuple(math.log((counts[label][feature] + alpha) / totals[label]) for label in LABELS)
+            for feature in vocabulary
+        }
+
+    def _predict(self, reply: str) -> TreatmentResponse:
+        scores = list(self._priors)
+        weights = self._weights
+        for feature in features(reply):
+            row = weights.get(feature)
+            if row is not None:
+                scores[0] += row[0]
+                scores[1] += row[1]
+                scores[2] += row[2]
+        best = max(scores)
+        index = scores.index(best)
+        confidence = 1 / sum(math.exp(score - best) for score in scores)
+        return TreatmentResponse(LABELS[index], confidence, "model")
+
+
+def load_examples(path: str) -> list:
+    """(text, label) pairs from a JSONL file of {"text": ..., "label": ...}"""
+    examples = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                examples.append((str(item["text"]), item["label"]))
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"{path}:{number}: expected {{\"text\", \"label\"}}: {e}") from e
+    return examples
+
+
+_CLASSIFIER = None
+_CLASSIFIER_LOCK = threading.Lock()
+
+
+def get_classifier() -> TreatmentClassifier:
+    """Trained from TREATMENT_EXAMPLES, or the bundled examples, on first use"""
+    global _CLASSIFIER
+    if _CLASSIFIER is None:
+        with _CLASSIFIER_LOCK:
+            if _CLASSIFIER is None:
+                path = os.environ.get("TREATMENT_EXAMPLES") or DEFAULT_EXAMPLES
+                try:
+                    classifier = TreatmentClassifier(load_examples(path))
+                except (OSError, ValueError) as e:
+                    if path == DEFAULT_EXAMPLES:
+                        raise
+                    print(f"[WARNING] Could not load treatment examples {path}: {e}; using the bundled set")
+                    classifier = TreatmentClassifier(load_examples(DEFAULT_EXAMPLES))
+                _CLASSIFIER = classifier
+    return _CLASSIFIER
+
+
+def classify_treatment_response(reply: str) -> TreatmentResponse:
+    return get_classifier().classify(reply)
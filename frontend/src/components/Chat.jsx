@@ -1,5 +1,5 @@
 import React, { useState, useEffect, useRef } from "react";
-import { createSession, sendMessage } from "../sessionservice";
+import { createSession, openChatSocket } from "../sessionservice";
 import "./Chat.css";
 
 export default function Chat() {
@@ -11,12 +11,14 @@ export default function Chat() {
   const [initializing, setInitializing] = useState(true);
   const messagesEndRef = useRef(null);
   const chatContainerRef = useRef(null);
+  const chatSocketRef = useRef(null);
 
   useEffect(() => {
     (async () => {
       try {
         setInitializing(true);
         const sid = await createSession();
+        chatSocketRef.current = openChatSocket(sid);
         setSessionId(sid);
         setError(null);
       } catch (err) {
@@ -26,6 +28,7 @@ export default function Chat() {
         setInitializing(false);
       }
     })();
+    return () => chatSocketRef.current?.close();
   }, []);
 
   // Auto-scroll to bottom when new messages arrive
@@ -44,9 +47,20 @@ export default function Chat() {
     setError(null);
 
     try {
-      const r = await sendMessage(sessionId, userMsg.text);
-      const reply = r.reply;
-      setMessages(prev => [...prev, { role: "agent", text: reply }]);
+      let started = false;
+      await chatSocketRef.current.send(userMsg.text, delta => {
+        if (!started) {
+          // First token: replace the typing indicator with the reply bubble
+          started = true;
+          setLoading(false);
+          setMessages(prev => [...prev, { role: "agent", text: delta }]);
+          return;
+        }
+        setMessages(prev => {
+          const last = prev[prev.length - 1];
+          return [...prev.slice(0, -1), { ...last, text: last.text + delta }];
+        });
+      });
     } catch (err) {
       setError("Failed to send message. Please try again.");
       console.error("Message send error:", err);
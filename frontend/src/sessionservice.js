@@ -1,11 +1,13 @@
 // Use VITE_API_URL if set (for production), otherwise empty string (uses Vite proxy for local dev)
 const API_BASE_URL = import.meta.env.VITE_API_URL || "";
 
-export async function createSession() {
+// scenario: a case id from /api/scenarios, "random", or omitted for the server default
+export async function createSession(scenario) {
   try {
     const res = await fetch(`${API_BASE_URL}/api/session`, { 
       method: "POST",
-      headers: { "Content-Type": "application/json" }
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(scenario ? { scenario } : {})
     });
     if (!res.ok) {
       throw new Error(`Failed to create session: ${res.statusText}`);
@@ -18,6 +20,14 @@ export async function createSession() {
   }
 }
 
+export async function listScenarios() {
+  const res = await fetch(`${API_BASE_URL}/api/scenarios`);
+  if (!res.ok) {
+    throw new Error(`Failed to list scenarios: ${res.statusText}`);
+  }
+  return await res.json();
+}
+
 export async function sendMessage(session_id, text) {
   try {
     const res = await fetch(`${API_BASE_URL}/api/message`, {
@@ -34,3 +44,112 @@ export async function sendMessage(session_id, text) {
     throw error;
   }
 }
+
+// Stream the patient reply over Server-Sent Events. onDelta is called with
+// each partial chunk; resolves with the full reply once the stream ends.
+export async function sendMessageStream(session_id, text, onDelta) {
+  try {
+    const res = await fetch(`${API_BASE_URL}/api/message/stream`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json", Accept: "text/event-stream" },
+      body: JSON.stringify({ session_id, message: text })
+    });
+    if (!res.ok || !res.body) {
+      throw new Error(`Failed to send message: ${res.statusText}`);
+    }
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let reply = "";
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let sep;
+      while ((sep = buffer.indexOf("\n\n")) !== -1) {
+        const raw = buffer.slice(0, sep);
+        buffer = buffer.slice(sep + 2);
+        const dataLine = raw.split("\n").find(line => line.startsWith("data: "));
+        if (!dataLine) continue;
+        const data = JSON.parse(dataLine.slice(6));
+        if (data.delta !== undefined) {
+          reply += data.delta;
+          onDelta?.(data.delta);
+        } else if (data.reply !== undefined) {
+          reply = data.reply;
+        } else if (data.error !== undefined) {
+          throw new Error(data.error);
+        }
+      }
+    }
+    return { reply };
+  } catch (error) {
+    console.error("Error streaming message:", error);
+    throw error;
+  }
+}
+
+function socketUrl(session_id) {
+  const url = new URL(`${API_BASE_URL}/api/ws`, window.location.href);
+  url.protocol = url.protocol === "https:" ? "wss:" : "ws:";
+  url.searchParams.set("session_id", session_id);
+  return url.toString();
+}
+
+// One WebSocket for the whole chat (served by the ASGI entrypoint). Messages
+// can be sent while a reply is still streaming; the server answers them in
+// order. send() falls back to sendMessageStream when the socket cannot be
+// opened, e.g. when the backend runs without asgi.py.
+export function openChatSocket(session_id) {
+  const turns = new Map(); // ref -> { onDelta, resolve, reject }
+  let nextRef = 1;
+  let opening = null;
+
+  function connect() {
+    if (opening) return opening;
+    opening = new Promise((resolve, reject) => {
+      const ws = new WebSocket(socketUrl(session_id));
+      ws.onopen = () => resolve(ws);
+      ws.onerror = () => reject(new Error("WebSocket connection failed"));
+      ws.onmessage = event => {
+        const data = JSON.parse(event.data);
+        const turn = turns.get(data.ref);
+        if (!turn) return;
+        if (data.delta !== undefined) {
+          turn.onDelta?.(data.delta);
+        } else if (data.reply !== undefined) {
+          turns.delete(data.ref);
+          turn.resolve({ reply: data.reply, id: data.id });
+        } else if (data.error !== undefined) {
+          turns.delete(data.ref);
+          turn.reject(new Error(data.error));
+        }
+      };
+      ws.onclose = () => {
+        opening = null;
+        for (const turn of turns.values()) turn.reject(new Error("Connection closed"));
+        turns.clear();
+      };
+    });
+    return opening;
+  }
+
+  return {
+    async send(text, onDelta) {
+      let ws;
+      try {
+        ws = await connect();
+      } catch (error) {
+        return sendMessageStream(session_id, text, onDelta);
+      }
+      const ref = nextRef++;
+      return new Promise((resolve, reject) => {
+        turns.set(ref, { onDelta, resolve, reject });
+        ws.send(JSON.stringify({ message: text, ref }));
+      });
+    },
+    close() {
+      opening?.then(ws => ws.close(), () => {});
+    }
+  };
+}